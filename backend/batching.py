@@ -0,0 +1,118 @@
+"""
+动态微批处理 (Micro-batching)
+
+将来自并发请求的单个推理任务收集起来，合并为一次批量前向计算。
+收集在达到最大批大小或等待超时后结束，从而在吞吐量与单请求延迟之间取得平衡。
+任务按优先级出队 (数值越小越先处理，同优先级先进先出)，后台任务的切片不会挡在交互式请求之前。
+"""
+import asyncio
+import itertools
+import logging
+from typing import Any, Awaitable, Callable, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    通用的异步微批处理器。
+
+    - ``batch_fn``: 协程函数 ``batch_fn(items, priority)``，接收一批输入并按相同顺序返回结果列表；
+      ``priority`` 为批内任务的最高优先级 (最小的数值)。计算本身应由它交给有界的推理工作池执行
+      (见 main.py)，微批处理器只在事件循环中组批，不另占线程。
+    - ``max_batch_size``: 单批最多合并的任务数。
+    - ``max_wait_ms``: 收到第一个任务后最多等待多少毫秒以凑满一批。
+    """
+
+    def __init__(self, batch_fn: Callable[[list, int], Awaitable[Sequence[Any]]], max_batch_size: int = 8,
+                 max_wait_ms: float = 10.0):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size 必须大于等于 1。")
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: asyncio.PriorityQueue | None = None
+        self._arrived: asyncio.Event | None = None  # 有新任务入队 (凑批时等待它，而不是直接等待 queue.get)
+        self._worker: asyncio.Task | None = None
+        self._inflight: list[tuple[int, int, Any, asyncio.Future]] = []  # 正在凑批或在 batch_fn 中执行的批次 (队列条目)
+        self._sequence = itertools.count()  # 同优先级按提交顺序出队，也避免比较 item
+
+    def start(self):
+        """在当前事件循环中启动后台批处理任务。"""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.PriorityQueue()
+            self._arrived = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台任务，并让正在执行与尚未处理的任务以异常结束。"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        # 正在凑批或执行的批次 (已交给工作池的计算继续运行，但结果不再返回) 与尚未处理的任务
+        entries = self._inflight
+        self._inflight = []
+        if self._queue is not None:
+            while not self._queue.empty():
+                entries.append(self._queue.get_nowait())
+        for _, _, _, future in entries:
+            if not future.done():
+                future.set_exception(RuntimeError("微批处理器已停止。"))
+
+    async def submit(self, item: Any, priority: int = 0) -> Any:
+        """
+        提交单个任务并等待其所在批次完成，返回该任务对应的结果。
+        ``priority`` 数值越小越先被取出组批 (取值与 worker_pool.PRIORITY_* 一致)。
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((priority, next(self._sequence), item, future))
+        self._arrived.set()
+        return await future
+
+    async def _collect_batch(self, batch: list[tuple[int, int, Any, asyncio.Future]]):
+        """将取出的队列条目逐个放入 ``batch`` (即 self._inflight)，停止时凑批中途取出的任务也能以异常结束。"""
+        loop = asyncio.get_running_loop()
+        batch.append(await self._queue.get())
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # 先取走已在队列中的任务，再在剩余时间内等待新任务
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            # 只在等待「有新任务」时使用超时，条目总是由上面的 get_nowait 取出：
+            # 若对 queue.get 使用 wait_for，超时与取出同时发生时取出的条目会被丢弃，其调用方永远等不到结果
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+
+    async def _run(self):
+        while True:
+            self._inflight = []
+            await self._collect_batch(self._inflight)
+            # 跳过已被调用方取消的任务
+            batch = self._inflight = [entry for entry in self._inflight if not entry[3].done()]
+            if not batch:
+                continue
+            try:
+                results = await self.batch_fn([item for _, _, item, _ in batch], min(entry[0] for entry in batch))
+            except Exception as e:
+                self._inflight = []
+                logger.error(f"批量推理失败 (batch={len(batch)}): {e}", exc_info=True)
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self._inflight = []
+            for (_, _, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,376 @@
+"""
+检测流程离线基准测试
+
+使用合成的 CT 切片 (DICOM / PNG，多种尺寸与结节密度) 测量检测流程的延迟与吞吐量，不依赖任何患者数据。
+对每个场景分别测量:
+    - pipeline: 直接调用 run_prediction，并按阶段 (decode / preprocess / unet / watershed / cnn / contours) 统计耗时；
+    - preprocess: 只调用 preprocess_image (解码与预处理)，并用 tracemalloc 统计每张切片的峰值分配内存；
+    - http:     通过 FastAPI TestClient 调用 /api/predict 的端到端耗时 (需要安装 httpx)。
+报告 p50 / p95 / p99 延迟、每秒切片数与进程峰值内存 (RSS)，并可与保存的基线文件对比以发现性能回退。
+每个场景结束后还记录当前常驻内存 (rss_mb)，即推理结束后仍未归还的内存；对比 MALLOC_RETAIN=0/1 时用它衡量内存代价。
+任一场景执行失败 (包括 HTTP 请求失败) 时以非零状态码退出。
+
+用法示例:
+    python benchmark.py --sizes 512 1024 --densities 0 10 40 --iterations 20
+    python benchmark.py --save-baseline benchmark_baseline.json
+    python benchmark.py --baseline benchmark_baseline.json --tolerance 0.15
+    python benchmark.py --random-weights       # 没有权重文件时使用随机初始化的模型 (只用于测量计算开销)
+    python benchmark.py --unet-mode tiled --sizes 512 1024 2048 --formats dcm   # 分块推理在各尺寸下的吞吐与内存
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+# 基准测试需要每次都真正执行推理
+os.environ.setdefault("RESULT_CACHE_MAX_ENTRIES", "0")
+# HTTP 基准测试在服务就绪 (模型加载与预热完成) 后才开始计时
+os.environ.setdefault("MODEL_LOAD_IN_BACKGROUND", "0")
+READY_TIMEOUT_SECONDS = 600
+
+import cv2
+import numpy as np
+import torch
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import predict
+from metrics import run_profiled
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+STAGES = ("decode", "preprocess", "unet", "watershed", "cnn", "contours")
+
+
+# --- 合成数据 ---
+def make_phantom(size: int, n_nodules: int, seed: int = 0) -> np.ndarray:
+    """生成一张 HU 值的合成胸部 CT 切片: 体部椭圆、两侧肺野，以及随机分布在肺野内的球形结节。"""
+    rng = np.random.default_rng(seed)
+    image = np.full((size, size), -1000, np.float32)
+    center = size // 2
+    cv2.ellipse(image, (center, center), (int(size * 0.45), int(size * 0.35)), 0, 0, 360, 40, -1)
+    for side in (-1, 1):
+        lung_center = (center + side * int(size * 0.2), center)
+        cv2.ellipse(image, lung_center, (int(size * 0.15), int(size * 0.27)), 0, 0, 360, -850, -1)
+    for _ in range(n_nodules):
+        side = rng.choice((-1, 1))
+        x = center + side * int(size * 0.2) + int(rng.integers(-size * 0.1, size * 0.1))
+        y = center + int(rng.integers(-size * 0.2, size * 0.2))
+        radius = max(2, int(rng.integers(size // 170, size // 35)))
+        cv2.circle(image, (x, y), radius, int(rng.integers(-100, 60)), -1)
+    image += rng.normal(0, 20, image.shape).astype(np.float32)
+    return image
+
+
+def encode_dicom(image_hu: np.ndarray, slice_z: float = 0.0) -> bytes:
+    """将 HU 图像编码为 16 位 CT DICOM 文件 (RescaleIntercept = -1024)。"""
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = CT_IMAGE_STORAGE
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.Modality = "CT"
+    ds.Rows, ds.Columns = image_hu.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 0
+    ds.RescaleSlope, ds.RescaleIntercept = 1, -1024
+    ds.ImagePositionPatient = [0.0, 0.0, slice_z]
+    ds.PixelSpacing = [0.7, 0.7]
+    ds.PixelData = np.clip(image_hu + 1024, 0, 65535).astype(np.uint16).tobytes()
+    buffer = BytesIO()
+    try:
+        ds.save_as(buffer, enforce_file_format=True)  # pydicom >= 3
+    except TypeError:
+        ds.is_little_endian, ds.is_implicit_VR = True, False
+        ds.save_as(buffer, write_like_original=False)
+    return buffer.getvalue()
+
+
+def encode_png(image_hu: np.ndarray) -> bytes:
+    """将 HU 图像按肺窗映射到 8 位灰度并编码为 PNG。"""
+    low = predict.WINDOW_LEVEL - predict.WINDOW_WIDTH / 2
+    image = np.clip((image_hu - low) / predict.WINDOW_WIDTH, 0, 1)
+    return cv2.imencode(".png", (image * 255).astype(np.uint8))[1].tobytes()
+
+
+# --- 统计 ---
+def peak_rss_mb() -> float | None:
+    """进程自启动以来的峰值常驻内存 (MB)。"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def rss_mb() -> float | None:
+    """当前常驻内存 (MB)，只支持 Linux。"""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, IndexError, AttributeError):  # 非 Linux 平台没有 /proc 或 os.sysconf
+        return None
+
+
+def summarize(latencies: list[float]) -> dict:
+    values = np.asarray(latencies) * 1000
+    return {
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "slices_per_sec": float(len(values) / (values.sum() / 1000)) if values.sum() > 0 else 0.0,
+    }
+
+
+# --- 基准测试 ---
+def install_random_models():
+    """使用随机初始化的模型代替权重文件，只用于在没有权重时测量计算开销。"""
+    from cnn_classifier_model import get_classifier_model
+    from unet_model import UNet
+    unet = UNet(n_channels=1, n_classes=1, bilinear=False).to(predict.DEVICE).eval()
+    cnn = get_classifier_model(pretrained=False).to(predict.DEVICE).eval()
+    predict._install_models(unet, cnn)
+
+
+def bench_pipeline(samples: list[bytes], iterations: int, warmup: int) -> dict:
+    for i in range(warmup):
+        predict.run_prediction(samples[i % len(samples)])
+    latencies, stages, candidates, tiles, tiles_skipped = [], {stage: [] for stage in STAGES}, [], [], []
+    for i in range(iterations):
+        start = time.perf_counter()
+        _, profile = run_profiled(predict.run_prediction, samples[i % len(samples)])
+        latencies.append(time.perf_counter() - start)
+        for stage, seconds in profile.get("stages", {}).items():
+            stages.setdefault(stage, []).append(seconds)
+        candidates.append(profile.get("candidates", 0))
+        if "tiles" in profile:
+            tiles.append(profile["tiles"])
+            tiles_skipped.append(profile["tiles_skipped"])
+    result = summarize(latencies)
+    result["stages"] = {stage: summarize(values) for stage, values in stages.items() if values}
+    result["mean_candidates"] = float(np.mean(candidates))
+    if tiles:
+        result["mean_tiles"] = float(np.mean(tiles))
+        result["mean_tiles_skipped"] = float(np.mean(tiles_skipped))
+    return result
+
+
+def bench_preprocess(samples: list[bytes], iterations: int, warmup: int) -> dict:
+    """preprocess_image 的延迟，以及每张切片的峰值分配内存 (MB，包括解码与返回的输入缓冲区)。"""
+    for i in range(warmup):
+        predict.preprocess_image(samples[i % len(samples)])
+    latencies, peaks = [], []
+    for i in range(iterations):
+        start = time.perf_counter()
+        predict.preprocess_image(samples[i % len(samples)])
+        latencies.append(time.perf_counter() - start)
+        # 分配统计单独运行一次，避免 tracemalloc 的开销计入延迟
+        tracemalloc.start()
+        try:
+            predict.preprocess_image(samples[i % len(samples)])
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    result = summarize(latencies)
+    result["peak_alloc_mb"] = float(np.mean(peaks)) / 1024 / 1024
+    return result
+
+
+def bench_http(client, samples: list[bytes], iterations: int, warmup: int) -> dict:
+    def post(data):
+        response = client.post("/api/predict", files={"file": ("slice", data)})
+        response.raise_for_status()
+    for i in range(warmup):
+        post(samples[i % len(samples)])
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        post(samples[i % len(samples)])
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+
+def wait_until_ready(client, timeout: float = READY_TIMEOUT_SECONDS):
+    """轮询 /api/ready 直到服务就绪；加载失败或超时时抛出 RuntimeError。"""
+    deadline = time.monotonic() + timeout
+    while True:
+        response = client.get("/api/ready")
+        if response.status_code == 200:
+            return
+        error = response.json().get("error")
+        if error:
+            raise RuntimeError(f"服务启动失败: {error}")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"服务在 {timeout:.0f} 秒内未就绪。")
+        time.sleep(0.2)
+
+
+def run_benchmarks(args) -> dict:
+    client = None
+    if not args.skip_http:
+        try:
+            from fastapi.testclient import TestClient
+            import main as server
+            client = TestClient(server.app)
+            client.__enter__()  # 触发 startup 事件
+            wait_until_ready(client)
+        except ImportError as e:
+            print(f"跳过 HTTP 基准测试 (缺少依赖: {e})。")
+
+    results = {}
+    try:
+        for fmt in args.formats:
+            for size in args.sizes:
+                for density in args.densities:
+                    name = f"{fmt}-{size}-n{density}" + ("-tiled" if args.unet_mode == "tiled" else "")
+                    phantoms = [make_phantom(size, density, seed) for seed in range(args.samples)]
+                    encode = encode_dicom if fmt == "dcm" else encode_png
+                    samples = [encode(image) for image in phantoms]
+                    entry = {"request_bytes": int(np.mean([len(s) for s in samples]))}
+                    rss_before = peak_rss_mb()
+                    try:
+                        entry["preprocess"] = bench_preprocess(samples, args.iterations, args.warmup)
+                        entry["pipeline"] = bench_pipeline(samples, args.iterations, args.warmup)
+                    except Exception as e:
+                        entry["error"] = f"{type(e).__name__}: {e}"
+                    if client is not None and "error" not in entry:
+                        try:
+                            entry["http"] = bench_http(client, samples, args.iterations, args.warmup)
+                        except Exception as e:
+                            # HTTP 失败不覆盖已测得的 preprocess / pipeline 结果
+                            entry["http_error"] = f"{type(e).__name__}: {e}"
+                    entry["peak_rss_mb"] = peak_rss_mb()
+                    if rss_before is not None:
+                        # 峰值 RSS 只增不减，按尺寸从小到大运行时，增量即为该场景新增的内存峰值
+                        entry["rss_growth_mb"] = entry["peak_rss_mb"] - rss_before
+                    entry["rss_mb"] = rss_mb()
+                    results[name] = entry
+                    print_entry(name, entry)
+    finally:
+        if client is not None:
+            client.__exit__(None, None, None)
+    return results
+
+
+# --- 报告与基线对比 ---
+def print_entry(name: str, entry: dict):
+    if "error" in entry:
+        print(f"{name:<18} ERROR {entry['error']}")
+        return
+    pipe = entry["pipeline"]
+    line = (f"{name:<18} pipeline p50={pipe['p50_ms']:8.1f}ms p95={pipe['p95_ms']:8.1f}ms "
+            f"p99={pipe['p99_ms']:8.1f}ms {pipe['slices_per_sec']:6.2f} slices/s")
+    if "http" in entry:
+        line += f" | http p50={entry['http']['p50_ms']:8.1f}ms p95={entry['http']['p95_ms']:8.1f}ms"
+    elif "http_error" in entry:
+        line += f" | http ERROR {entry['http_error']}"
+    rss = entry.get("peak_rss_mb")
+    line += f" | peak RSS={rss:.0f}MB (+{entry['rss_growth_mb']:.0f}MB)" if rss is not None else ""
+    line += f" RSS={entry['rss_mb']:.0f}MB" if entry.get("rss_mb") is not None else ""
+    print(line)
+    pre = entry["preprocess"]
+    print(f"{'':<18} preprocess p50={pre['p50_ms']:.2f}ms peak alloc={pre['peak_alloc_mb']:.2f}MB")
+    stages = "  ".join(f"{stage}={stats['p50_ms']:.1f}" for stage, stats in pipe["stages"].items())
+    line = f"{'':<18} stages p50 (ms): {stages}  candidates={pipe['mean_candidates']:.1f}"
+    if "mean_tiles" in pipe:
+        line += f"  tiles={pipe['mean_tiles']:.1f} (skipped {pipe['mean_tiles_skipped']:.1f})"
+    print(line)
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """返回超出容差的回退项列表；延迟变大或吞吐下降超过 ``tolerance`` (相对值) 视为回退。"""
+    regressions = []
+    for name, entry in results.items():
+        base = baseline.get(name)
+        if base is None or "error" in base:
+            continue
+        if "error" in entry:
+            regressions.append(f"{name}: {entry['error']}")
+            continue
+        if "http_error" in entry and "http" in base:
+            regressions.append(f"{name} http: {entry['http_error']}")
+        for kind in ("preprocess", "pipeline", "http"):
+            if kind not in entry or kind not in base:
+                continue
+            current, previous = entry[kind], base[kind]
+            for metric in ("p50_ms", "p95_ms"):
+                if current[metric] > previous[metric] * (1 + tolerance):
+                    regressions.append(f"{name} {kind} {metric}: {previous[metric]:.1f} -> {current[metric]:.1f}")
+            if current["slices_per_sec"] < previous["slices_per_sec"] * (1 - tolerance):
+                regressions.append(f"{name} {kind} slices_per_sec: "
+                                   f"{previous['slices_per_sec']:.2f} -> {current['slices_per_sec']:.2f}")
+            if "peak_alloc_mb" in previous and current["peak_alloc_mb"] > previous["peak_alloc_mb"] * (1 + tolerance):
+                regressions.append(f"{name} {kind} peak_alloc_mb: "
+                                   f"{previous['peak_alloc_mb']:.2f} -> {current['peak_alloc_mb']:.2f}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="肺结节检测流程离线基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024], help="合成切片的边长 (像素)")
+    parser.add_argument("--densities", type=int, nargs="+", default=[0, 10, 40], help="每张切片的结节数")
+    parser.add_argument("--formats", nargs="+", choices=["dcm", "png"], default=["dcm", "png"])
+    parser.add_argument("--samples", type=int, default=4, help="每个场景生成的不同切片数")
+    parser.add_argument("--iterations", type=int, default=20, help="每个场景的计时次数")
+    parser.add_argument("--warmup", type=int, default=2, help="每个场景计时前的预热次数")
+    parser.add_argument("--skip-http", action="store_true", help="不测量 HTTP 端点")
+    parser.add_argument("--random-weights", action="store_true", help="使用随机初始化的模型")
+    parser.add_argument("--unet-mode", choices=["resize", "tiled"], default=predict.UNET_INFERENCE_MODE,
+                        help="U-Net 推理模式 (见 predict.UNET_INFERENCE_MODE)")
+    parser.add_argument("--output", help="将结果写入 JSON 文件")
+    parser.add_argument("--save-baseline", help="将结果保存为基线文件")
+    parser.add_argument("--baseline", help="与基线文件对比，出现回退时以非零状态码退出")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="允许的相对性能波动 (默认 0.15)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    predict.UNET_INFERENCE_MODE = args.unet_mode
+    args.sizes = sorted(args.sizes)
+    # 与服务启动时相同的线程数与内存分配器设置 (见 predict.configure_runtime)
+    runtime = predict.configure_runtime()
+    if args.random_weights:
+        install_random_models()
+    unet, cnn = predict.get_models()
+    if unet is None or cnn is None:
+        print("模型加载失败；如果没有权重文件，可以使用 --random-weights。")
+        return 2
+
+    results = run_benchmarks(args)
+    report = {"device": str(predict.DEVICE), "torch_threads": torch.get_num_threads(), "unet_mode": args.unet_mode,
+              "runtime": runtime, "results": results}
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+            print(f"结果已写入 {path}")
+
+    failed = [name for name, entry in results.items() if "error" in entry or "http_error" in entry]
+    if failed:
+        print(f"以下场景执行失败: {', '.join(failed)}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline.get("results", {}), args.tolerance)
+        if regressions:
+            print("检测到性能回退:")
+            for item in regressions:
+                print(f"  - {item}")
+            return 1
+        print("与基线相比未发现性能回退。")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,19 +7,21 @@ def get_classifier_model(arch: str = 'efficientnet_b0', num_classes: int = 2, pr
     支持:
     1. efficientnet_b0  (默认)
     2. resnet101  (用户提出的"resnet100"将自动映射为 resnet101)
+
+    推理时权重随后由检查点覆盖，应传入 ``pretrained=False``，避免下载 ImageNet 权重 (离线环境中会失败或长时间阻塞)。
     """
 
     arch = arch.lower()
 
     if arch in {'efficientnet', 'efficientnet_b0', 'effb0'}:
         # EfficientNet-B0
-        model = models.efficientnet_b0(pretrained=pretrained)
+        model = models.efficientnet_b0(weights=models.EfficientNet_B0_Weights.DEFAULT if pretrained else None)
         num_ftrs = model.classifier[1].in_features
         model.classifier[1] = nn.Linear(num_ftrs, num_classes)
 
     elif arch in {'resnet100', 'resnet101'}:
         # torchvision 没有 resnet100，使用最接近的 resnet101
-        model = models.resnet101(pretrained=pretrained)
+        model = models.resnet101(weights=models.ResNet101_Weights.DEFAULT if pretrained else None)
         num_ftrs = model.fc.in_features
         model.fc = nn.Linear(num_ftrs, num_classes)
 
@@ -0,0 +1,154 @@
+"""
+结节轮廓的响应格式
+
+默认的 JSON 格式中每个轮廓点都是一个 {"x": .., "y": ..} 对象，高分辨率图像上不规则的大结节每张切片可有数千个点，
+逐点的 Pydantic 校验与 JSON 序列化会占去可观的时间。这里提供更紧凑的编码 (由 ``format`` 查询参数或 Accept 头选择):
+    - json: 默认格式，与原来相同；
+    - flat: 轮廓为展平的整数数组 [x0, y0, x1, y1, ...]；
+    - packed: 轮廓为交错坐标的 little-endian int16 数组 (坐标超出 int16 范围时为 int32) 的 base64 字符串，``dtype`` 给出类型；
+    - rle: 轮廓填充后的掩码，在外接矩形 ``bbox`` = [x, y, w, h] 内按行优先做游程编码，第一个游程为背景 (可能为 0)；
+    - msgpack: 与 packed 相同的结构，以 MessagePack 二进制编码，坐标数组直接以原始字节存放 (需要安装 msgpack)。
+编码前可按 Douglas-Peucker 容差 (原图像素) 简化轮廓，用于显示。
+后处理与结果缓存中轮廓始终为 (N, 2) 的 int32 坐标数组 (序列化时为 flat 格式的整数数组，见 json_default)，
+逐点的 {"x", "y"} 对象只在以 json 格式返回响应时生成。
+"""
+import base64
+import json
+
+import cv2
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:  # 可选依赖，未安装时不提供 msgpack 格式
+    msgpack = None
+
+CONTOUR_FORMATS = ("json", "flat", "packed", "rle", "msgpack")
+MEDIA_TYPES = {
+    "json": "application/json",
+    "flat": "application/vnd.lungcad.flat+json",
+    "packed": "application/vnd.lungcad.packed+json",
+    "rle": "application/vnd.lungcad.rle+json",
+    "msgpack": "application/msgpack",
+}
+_MEDIA_TYPE_FORMATS = {media_type: fmt for fmt, media_type in MEDIA_TYPES.items()}
+_MEDIA_TYPE_FORMATS["application/x-msgpack"] = "msgpack"
+
+
+def _available(fmt: str) -> bool:
+    return fmt != "msgpack" or msgpack is not None
+
+
+def _accepted_media_types(accept: str) -> list[str]:
+    """按 q 值从高到低 (相同时保持原顺序) 返回 Accept 头中的媒体类型，忽略 q=0 的类型。"""
+    weighted = []
+    for item in accept.split(","):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type and quality > 0:
+            weighted.append((-quality, len(weighted), media_type.lower()))
+    return [media_type for _, _, media_type in sorted(weighted)]
+
+
+def negotiate_format(requested: str | None, accept: str | None) -> str:
+    """
+    确定响应格式：``requested`` (查询参数) 优先，其次为 Accept 头中第一个支持的媒体类型，默认 json。
+    查询参数给出未知或不可用的格式时抛出 ValueError；Accept 头中不支持的类型直接忽略。
+    """
+    if requested:
+        fmt = requested.lower()
+        if fmt not in CONTOUR_FORMATS:
+            raise ValueError(f"Unknown format '{requested}', expected one of: {', '.join(CONTOUR_FORMATS)}.")
+        if not _available(fmt):
+            raise ValueError("The msgpack format requires the 'msgpack' package on the server.")
+        return fmt
+    for media_type in _accepted_media_types(accept or ""):
+        fmt = _MEDIA_TYPE_FORMATS.get(media_type)
+        if fmt and _available(fmt):
+            return fmt
+    return "json"
+
+
+def json_default(value):
+    """``json.dumps`` 的 default 钩子：轮廓数组序列化为展平的整数数组 [x0, y0, x1, y1, ...]。"""
+    if isinstance(value, np.ndarray):
+        return value.ravel().tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _contour_array(contour) -> np.ndarray:
+    """轮廓数组、展平的整数数组或 (旧版本缓存中的) {"x", "y"} 点列表统一转换为 (N, 2) 的 int32 数组。"""
+    if len(contour) and isinstance(contour[0], dict):
+        return np.array([(point["x"], point["y"]) for point in contour], dtype=np.int32).reshape(-1, 2)
+    return np.asarray(contour, dtype=np.int32).reshape(-1, 2)
+
+
+def simplify_contour(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """Douglas-Peucker 简化闭合轮廓；简化后不足 3 个点时保留原轮廓。"""
+    if tolerance <= 0 or len(points) < 3:
+        return points
+    simplified = cv2.approxPolyDP(points.reshape(-1, 1, 2), tolerance, True).reshape(-1, 2)
+    return simplified if len(simplified) >= 3 else points
+
+
+def _packed(points: np.ndarray) -> tuple[str, bytes]:
+    dtype = "int16" if points.size == 0 or (points.min() >= -2 ** 15 and points.max() < 2 ** 15) else "int32"
+    return dtype, points.astype("<i2" if dtype == "int16" else "<i4").tobytes()
+
+
+def _rle(points: np.ndarray) -> dict:
+    x, y, w, h = cv2.boundingRect(points)
+    mask = np.zeros((h, w), dtype=np.uint8)
+    if points.size:
+        cv2.fillPoly(mask, [points - (x, y)], 1)
+    flat = mask.ravel()
+    boundaries = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], boundaries, [flat.size])))
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return {"bbox": [x, y, w, h], "counts": counts.tolist()}
+
+
+def encode_nodule(nodule: dict, fmt: str, tolerance: float = 0.0) -> dict:
+    """将一个 {"id", "contour": 坐标数组} 结节编码为 ``fmt`` 格式，其余字段原样保留。"""
+    points = simplify_contour(_contour_array(nodule["contour"]), tolerance)
+    encoded = {key: value for key, value in nodule.items() if key != "contour"}
+    if fmt == "json":
+        encoded["contour"] = [{"x": x, "y": y} for x, y in points.tolist()]
+    elif fmt == "flat":
+        encoded["contour"] = points.ravel().tolist()
+    elif fmt in ("packed", "msgpack"):
+        dtype, data = _packed(points)
+        encoded["dtype"] = dtype
+        encoded["contour"] = data if fmt == "msgpack" else base64.b64encode(data).decode("ascii")
+    elif fmt == "rle":
+        encoded.update(_rle(points))
+    else:
+        raise ValueError(f"Unknown format '{fmt}'.")
+    return encoded
+
+
+def _encode_tree(value, fmt: str, tolerance: float):
+    """遍历响应结构，编码其中所有带 ``contour`` 的结节 (不会进入轮廓点列表内部)。"""
+    if isinstance(value, dict):
+        if "contour" in value:
+            return encode_nodule(value, fmt, tolerance)
+        return {key: _encode_tree(item, fmt, tolerance) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_encode_tree(item, fmt, tolerance) for item in value]
+    return value
+
+
+def render(payload: dict, fmt: str = "json", tolerance: float = 0.0) -> tuple[bytes, str]:
+    """将响应 (轮廓为坐标数组) 编码为 ``fmt`` 格式，返回 (响应体, 媒体类型)。"""
+    payload = _encode_tree(payload, fmt, tolerance)
+    if fmt == "msgpack":
+        return msgpack.packb(payload), MEDIA_TYPES[fmt]
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode(), MEDIA_TYPES[fmt]
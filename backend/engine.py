@@ -0,0 +1,382 @@
+"""
+CPU 推理后端
+
+在启动时根据配置 (predict.INFERENCE_BACKEND) 将加载好的 fp32 U-Net 与 CNN 分类器转换为所选的推理后端。
+转换后的模型保持与原模型相同的调用方式 (输入/输出均为 torch.Tensor)，其余流程无需改动。
+
+支持的后端:
+    - eager:         原始 PyTorch 模型 (可配合 channels_last 内存格式)；
+    - torchscript:   trace + freeze 后的 TorchScript 模型，加载时再做 optimize_for_inference；
+    - onnx:          ONNX Runtime (需要安装 onnxruntime)；
+    - onnx_int8:     ONNX Runtime + 动态 int8 量化权重；
+    - int8_dynamic:  PyTorch 动态 int8 量化 (仅作用于 nn.Linear，即 CNN 的分类头；U-Net 没有线性层，保持 fp32)；
+    - int8_static:   PyTorch FX 训练后静态 int8 量化 (卷积层)，需要校准数据。
+
+导出与一致性检查 (在 backend 目录下运行):
+    python engine.py export --backends torchscript onnx onnx_int8 int8_static --calibration-dir /path/to/dicoms
+    python engine.py parity --backend int8_static --data-dir /path/to/dicoms
+导出的文件保存在 MODEL_EXPORT_DIR 中，并记录对应的模型版本；权重更新后旧的导出文件会被忽略。
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("eager", "torchscript", "onnx", "onnx_int8", "int8_dynamic", "int8_static")
+MANIFEST_NAME = "manifest.json"
+EXPORT_FORMAT = 2  # 导出格式版本；格式变化 (如 U-Net 改为动态 H/W) 后旧的导出文件会被忽略并重新导出
+
+# 各后端导出文件名 (U-Net, CNN)
+ARTIFACTS = {
+    "torchscript": ("unet.ts.pt", "cnn.ts.pt"),
+    "onnx": ("unet.onnx", "cnn.onnx"),
+    "onnx_int8": ("unet.int8.onnx", "cnn.int8.onnx"),
+    "int8_static": ("unet.int8.pt", "cnn.int8.pt"),
+}
+
+
+# --- 后端包装 ---
+class ChannelsLastModule(nn.Module):
+    """将模型与输入转换为 channels_last 内存格式，CPU 上的卷积通常更快。"""
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model.to(memory_format=torch.channels_last)
+
+    def forward(self, x):
+        return self.model(x.contiguous(memory_format=torch.channels_last))
+
+
+class OnnxModule(nn.Module):
+    """以 nn.Module 的调用方式包装 ONNX Runtime 会话。"""
+
+    def __init__(self, path: str, num_threads: int | None = None):
+        super().__init__()
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.path = path
+        self.session = ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, x):
+        output = self.session.run(None, {self.input_name: x.detach().cpu().numpy()})[0]
+        return torch.from_numpy(output)
+
+
+# --- 导出 ---
+def _example_inputs(batch_size: int = 2) -> tuple[torch.Tensor, torch.Tensor]:
+    from predict import PATCH_SIZE, TARGET_IMG_SIZE
+    unet_input = torch.rand(batch_size, 1, TARGET_IMG_SIZE[1], TARGET_IMG_SIZE[0])
+    cnn_input = torch.randn(batch_size, 3, PATCH_SIZE, PATCH_SIZE)
+    return unet_input, cnn_input
+
+
+def to_torchscript(model: nn.Module, example: torch.Tensor) -> torch.jit.ScriptModule:
+    """trace 并 freeze (常量折叠、内联参数)。optimize_for_inference 的结果无法序列化，在加载后再执行。"""
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), (example,), check_trace=False)
+    return torch.jit.freeze(traced)
+
+
+def export_onnx(model: nn.Module, example: torch.Tensor, path: str, dynamic_spatial: bool = False):
+    """
+    导出 ONNX，批大小总是动态的。``dynamic_spatial`` 时 H/W 也是动态的：
+    U-Net 的输入是肺野门控裁剪出的区域 (见 predict.lung_gate)，尺寸随切片变化。
+    """
+    axes = {0: "batch", 2: "height", 3: "width"} if dynamic_spatial else {0: "batch"}
+    kwargs = dict(input_names=["input"], output_names=["output"],
+                  dynamic_axes={"input": axes, "output": axes}, opset_version=17)
+    with torch.no_grad():
+        try:
+            torch.onnx.export(model.eval(), (example,), path, dynamo=False, **kwargs)
+        except TypeError:  # 较早版本的 torch 没有 dynamo 参数
+            torch.onnx.export(model.eval(), (example,), path, **kwargs)
+
+
+def quantize_onnx(src_path: str, dst_path: str):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    quantize_dynamic(src_path, dst_path, weight_type=QuantType.QInt8)
+
+
+def quantize_dynamic_int8(model: nn.Module) -> nn.Module:
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_static_int8(model: nn.Module, calibration_batches: list[torch.Tensor]) -> torch.jit.ScriptModule:
+    """FX 训练后静态量化：插入观察器、用校准数据统计激活范围，再转换为 int8 并冻结为 TorchScript。"""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    torch.backends.quantized.engine = "x86"
+    example = calibration_batches[0]
+    prepared = prepare_fx(copy.deepcopy(model).eval(), get_default_qconfig_mapping("x86"), example_inputs=(example,))
+    with torch.no_grad():
+        for batch in calibration_batches:
+            prepared(batch)
+    quantized = convert_fx(prepared)
+    with torch.no_grad():
+        return torch.jit.freeze(torch.jit.trace(quantized, (example,), check_trace=False))
+
+
+def _synthetic_slices(count: int) -> list[bytes]:
+    from benchmark import encode_dicom, make_phantom
+    return [encode_dicom(make_phantom(512, n_nodules=20, seed=seed)) for seed in range(count)]
+
+
+def _read_slices(data_dir: str | None, limit: int) -> list[bytes]:
+    """读取目录中的切片文件；未指定目录时使用合成切片。"""
+    if not data_dir:
+        return _synthetic_slices(limit)
+    slices = []
+    for root, _, names in os.walk(data_dir):
+        for name in sorted(names):
+            with open(os.path.join(root, name), "rb") as f:
+                slices.append(f.read())
+            if len(slices) >= limit:
+                return slices
+    return slices
+
+
+def calibration_data(unet: nn.Module, slices: list[bytes]) -> tuple[list[torch.Tensor], list[torch.Tensor]]:
+    """由切片生成 U-Net 输入与 CNN 候选 patch 批次，用于静态量化校准。"""
+    from predict import _extract_patches_with_watershed, _patches_to_tensor, preprocess_image
+    unet_batches, cnn_batches = [], []
+    for image_bytes in slices:
+        input_tensor, resized_image_np, _ = preprocess_image(image_bytes)
+        if input_tensor is None:
+            continue
+        input_tensor = input_tensor.cpu()
+        unet_batches.append(input_tensor)
+        with torch.no_grad():
+            prob_map = unet(input_tensor).squeeze().numpy()
+        _, candidates = _extract_patches_with_watershed(resized_image_np, prob_map)
+        if candidates:
+            cnn_batches.append(_patches_to_tensor([cand["patch"] for cand in candidates]).cpu())
+    if not cnn_batches:
+        cnn_batches.append(_example_inputs()[1])
+    return unet_batches, cnn_batches
+
+
+def _read_manifest(export_dir: str) -> dict:
+    try:
+        with open(os.path.join(export_dir, MANIFEST_NAME), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def export_models(unet: nn.Module, cnn: nn.Module, backends: list[str], export_dir: str,
+                  calibration_slices: list[bytes] | None = None) -> dict:
+    """将 fp32 模型导出为各后端所需的文件，并在 manifest.json 中记录模型版本。"""
+    from predict import get_model_version
+    os.makedirs(export_dir, exist_ok=True)
+    unet, cnn = unet.cpu().eval(), cnn.cpu().eval()
+    unet_example, cnn_example = _example_inputs()
+    manifest = _read_manifest(export_dir)
+    version = get_model_version()
+    if manifest.get("model_version") != version or manifest.get("format") != EXPORT_FORMAT:
+        manifest = {"model_version": version, "format": EXPORT_FORMAT, "backends": []}
+
+    for backend in backends:
+        unet_path, cnn_path = (os.path.join(export_dir, name) for name in ARTIFACTS[backend])
+        if backend == "torchscript":
+            torch.jit.save(to_torchscript(unet, unet_example), unet_path)
+            torch.jit.save(to_torchscript(cnn, cnn_example), cnn_path)
+        elif backend == "onnx":
+            export_onnx(unet, unet_example, unet_path, dynamic_spatial=True)
+            export_onnx(cnn, cnn_example, cnn_path)
+        elif backend == "onnx_int8":
+            fp32_unet_path, fp32_cnn_path = (os.path.join(export_dir, name) for name in ARTIFACTS["onnx"])
+            if "onnx" not in manifest["backends"]:
+                export_onnx(unet, unet_example, fp32_unet_path, dynamic_spatial=True)
+                export_onnx(cnn, cnn_example, fp32_cnn_path)
+                manifest["backends"].append("onnx")
+            quantize_onnx(fp32_unet_path, unet_path)
+            quantize_onnx(fp32_cnn_path, cnn_path)
+        elif backend == "int8_static":
+            slices = calibration_slices if calibration_slices is not None else _synthetic_slices(8)
+            unet_batches, cnn_batches = calibration_data(unet, slices)
+            torch.jit.save(quantize_static_int8(unet, unet_batches), unet_path)
+            torch.jit.save(quantize_static_int8(cnn, cnn_batches), cnn_path)
+        else:
+            continue  # eager / int8_dynamic 无需导出文件
+        if backend not in manifest["backends"]:
+            manifest["backends"].append(backend)
+        logger.info(f"已导出 {backend} 后端: {unet_path}, {cnn_path}")
+
+    with open(os.path.join(export_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+# --- 启动时准备后端 ---
+def _exported_artifacts(backend: str, export_dir: str | None) -> tuple[str, str] | None:
+    """返回与当前模型版本、导出格式一致的导出文件；不存在或已过期时返回 None。"""
+    from predict import get_model_version
+    if backend not in ARTIFACTS or not export_dir:
+        return None
+    manifest = _read_manifest(export_dir)
+    paths = tuple(os.path.join(export_dir, name) for name in ARTIFACTS[backend])
+    up_to_date = (manifest.get("model_version") == get_model_version() and manifest.get("format") == EXPORT_FORMAT
+                  and backend in manifest.get("backends", []))
+    return paths if up_to_date and all(os.path.exists(path) for path in paths) else None
+
+
+def _ensure_artifacts(unet: nn.Module, cnn: nn.Module, backend: str, export_dir: str) -> tuple[str, str]:
+    """返回后端所需的导出文件；文件不存在或与当前模型版本不符时现场导出。"""
+    paths = _exported_artifacts(backend, export_dir)
+    if paths is None:
+        if backend == "int8_static":
+            logger.warning("未找到静态量化模型，使用合成数据校准；建议用真实数据运行 `python engine.py export`。")
+        export_models(unet, cnn, [backend], export_dir)
+        paths = tuple(os.path.join(export_dir, name) for name in ARTIFACTS[backend])
+    return paths
+
+
+def _load_artifacts(backend: str, unet_path: str, cnn_path: str, device: torch.device) -> tuple[nn.Module, nn.Module]:
+    if backend in ("onnx", "onnx_int8"):
+        num_threads = torch.get_num_threads()
+        return OnnxModule(unet_path, num_threads).eval(), OnnxModule(cnn_path, num_threads).eval()
+    if backend == "int8_static":
+        torch.backends.quantized.engine = "x86"
+        return (torch.jit.load(unet_path, map_location=device).eval(),
+                torch.jit.load(cnn_path, map_location=device).eval())
+    # torchscript: 加载冻结的模型后针对当前 CPU 做推理优化 (如 MKLDNN 卷积预打包、Conv-BN 融合)
+    return (torch.jit.optimize_for_inference(torch.jit.load(unet_path, map_location=device).eval()),
+            torch.jit.optimize_for_inference(torch.jit.load(cnn_path, map_location=device).eval()))
+
+
+def load_exported_models(backend: str, export_dir: str | None,
+                         device: torch.device) -> tuple[nn.Module, nn.Module] | None:
+    """
+    直接加载已导出的后端模型 (不需要先加载 fp32 模型，也不导入 torchvision)，用于缩短冷启动时间。
+    没有与当前模型版本一致的导出文件，或后端不支持该设备时返回 None，由调用方走 prepare_models 的完整流程。
+    """
+    paths = _exported_artifacts(backend, export_dir)
+    if paths is None or (backend != "torchscript" and device.type != "cpu"):
+        return None
+    return _load_artifacts(backend, *paths, device)
+
+
+def prepare_models(unet: nn.Module, cnn: nn.Module, backend: str = "eager", export_dir: str | None = None,
+                   channels_last: bool = False) -> tuple[nn.Module, nn.Module]:
+    """将 fp32 eager 模型转换为所选后端，返回 (unet, cnn)，调用方式与原模型一致。"""
+    if backend not in BACKENDS:
+        raise ValueError(f"不支持的推理后端: {backend}. 可选: {', '.join(BACKENDS)}")
+    if backend == "eager":
+        if channels_last:
+            return ChannelsLastModule(unet).eval(), ChannelsLastModule(cnn).eval()
+        return unet, cnn
+
+    device = next(unet.parameters()).device
+    if backend != "torchscript" and device.type != "cpu":
+        raise ValueError(f"推理后端 {backend} 仅支持 CPU。")
+    if backend == "int8_dynamic":
+        return unet, quantize_dynamic_int8(cnn)
+
+    return _load_artifacts(backend, *_ensure_artifacts(unet, cnn, backend, export_dir), device)
+
+
+# --- 一致性检查 ---
+def _dice(a: np.ndarray, b: np.ndarray) -> float:
+    total = a.sum() + b.sum()
+    return 1.0 if total == 0 else float(2 * np.logical_and(a, b).sum() / total)
+
+
+def _nodule_mask(nodules: list[dict], size: tuple[int, int]) -> np.ndarray:
+    import cv2
+    mask = np.zeros((size[1], size[0]), np.uint8)
+    contours = [np.asarray(nodule["contour"], np.int32).reshape(-1, 2) for nodule in nodules]
+    if contours:
+        cv2.drawContours(mask, contours, -1, 1, thickness=-1)
+    return mask.astype(bool)
+
+
+def parity_check(backend: str, slices: list[bytes], export_dir: str, channels_last: bool = False) -> dict:
+    """
+    对比所选后端与 fp32 eager 模型的输出:
+        - unet_dice:  U-Net 二值化掩码的 Dice；
+        - final_dice: 完整流程 (含 CNN 过滤) 最终结节掩码的 Dice；
+        - cnn_agreement: 相同候选 patch 上 CNN 分类结果一致的比例。
+    """
+    import predict
+    fp32_unet, fp32_cnn = predict.load_fp32_models()
+    backend_unet, backend_cnn = prepare_models(fp32_unet, fp32_cnn, backend, export_dir, channels_last)
+
+    unet_dice, final_dice, agree, total = [], [], 0, 0
+    for image_bytes in slices:
+        input_tensor, resized_image_np, original_size = predict.preprocess_image(image_bytes)
+        if input_tensor is None:
+            continue
+        with torch.no_grad():
+            ref_prob = fp32_unet(input_tensor).squeeze().cpu().numpy()
+            test_prob = backend_unet(input_tensor).squeeze().cpu().numpy()
+        unet_dice.append(_dice(ref_prob > predict.UNET_THRESHOLD, test_prob > predict.UNET_THRESHOLD))
+
+        _, candidates = predict._extract_patches_with_watershed(resized_image_np, ref_prob)
+        if candidates:
+            patches = [cand["patch"] for cand in candidates]
+            ref_idx = predict._classify_patches(fp32_cnn, patches)
+            test_idx = predict._classify_patches(backend_cnn, patches)
+            agree += int((ref_idx == test_idx).sum())
+            total += len(patches)
+
+        predict._install_models(fp32_unet, fp32_cnn)
+        ref_nodules = predict.run_prediction(image_bytes)
+        predict._install_models(backend_unet, backend_cnn)
+        test_nodules = predict.run_prediction(image_bytes)
+        final_dice.append(_dice(_nodule_mask(ref_nodules, original_size), _nodule_mask(test_nodules, original_size)))
+
+    return {
+        "backend": backend,
+        "slices": len(unet_dice),
+        "unet_dice_mean": float(np.mean(unet_dice)) if unet_dice else None,
+        "unet_dice_min": float(np.min(unet_dice)) if unet_dice else None,
+        "final_dice_mean": float(np.mean(final_dice)) if final_dice else None,
+        "final_dice_min": float(np.min(final_dice)) if final_dice else None,
+        "cnn_agreement": agree / total if total else None,
+    }
+
+
+def main(argv=None) -> int:
+    import predict
+    parser = argparse.ArgumentParser(description="推理后端导出与一致性检查")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="导出各后端所需的模型文件")
+    export_parser.add_argument("--backends", nargs="+", choices=list(ARTIFACTS), default=list(ARTIFACTS))
+    export_parser.add_argument("--calibration-dir", help="静态量化校准用的切片目录 (默认使用合成切片)")
+    export_parser.add_argument("--calibration-slices", type=int, default=32)
+    export_parser.add_argument("--export-dir", default=predict.EXPORT_DIR)
+    parity_parser = subparsers.add_parser("parity", help="与 fp32 结果对比 Dice")
+    parity_parser.add_argument("--backend", choices=BACKENDS, required=True)
+    parity_parser.add_argument("--channels-last", action="store_true")
+    parity_parser.add_argument("--data-dir", help="用于对比的切片目录 (默认使用合成切片)")
+    parity_parser.add_argument("--slices", type=int, default=16)
+    parity_parser.add_argument("--export-dir", default=predict.EXPORT_DIR)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.command == "export":
+        unet, cnn = predict.load_fp32_models()
+        slices = _read_slices(args.calibration_dir, args.calibration_slices)
+        manifest = export_models(unet, cnn, args.backends, args.export_dir, calibration_slices=slices)
+        print(json.dumps(manifest, indent=2))
+    else:
+        report = parity_check(args.backend, _read_slices(args.data_dir, args.slices), args.export_dir, args.channels_last)
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+上传文件的流式落盘
+
+``UploadFile.read()`` 会把整个上传内容读入内存。这里按块读取上传内容并写入临时文件，同时计算结果缓存键；
+之后 DICOM 头的解析与像素数据的按帧解码都直接从文件读取 (见 predict.preprocess_image)，
+单个请求的内存占用不再随文件大小增长。临时文件以路径传给推理工作线程/进程，请求结束后删除。
+"""
+import os
+import tempfile
+import zipfile
+from typing import Any, BinaryIO, Callable
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 每次读取/写入的块大小 (字节)
+
+
+class SpooledUpload:
+    """已落盘的上传文件 (或 zip 中的一个成员)：原始文件名、临时文件路径、字节数与结果缓存键。"""
+
+    def __init__(self, filename: str, path: str, size: int, key: str):
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.key = key
+
+    def close(self):
+        """删除临时文件。"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _spool_file(spool_dir: str | None):
+    return tempfile.NamedTemporaryFile(prefix="upload-", suffix=".part", dir=spool_dir, delete=False)
+
+
+async def spool_upload(upload, hasher, spool_dir: str | None = None,
+                       chunk_size: int = UPLOAD_CHUNK_SIZE) -> SpooledUpload:
+    """
+    将 FastAPI 的 UploadFile 按块写入临时文件。
+    ``hasher`` 为 hashlib 风格的对象 (见 ResultCache.hasher)，每个块都会送入其中，其最终摘要即为缓存键。
+    """
+    size = 0
+    with _spool_file(spool_dir) as f:
+        try:
+            while chunk := await upload.read(chunk_size):
+                hasher.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    return SpooledUpload(upload.filename, f.name, size, hasher.hexdigest())
+
+
+def spool_stream(filename: str, stream: BinaryIO, hasher, spool_dir: str | None = None,
+                 chunk_size: int = UPLOAD_CHUNK_SIZE) -> SpooledUpload:
+    """将同步的文件对象 (如 zip 成员) 按块写入临时文件，与 spool_upload 相同。"""
+    size = 0
+    with _spool_file(spool_dir) as f:
+        try:
+            while chunk := stream.read(chunk_size):
+                hasher.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    return SpooledUpload(filename, f.name, size, hasher.hexdigest())
+
+
+def expand_archives(uploads: list[SpooledUpload], new_hasher: Callable[[], Any],
+                    spool_dir: str | None = None) -> list[SpooledUpload]:
+    """
+    将上传文件展开为切片文件列表：zip 压缩包中的各个切片被逐个解压到独立的临时文件 (按文件名排序)，
+    其他文件原样保留。压缩包本身的临时文件在解压后删除。无效的 zip 抛出 zipfile.BadZipFile。
+    """
+    slices = []
+    try:
+        for upload in uploads:
+            if not zipfile.is_zipfile(upload.path):
+                slices.append(upload)
+                continue
+            with zipfile.ZipFile(upload.path) as archive:
+                members = [
+                    info for info in archive.infolist()
+                    if not info.is_dir() and not info.filename.startswith("__MACOSX/")
+                ]
+                for info in sorted(members, key=lambda info: info.filename):
+                    with archive.open(info) as member:
+                        slices.append(spool_stream(info.filename, member, new_hasher(), spool_dir))
+            upload.close()
+    except BaseException:
+        for spooled in slices:
+            spooled.close()
+        raise
+    return slices
+
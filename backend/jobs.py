@@ -0,0 +1,349 @@
+"""
+后台分析任务 (Job)
+
+整个检查 (数百张切片) 通过一次请求提交后立即得到 job_id，之后轮询任务状态，
+或以 Server-Sent Events 订阅逐切片的结果 (见 main.py 中的 /api/jobs 端点)；任务可以取消。
+
+- JobStore: 以 SQLite 保存任务状态与每张已完成切片的结果，服务重启后已完成的结果仍可查询。
+  重启时尚未完成的任务被标记为 interrupted (上传的临时文件已不存在，无法继续执行)。
+- JobManager: 进程内的任务调度。排队的任务按优先级 (大者优先，同优先级先到先得) 依次启动，
+  同时运行的任务数与每个任务同时处理的切片数均有上限；切片由调用方以低于交互式请求的优先级
+  提交到推理工作池 (见 worker_pool.py)，因此单张切片的 /api/predict 请求不会排在整个检查之后。
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable
+
+import structured_logging
+from contour_format import json_default
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATES = ("queued", "running")
+TERMINAL_STATES = ("completed", "failed", "cancelled", "interrupted")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    params TEXT NOT NULL,
+    slices TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 0,
+    errors INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS results (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (job_id, idx)
+);
+"""
+_STATUS_COLUMNS = ("job_id", "status", "priority", "params", "total", "completed", "errors", "error",
+                   "created_at", "started_at", "finished_at")
+
+
+class JobQueueFullError(RuntimeError):
+    """排队的任务数已达上限。"""
+
+    def __init__(self, max_queued: int):
+        super().__init__(f"排队的任务数已达上限 ({max_queued})，请稍后重试。")
+        self.max_queued = max_queued
+
+
+class JobStore:
+    """
+    SQLite 任务存储 (线程安全，所有方法都是同步的，由调用方放到线程中执行)。
+
+    - ``path``: 数据库文件路径，":memory:" 表示只保存在内存中 (重启后丢失)。
+    - ``retention_seconds``: 已结束的任务在结束后保留的时长，之后由 purge 删除。
+
+    构造时不访问磁盘，由 open 打开数据库 (服务启动时调用)，因此仅导入 main 不会创建数据库文件。
+    """
+
+    def __init__(self, path: str = ":memory:", retention_seconds: float = 7 * 24 * 3600):
+        self.path = path
+        self.retention_seconds = retention_seconds
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        """打开 (必要时创建) 数据库，并将上次运行中未完成的任务标记为 interrupted；已打开时不做任何事。"""
+        with self._lock:
+            if self._conn is not None:
+                return
+            if self.path != ":memory:" and os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            if self.path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+            interrupted = self._conn.execute(
+                "UPDATE jobs SET status = 'interrupted', error = ?, finished_at = ? WHERE status IN (?, ?)",
+                ("服务重启时任务尚未完成。", time.time(), *ACTIVE_STATES)).rowcount
+        if interrupted:
+            logger.warning(f"{interrupted} 个未完成的任务因服务重启被标记为 interrupted。")
+
+    def create(self, slices: list[dict], params: dict, priority: int = 0) -> dict:
+        """新建排队中的任务并返回其状态；``slices`` 为各切片的描述 (文件名、帧序号)，按处理顺序排列。"""
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, status, priority, params, slices, total, created_at) "
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, priority, json.dumps(params), json.dumps(slices), len(slices), time.time()))
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(_STATUS_COLUMNS)} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        status = dict(row)
+        status["params"] = json.loads(status["params"])
+        return status
+
+    def slices(self, job_id: str) -> list[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT slices FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row["slices"]) if row is not None else []
+
+    def set_status(self, job_id: str, status: str, error: str | None = None):
+        """更新任务状态；进入 running 时记录开始时间，进入结束状态时记录结束时间。"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = COALESCE(?, error), "
+                "started_at = CASE WHEN ? = 'running' THEN ? ELSE started_at END, "
+                "finished_at = CASE WHEN ? IN (?, ?, ?, ?) THEN ? ELSE finished_at END WHERE job_id = ?",
+                (status, error, status, now, status, *TERMINAL_STATES, now, job_id))
+
+    def add_result(self, job_id: str, index: int, result: dict):
+        """保存第 ``index`` 张切片的结果，并更新任务的完成数与出错切片数。"""
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            inserted = self._conn.execute(
+                "INSERT OR IGNORE INTO results (job_id, idx, result) VALUES (?, ?, ?)",
+                (job_id, index,
+                 json.dumps(result, ensure_ascii=False, separators=(",", ":"), default=json_default))).rowcount
+            if inserted:
+                self._conn.execute(
+                    "UPDATE jobs SET completed = completed + 1, errors = errors + ? WHERE job_id = ?",
+                    (1 if result.get("error") else 0, job_id))
+
+    def results(self, job_id: str, start: int = 0, stop: int | None = None) -> list[dict]:
+        """按切片顺序返回序号在 [start, stop) 内的已完成切片结果。"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT result FROM results WHERE job_id = ? AND idx >= ? AND idx < ? ORDER BY idx",
+                (job_id, start, stop if stop is not None else 2 ** 62)).fetchall()
+        return [json.loads(row["result"]) for row in rows]
+
+    def delete(self, job_id: str) -> bool:
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM results WHERE job_id = ?", (job_id,))
+            return self._conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,)).rowcount > 0
+
+    def purge(self) -> int:
+        """删除结束时间早于保留期限的任务及其结果，返回删除的任务数。"""
+        deadline = time.time() - self.retention_seconds
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "DELETE FROM results WHERE job_id IN (SELECT job_id FROM jobs WHERE finished_at < ?)", (deadline,))
+            return self._conn.execute("DELETE FROM jobs WHERE finished_at < ?", (deadline,)).rowcount
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class _ActiveJob:
+    """排队或运行中的任务：待处理的切片、任务结束时的清理函数与事件订阅者。"""
+
+    def __init__(self, job_id: str, items: list, params: dict, cleanup: Callable[[], Any] | None):
+        self.job_id = job_id
+        self.items = items
+        self.params = params
+        self.cleanup = cleanup
+        self.task: asyncio.Task | None = None
+        self.cancel_requested = False
+        self.subscribers: set[asyncio.Queue] = set()
+
+
+class JobManager:
+    """
+    进程内的任务调度器。
+
+    - ``store``: 保存任务状态与结果的 JobStore。
+    - ``process_slice``: 协程函数 ``process_slice(item, params) -> dict``，处理一张切片并返回其结果
+      (切片级的错误放在结果的 ``error`` 字段中，抛出的异常会使整个任务失败)。
+    - ``max_running``: 同时运行的任务数。
+    - ``slice_concurrency``: 每个任务同时处理的切片数 (不小于 U-Net 微批大小时切片能合并为批量前向)。
+    - ``max_queued``: 排队任务数上限，超出时 submit 抛出 JobQueueFullError。
+    """
+
+    def __init__(self, store: JobStore, process_slice: Callable[[Any, dict], Awaitable[dict]],
+                 max_running: int = 1, slice_concurrency: int = 8, max_queued: int = 32):
+        self.store = store
+        self.process_slice = process_slice
+        self.max_running = max_running
+        self.slice_concurrency = slice_concurrency
+        self.max_queued = max_queued
+        self._jobs: dict[str, _ActiveJob] = {}
+        self._pending: list[tuple[int, int, str]] = []  # (-优先级, 序号, job_id) 组成的堆
+        self._sequence = itertools.count()
+        self._running: set[str] = set()
+        self._accepting = False
+
+    @property
+    def queued(self) -> int:
+        return len(self._jobs) - len(self._running)
+
+    @property
+    def running(self) -> int:
+        return len(self._running)
+
+    def submit(self, slices: list[dict], items: list, params: dict, priority: int = 0,
+               cleanup: Callable[[], Any] | None = None) -> dict:
+        """
+        提交任务并返回其状态。``slices`` 为保存到 JobStore 的切片描述，``items`` 为逐个传给 process_slice 的切片，
+        ``cleanup`` 在任务结束 (完成、失败或取消) 后调用，用于删除上传的临时文件。
+        """
+        if self.queued >= self.max_queued:
+            raise JobQueueFullError(self.max_queued)
+        status = self.store.create(slices, params, priority)
+        job_id = status["job_id"]
+        self._jobs[job_id] = _ActiveJob(job_id, items, params, cleanup)
+        heapq.heappush(self._pending, (-priority, next(self._sequence), job_id))
+        self._dispatch()
+        return status
+
+    def start(self):
+        """开始执行排队的任务 (模型就绪后调用；之前提交的任务保持排队)。"""
+        self._accepting = True
+        self._dispatch()
+
+    async def stop(self):
+        """服务关闭时调用：取消运行中的任务，未完成的任务均标记为 interrupted。"""
+        self._accepting = False
+        tasks = [job.task for job in self._jobs.values() if job.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for job in list(self._jobs.values()):
+            self._finish(job, "interrupted", "服务关闭时任务尚未完成。")
+
+    async def cancel(self, job_id: str) -> bool:
+        """取消排队或运行中的任务并等待其停止；任务不存在或已结束时返回 False。"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return False
+        job.cancel_requested = True
+        if job.task is None:
+            self._finish(job, "cancelled")
+        else:
+            job.task.cancel()
+            await asyncio.wait([job.task])
+        return True
+
+    def subscribe(self, job_id: str) -> asyncio.Queue | None:
+        """订阅任务事件 ({"event": "slice" | "status", "data": ...})；任务已结束 (或不存在) 时返回 None。"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        queue = asyncio.Queue()
+        job.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job.subscribers.discard(queue)
+
+    def stats(self) -> dict:
+        return {"queued": self.queued, "running": self.running, "max_running": self.max_running,
+                "max_queued": self.max_queued}
+
+    # --- 内部方法 ---
+    def _dispatch(self):
+        while self._accepting and self._pending and len(self._running) < self.max_running:
+            _, _, job_id = heapq.heappop(self._pending)
+            job = self._jobs.get(job_id)
+            if job is None:  # 排队时已被取消
+                continue
+            self._running.add(job_id)
+            # 任务不继承触发调度的请求的日志上下文，其日志以 job_id 关联
+            job.task = asyncio.create_task(self._run(job), context=contextvars.Context())
+
+    def _publish(self, job: _ActiveJob, event: str, data: dict):
+        for queue in job.subscribers:
+            queue.put_nowait({"event": event, "data": data})
+
+    def _finish(self, job: _ActiveJob, status: str, error: str | None = None):
+        """记录结束状态、通知订阅者并清理；之后任务只存在于 JobStore 中。"""
+        if self._jobs.pop(job.job_id, None) is None:
+            return
+        self._running.discard(job.job_id)
+        self.store.set_status(job.job_id, status, error)
+        self._publish(job, "status", self.store.get(job.job_id))
+        if job.cleanup is not None:
+            try:
+                job.cleanup()
+            except Exception as e:
+                logger.warning(f"任务 {job.job_id} 清理临时文件失败: {e}")
+        logger.info(f"任务 {job.job_id} 结束: {status}。")
+        self._dispatch()
+
+    async def _run(self, job: _ActiveJob):
+        structured_logging.bind(job_id=job.job_id)
+        pending = iter(enumerate(job.items))
+
+        async def worker():
+            # 各 worker 从同一个迭代器中按顺序取切片，保证结果大致按切片顺序产生
+            for index, item in pending:
+                result = {"index": index, **await self.process_slice(item, job.params)}
+                await asyncio.to_thread(self.store.add_result, job.job_id, index, result)
+                self._publish(job, "slice", result)
+
+        try:
+            await asyncio.to_thread(self.store.set_status, job.job_id, "running")
+            self._publish(job, "status", await asyncio.to_thread(self.store.get, job.job_id))
+            workers = [asyncio.create_task(worker()) for _ in range(max(1, min(self.slice_concurrency, len(job.items))))]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                # 某个 worker 失败或任务被取消时，先停止其余 worker 并等待其退出，再清理任务 (删除上传的临时文件等)
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+        except asyncio.CancelledError:
+            if job.cancel_requested:
+                self._finish(job, "cancelled")
+            # 服务关闭时由 stop 标记为 interrupted
+            return
+        except Exception as e:
+            logger.error(f"任务 {job.job_id} 失败: {e}", exc_info=True)
+            self._finish(job, "failed", str(e))
+            return
+        self._finish(job, "completed")
@@ -0,0 +1,52 @@
+"""
+经典方法的肺野掩码 (不依赖模型)
+
+输入为预处理后的肺窗归一化图像 (0 对应 WINDOW_LEVEL - WINDOW_WIDTH / 2 HU，1 对应 WINDOW_LEVEL + WINDOW_WIDTH / 2 HU)，
+阈值以 HU 给出并换算到归一化值。体外空气与肺内空气都低于阈值，去掉与图像边界相连的空气即为肺野；
+再经闭运算、填洞与膨胀，把肺内的血管、结节以及贴近胸膜的结节包含进来。
+掩码在缩小后的图像上计算 (每张切片数毫秒)，只用于跳过明显不含肺的区域，宁大勿小。
+"""
+import cv2
+import numpy as np
+from scipy import ndimage
+
+from predict import WINDOW_LEVEL, WINDOW_WIDTH
+
+# --- 配置 ---
+LUNG_AIR_HU = -400          # 低于该值视为空气或肺实质
+LUNG_MASK_MAX_SIDE = 256    # 在长边缩小到该尺寸的图像上计算掩码
+LUNG_MASK_MARGIN = 0.03     # 闭运算与膨胀的半径 (相对图像长边)
+LUNG_MIN_COMPONENT = 0.002  # 面积小于图像面积该比例的空气区域视为噪声
+
+
+def hu_to_normalized(hu: float) -> float:
+    """将 HU 值换算为肺窗归一化后的数值。"""
+    return (hu - (WINDOW_LEVEL - WINDOW_WIDTH / 2)) / WINDOW_WIDTH
+
+
+def lung_mask(image: np.ndarray) -> np.ndarray:
+    """返回与 ``image`` 同尺寸的布尔肺野掩码。"""
+    height, width = image.shape
+    scale = min(1.0, LUNG_MASK_MAX_SIDE / max(height, width))
+    if scale < 1.0:
+        small = cv2.resize(np.asarray(image, dtype=np.float32), (max(1, round(width * scale)), max(1, round(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+    else:
+        small = image
+
+    air = (small < hu_to_normalized(LUNG_AIR_HU)).astype(np.uint8)
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(air, connectivity=4)
+    keep = stats[:, cv2.CC_STAT_AREA] >= LUNG_MIN_COMPONENT * air.size
+    keep[0] = False  # 非空气
+    keep[np.unique(np.concatenate((labels[0], labels[-1], labels[:, 0], labels[:, -1])))] = False  # 体外空气
+    mask = keep[labels].astype(np.uint8)
+
+    radius = max(1, round(LUNG_MASK_MARGIN * max(small.shape)))
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    mask = ndimage.binary_fill_holes(mask).astype(np.uint8)
+    mask = cv2.dilate(mask, kernel)
+
+    if scale < 1.0:
+        mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+    return mask.astype(bool)
@@ -1,20 +1,226 @@
 """
 Backend server using FastAPI to serve the lung nodule detection model.
 """
+import asyncio
+import json
 import logging
-import uvicorn
-from typing import List
+import os
+import time
+import uuid
+import zipfile
+from typing import Dict, List, Optional
 
-from fastapi import FastAPI, File, UploadFile, HTTPException
+_IMPORT_START = time.perf_counter()  # 开始导入依赖的时刻，用于统计冷启动到就绪的耗时
+import uvicorn
+import torch.multiprocessing
+from fastapi import Depends, FastAPI, File, UploadFile, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
 
-from predict import run_prediction, get_models
+from batching import MicroBatcher
+from contour_format import negotiate_format, render
+from ingest import SpooledUpload, expand_archives, spool_upload
+from jobs import TERMINAL_STATES, JobManager, JobQueueFullError, JobStore
+from volume import VOLUME_LINK_MIN_OVERLAP, assemble_volume, slice_positions, sort_order
+from metrics import Counter, Gauge, Histogram, render_metrics, run_profiled, stage_timer
+from patch_cache import SeriesHitStats
+from result_cache import ResultCache
+from series_store import SeriesStore
+from structured_logging import configure_logging, dropped_records, reset, start_request
+from worker_pool import PRIORITY_BULK, PRIORITY_INTERACTIVE, InferencePool, PoolSaturatedError
+from predict import (
+    run_prediction, get_models, preprocess_slice, run_unet_batch, postprocess_prediction,
+    share_models, init_worker_process, pipeline_signature, count_frames, extract_candidates, postprocess_params,
+    image_to_tensor, sweep_combinations, sweep_postprocess, configure_runtime, warm_up, patch_cache_stats,
+    CNN_BATCH_SIZE, PATCH_CACHE_MAX_SERIES,
+)
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_START
 
 # --- 日志配置 ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")                          # 根 logger 的级别
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")                        # "json" (每行一条 JSON 记录) 或 "text"
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))        # 记录 INFO 及以下日志的请求比例 (WARNING 及以上总是记录)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))          # 日志队列长度，队列满时丢弃新记录
+configure_logging(LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_RATE, LOG_QUEUE_SIZE)
 logger = logging.getLogger(__name__)
 
+# --- 服务配置 (可通过环境变量调整) ---
+UNET_MAX_BATCH_SIZE = int(os.getenv("UNET_MAX_BATCH_SIZE", "8"))      # 单次 U-Net 前向最多合并的切片数
+UNET_MAX_WAIT_MS = float(os.getenv("UNET_MAX_WAIT_MS", "10"))         # 凑批的最长等待时间 (毫秒)
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "2"))          # 推理工作线程/进程数
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "16"))   # 等待队列长度，超出后返回 503
+INFERENCE_POOL_MODE = os.getenv("INFERENCE_POOL_MODE", "thread")      # "thread" 或 "process"
+RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", "2"))      # 503 响应中的 Retry-After
+# 进程模式下每个工作进程的 torch 线程数，默认按 CPU 核心数平均分配，避免超额订阅
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1024"))  # 内存结果缓存条目上限，0 表示禁用
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "256"))              # 内存结果缓存容量上限 (MB)
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")                            # 磁盘结果缓存目录，为空表示不启用
+RESULT_CACHE_DISK_MAX_MB = int(os.getenv("RESULT_CACHE_DISK_MAX_MB", "2048"))   # 磁盘结果缓存容量上限 (MB)
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or None                      # 上传文件落盘目录，默认系统临时目录
+SERIES_STORE_MAX_MB = int(os.getenv("SERIES_STORE_MAX_MB", "512"))              # 序列会话数组的内存上限 (MB)，超出部分溢出到磁盘
+SERIES_STORE_DIR = os.getenv("SERIES_STORE_DIR") or None                       # 溢出文件目录，默认系统临时目录
+SERIES_MAX_COUNT = int(os.getenv("SERIES_MAX_COUNT", "32"))                    # 同时保留的序列会话数
+SERIES_TTL_SECONDS = int(os.getenv("SERIES_TTL_SECONDS", "3600"))              # 会话空闲多久后删除 (秒)
+SWEEP_MAX_COMBINATIONS = int(os.getenv("SWEEP_MAX_COMBINATIONS", "256"))        # 阈值扫描单次请求的参数组合数上限
+MODEL_LOAD_IN_BACKGROUND = os.getenv("MODEL_LOAD_IN_BACKGROUND", "1") == "1"   # 后台加载模型，服务立即开始监听 (就绪前预测请求返回 503)
+WARMUP_ENABLED = os.getenv("WARMUP", "1") == "1"                               # 就绪前以合成输入预热两个模型
+WARMUP_UNET_BATCH_SIZES = os.getenv("WARMUP_UNET_BATCH_SIZES", "")              # 预热的 U-Net 批大小 (逗号分隔)，默认 1..UNET_MAX_BATCH_SIZE
+WARMUP_CNN_BATCH_SIZES = os.getenv("WARMUP_CNN_BATCH_SIZES", "")                # 预热的 CNN 批大小 (逗号分隔)，默认 1..CNN_BATCH_SIZE
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH") or ":memory:"                  # 任务数据库 (SQLite) 文件，默认不持久化 (重启后丢失)
+JOB_RETENTION_HOURS = float(os.getenv("JOB_RETENTION_HOURS", "168"))           # 已结束的任务保留多久 (小时)
+JOB_MAX_RUNNING = int(os.getenv("JOB_MAX_RUNNING", "1"))                        # 同时运行的任务数
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "32"))                         # 排队任务数上限，超出后返回 503
+JOB_SLICE_CONCURRENCY = int(os.getenv("JOB_SLICE_CONCURRENCY", str(UNET_MAX_BATCH_SIZE)))  # 每个任务同时处理的切片数
+JOB_EVENT_KEEPALIVE_SECONDS = 15  # 事件流在没有事件时发送注释行的间隔，避免代理断开空闲连接
+TORCH_THREADS_PER_WORKER = int(os.getenv("TORCH_THREADS_PER_WORKER", str(max(1, (os.cpu_count() or 1) // INFERENCE_WORKERS))))
+
+
+# --- 指标 (通过 /metrics 以 Prometheus 文本格式导出) ---
+STAGE_LATENCY = Histogram("lung_cad_stage_seconds", "Latency of each inference stage in seconds.", labelnames=("stage",))
+REQUEST_LATENCY = Histogram("lung_cad_request_seconds", "End-to-end prediction latency in seconds, including queueing.",
+                            labelnames=("endpoint",))
+CANDIDATE_COUNT = Histogram("lung_cad_candidates", "Watershed candidate regions per slice.",
+                            buckets=(0, 1, 2, 5, 10, 20, 40, 80, 160))
+TRUE_POSITIVE_COUNT = Histogram("lung_cad_true_positives", "Candidates classified as nodules per slice.",
+                                buckets=(0, 1, 2, 5, 10, 20, 40))
+REQUEST_BYTES = Histogram("lung_cad_request_bytes", "Size of uploaded files in bytes.", labelnames=("endpoint",),
+                          buckets=(64e3, 256e3, 512e3, 1e6, 2e6, 5e6, 10e6, 50e6, 100e6))
+UNET_BATCH_SIZE = Histogram("lung_cad_unet_batch_size", "Slices per micro-batched U-Net forward.",
+                            buckets=(1, 2, 4, 8, 16, 32, 64))
+REQUESTS = Counter("lung_cad_requests_total", "Prediction requests by endpoint and outcome.", labelnames=("endpoint", "status"))
+MODEL_LOAD_SECONDS = Gauge("lung_cad_model_load_seconds", "Time spent loading both models at startup.")
+WARMUP_SECONDS = Gauge("lung_cad_warmup_seconds", "Time spent warming up the models before reporting ready.")
+TIME_TO_READY_SECONDS = Gauge("lung_cad_time_to_ready_seconds",
+                              "Time from importing the server module until it reported ready.")
+LUNG_GATE_SLICES = Counter("lung_cad_lung_gate_slices_total", "Slices seen by the lung-field gate by outcome.",
+                           labelnames=("outcome",))
+PATCH_CACHE_LOOKUPS = Counter("lung_cad_patch_cache_lookups_total",
+                              "Candidate patches served from the patch logits cache (hit) or classified by the CNN (miss).",
+                              labelnames=("outcome",))
+LUNG_GATE_PIXELS = Counter("lung_cad_lung_gate_pixels_total", "Pixels seen by the lung-field gate and pixels not passed to the U-Net.",
+                           labelnames=("kind",))
+
+
+def _record_profile(profile: dict, fields: Optional[dict] = None):
+    """
+    将一次推理的 profile (阶段耗时与候选统计) 记录到指标中。
+    给出 ``fields`` 时同时把阶段耗时 (毫秒)、切片 UID、候选数与真阳性数合并进去，供 _log_slice 输出。
+    """
+    stages = profile.get("stages", {})
+    for stage, seconds in stages.items():
+        STAGE_LATENCY.observe(seconds, stage=stage)
+    if "candidates" in profile:
+        CANDIDATE_COUNT.observe(profile["candidates"])
+        TRUE_POSITIVE_COUNT.observe(profile["true_positives"])
+    gate = profile.get("lung_gate")
+    outcome = None
+    if gate is not None:
+        outcome = "skipped" if gate["skipped"] else "cropped" if gate["pixels_skipped"] else "full"
+        LUNG_GATE_SLICES.inc(outcome=outcome)
+        LUNG_GATE_PIXELS.inc(gate["pixels"], kind="total")
+        LUNG_GATE_PIXELS.inc(gate["pixels_skipped"], kind="skipped")
+    if "patch_cache_hits" in profile:
+        PATCH_CACHE_LOOKUPS.inc(profile["patch_cache_hits"], outcome="hit")
+        PATCH_CACHE_LOOKUPS.inc(profile["patch_cache_misses"], outcome="miss")
+        patch_cache_hits.record(profile["series_uid"], profile["patch_cache_hits"], profile["patch_cache_misses"])
+    if fields is None:
+        return
+    fields.setdefault("stages_ms", {}).update((stage, round(seconds * 1000, 2)) for stage, seconds in stages.items())
+    for key in ("slice_uid", "series_uid", "candidates", "true_positives", "patch_cache_hits", "patch_cache_misses"):
+        if key in profile:
+            fields[key] = profile[key]
+    if outcome is not None:
+        fields["lung_gate"] = outcome
+
+
+# patch 缓存 (见 patch_cache.py) 按序列的命中统计；命中数随 profile 返回，进程模式下同样完整
+patch_cache_hits = SeriesHitStats(PATCH_CACHE_MAX_SERIES)
+
+
+def _log_slice(fields: dict, nodules: list, cached: bool = False):
+    """每张切片输出一条结构化日志记录 (文件名、帧、结节数、是否命中缓存以及 _record_profile 合并的字段)。"""
+    logger.info("切片预测完成", extra={"fields": {**fields, "nodules": len(nodules), "cached": cached}})
+
+
+def _accumulate_gate_stats(stats: dict, profile: dict):
+    """将单张切片的肺野门控结果累加到整个序列的统计中。"""
+    gate = profile.get("lung_gate")
+    if gate is None:
+        return
+    stats["slices"] += 1
+    stats["slices_skipped"] += int(gate["skipped"])
+    stats["pixels"] += gate["pixels"]
+    stats["pixels_skipped"] += gate["pixels_skipped"]
+
+
+def _new_gate_stats() -> dict:
+    return {"slices": 0, "slices_skipped": 0, "pixels": 0, "pixels_skipped": 0}
+
+
+async def _run_unet_batch_pooled(items, priority: int):
+    """
+    微批处理器的批处理函数，``items`` 为 (输入张量, 肺野区域)。批量 U-Net 前向与其他推理任务一样在有界的
+    推理工作池中执行 (进程模式下即在工作进程中，受其线程数限制)，主进程不另外占用 CPU；记录耗时与批大小。
+    """
+    probs, profile = await inference_pool.run(
+        run_profiled, run_unet_batch, [tensor for tensor, _ in items], [roi for _, roi in items],
+        wait=True, priority=priority)
+    _record_profile(profile)
+    UNET_BATCH_SIZE.observe(len(items))
+    return probs
+
+
+def _warmup_batch_sizes(value: str, largest: int) -> list[int]:
+    """解析逗号分隔的批大小列表；为空时返回服务会用到的全部批大小 1..largest。"""
+    if not value.strip():
+        return list(range(1, largest + 1))
+    return sorted({int(size) for size in value.split(",") if size.strip()})
+
+
+# --- 推理调度 ---
+# 跨请求合并切片的 U-Net 微批处理器
+unet_batcher = MicroBatcher(_run_unet_batch_pooled, max_batch_size=UNET_MAX_BATCH_SIZE, max_wait_ms=UNET_MAX_WAIT_MS)
+
+# 以文件内容哈希为键的预测结果缓存
+result_cache = ResultCache(
+    max_entries=RESULT_CACHE_MAX_ENTRIES,
+    max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024,
+    disk_dir=RESULT_CACHE_DIR,
+    disk_max_bytes=RESULT_CACHE_DISK_MAX_MB * 1024 * 1024,
+)
+
+# 序列会话: 上传一次，按切片/范围多次预测
+series_store = SeriesStore(
+    max_bytes=SERIES_STORE_MAX_MB * 1024 * 1024,
+    max_series=SERIES_MAX_COUNT,
+    ttl_seconds=SERIES_TTL_SECONDS,
+    spill_dir=SERIES_STORE_DIR,
+)
+
+# 执行推理的有界工作池，避免阻塞事件循环
+# spawn 避免在已初始化 OpenMP 线程池的进程中 fork；torch.multiprocessing 以共享内存句柄传递模型权重
+mp_context = torch.multiprocessing.get_context("spawn") if INFERENCE_POOL_MODE == "process" else None
+inference_pool = InferencePool(
+    max_workers=INFERENCE_WORKERS,
+    max_queue=INFERENCE_QUEUE_SIZE,
+    mode=INFERENCE_POOL_MODE,
+    retry_after=RETRY_AFTER_SECONDS,
+    initializer=init_worker_process if INFERENCE_POOL_MODE == "process" else None,
+    mp_context=mp_context,
+)
+
+Gauge("lung_cad_inference_in_flight", "Inference tasks currently executing.", callback=lambda: inference_pool.in_flight)
+Gauge("lung_cad_inference_queued", "Inference tasks waiting for a worker.", callback=lambda: inference_pool.queued)
+Gauge("lung_cad_inference_rejected", "Requests rejected with 503 since startup.", callback=lambda: inference_pool.rejected)
+Gauge("lung_cad_result_cache_hits", "Result cache hits (memory and disk) since startup.",
+      callback=lambda: result_cache.hits + result_cache.disk_hits)
+Gauge("lung_cad_result_cache_misses", "Result cache misses since startup.", callback=lambda: result_cache.misses)
+Gauge("lung_cad_log_dropped", "Log records dropped because the log queue was full.", callback=dropped_records)
+Gauge("lung_cad_series_store_series", "Series sessions currently held.", callback=lambda: series_store.stats()["series"])
+Gauge("lung_cad_series_store_bytes", "Bytes of series session arrays held in memory (excluding spilled arrays).",
+      callback=lambda: series_store.stats()["bytes"])
+
 
 # --- FastAPI 应用初始化 ---
 app = FastAPI(
@@ -23,6 +229,38 @@ app = FastAPI(
     version="1.0.0",
 )
 
+# --- 就绪状态 (见 /api/ready) ---
+readiness = {"ready": False, "error": None, "time_to_ready_seconds": None, "stages": {}, "runtime": None, "warmup": None}
+
+
+@app.middleware("http")
+async def readiness_gate(request: Request, call_next):
+    """模型就绪前 (后台加载中或加载失败) 预测与序列会话请求直接返回 503，由客户端按 Retry-After 重试。"""
+    if not readiness["ready"] and request.url.path.startswith(("/api/predict", "/api/series")):
+        detail = f"Model loading failed: {readiness['error']}" if readiness["error"] else "Models are still loading."
+        return JSONResponse(status_code=503, content={"detail": detail},
+                            headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+    """
+    为每个请求绑定 request_id (沿用客户端的 X-Request-ID，否则生成) 并做出日志采样决定；
+    该请求处理过程中的所有日志都带有此 request_id，响应头中返回同一 ID。
+    """
+    request_id = request.headers.get("X-Request-ID", "")
+    if not request_id or len(request_id) > 128:
+        request_id = uuid.uuid4().hex[:16]
+    token = start_request(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+
 # --- CORS 跨域设置 ---
 # 允许指定的来源进行跨域请求。
 origins = [
@@ -42,17 +280,99 @@ app.add_middleware(
 )
 
 # --- 应用启动事件 ---
-@app.on_event("startup")
-async def startup_event():
-    """在应用启动时预加载模型。"""
+async def _warm_up(profile: dict, report_queue=None) -> dict:
+    """
+    在所有会执行推理的地方预热 (全部 U-Net 微批大小与 CNN 批大小)：线程模式下推理在主进程中执行；
+    进程模式下各工作进程在初始化时预热，主进程不执行推理，这里为每个工作进程提交一个空任务使其全部启动，
+    再从 ``report_queue`` 收集每个工作进程的预热结果，确保就绪前所有工作进程都已完成预热。
+    """
+    unet_sizes = _warmup_batch_sizes(WARMUP_UNET_BATCH_SIZES, UNET_MAX_BATCH_SIZE)
+    cnn_sizes = _warmup_batch_sizes(WARMUP_CNN_BATCH_SIZES, CNN_BATCH_SIZE)
+    with stage_timer(profile, "warmup"):
+        warmup = {"main": {}}
+        if INFERENCE_POOL_MODE != "process":
+            warmup["main"] = await asyncio.to_thread(warm_up, unet_sizes, cnn_sizes)
+        if report_queue is not None:
+            await asyncio.gather(*(inference_pool.run(os.getpid, wait=True) for _ in range(INFERENCE_WORKERS)))
+            warmup["workers"] = [await asyncio.to_thread(report_queue.get) for _ in range(INFERENCE_WORKERS)]
+    for model, timings in warmup["main"].items():
+        if timings:
+            logger.info("预热完成。", extra={"fields": {"model": model, "batch_sizes": len(timings),
+                                                     "seconds": round(sum(map(sum, timings.values())), 2)}})
+    return warmup
+
+
+async def _load_models_and_start():
+    """加载模型 (两个模型并行加载)、启动推理工作池并预热，完成后服务进入就绪状态，记录各阶段耗时。"""
     logger.info("正在预加载模型...")
+    profile = {"stages": {"imports": _IMPORT_SECONDS}}
     try:
-        get_models()  # 调用模型加载函数
+        # 固定主进程的线程池与内存分配器设置 (工作进程在其初始化函数中设置)
+        readiness["runtime"] = configure_runtime()
+        load_start = time.perf_counter()
+        unet_model, cnn_model = await asyncio.to_thread(get_models, profile)  # 调用模型加载函数
+        MODEL_LOAD_SECONDS.set(time.perf_counter() - load_start)
+        if unet_model is None or cnn_model is None:
+            raise RuntimeError("模型未加载，请检查权重文件。")
         logger.info("模型预加载成功！")
+        report_queue = None
+        with stage_timer(profile, "pool_start"):
+            if INFERENCE_POOL_MODE == "process":
+                # 权重只在主进程加载一次，工作进程通过共享内存直接使用
+                unet_model, cnn_model = share_models()
+                warmup_sizes = None
+                if WARMUP_ENABLED:
+                    warmup_sizes = (_warmup_batch_sizes(WARMUP_UNET_BATCH_SIZES, UNET_MAX_BATCH_SIZE),
+                                    _warmup_batch_sizes(WARMUP_CNN_BATCH_SIZES, CNN_BATCH_SIZE))
+                    report_queue = mp_context.Queue()
+                log_config = {"level": LOG_LEVEL, "fmt": LOG_FORMAT, "sample_rate": LOG_SAMPLE_RATE,
+                              "queue_size": LOG_QUEUE_SIZE}
+                inference_pool.start(initargs=(unet_model, cnn_model, TORCH_THREADS_PER_WORKER, warmup_sizes,
+                                               report_queue, log_config))
+            else:
+                inference_pool.start()
+        if WARMUP_ENABLED:
+            readiness["warmup"] = await _warm_up(profile, report_queue)
+            WARMUP_SECONDS.set(profile["stages"]["warmup"])
     except Exception as e:
-        logger.error(f"模型预加载失败: {e}", exc_info=True)
-        # 在启动失败时，最好让应用挂掉，以便容器或进程管理器可以重启它
-        raise e
+        readiness["error"] = str(e)
+        logger.error("模型预加载失败。", exc_info=True, extra={"fields": {"error": str(e)}})
+        raise
+    time_to_ready = time.perf_counter() - _IMPORT_START
+    readiness.update(ready=True, time_to_ready_seconds=time_to_ready, stages=profile["stages"])
+    job_manager.start()  # 就绪前提交的分析任务保持排队，此时开始执行
+    TIME_TO_READY_SECONDS.set(time_to_ready)
+    logger.info("服务已就绪。", extra={"fields": {
+        "time_to_ready_seconds": round(time_to_ready, 2),
+        "stages": {stage: round(seconds, 2) for stage, seconds in profile["stages"].items()},
+    }})
+
+
+@app.on_event("startup")
+async def startup_event():
+    """
+    在应用启动时预加载模型。默认在后台加载，服务立即开始监听，就绪与否由 /api/ready 报告；
+    MODEL_LOAD_IN_BACKGROUND=0 时在启动阶段阻塞直到加载完成，加载失败时让应用退出，以便容器或进程管理器重启它。
+    """
+    unet_batcher.start()
+    await asyncio.to_thread(job_store.open)
+    if MODEL_LOAD_IN_BACKGROUND:
+        task = asyncio.create_task(_load_models_and_start())
+        # 保存引用避免任务被回收；失败已记录在 readiness 中，这里只取出异常
+        app.state.model_load_task = task
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+    else:
+        await _load_models_and_start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """在应用关闭时停止后台任务 (未完成的分析任务标记为 interrupted) 并关闭任务数据库，删除序列会话的溢出文件。"""
+    await job_manager.stop()
+    job_store.close()
+    await unet_batcher.stop()
+    inference_pool.shutdown()
+    series_store.clear()
 
 
 # --- API 数据模型 (Pydantic) ---
@@ -66,6 +386,95 @@ class Nodule(BaseModel):
 
 class NoduleDetectResponse(BaseModel):
     nodules: List[Nodule]
+    timings: Optional[Dict[str, float]] = None  # 仅 debug 模式返回：各阶段耗时 (毫秒)
+
+class SliceDetectResult(BaseModel):
+    filename: str
+    frame: Optional[int] = None  # 仅多帧 DICOM：帧序号
+    nodules: List[Nodule]
+    error: Optional[str] = None
+
+class LungGateStats(BaseModel):
+    slices: int          # 经过肺野门控的切片数 (不含命中结果缓存的切片)
+    slices_skipped: int  # 跳过 U-Net 的切片数
+    pixels: int
+    pixels_skipped: int  # 未送入 U-Net 的像素数 (跳过的切片与裁剪掉的区域)
+
+class BatchDetectResponse(BaseModel):
+    slices: List[SliceDetectResult]
+    lung_gate: LungGateStats
+
+class VolumeNodule(BaseModel):
+    id: int
+    slice_start: int  # 首个/最后一个出现该结节的切片在 slices 中的序号
+    slice_end: int
+    num_slices: int
+
+class VolumeDetectResponse(BaseModel):
+    nodules: List[VolumeNodule]
+    slices: List[SliceDetectResult]  # 按切片位置排序
+    lung_gate: LungGateStats
+
+class SeriesSlice(BaseModel):
+    index: int  # 会话中的切片序号 (按切片位置排序)
+    filename: str
+    frame: Optional[int] = None
+    error: Optional[str] = None  # 解码或预处理失败的原因
+
+class SeriesInfo(BaseModel):
+    series_id: str
+    slices: List[SeriesSlice]
+    ttl_seconds: int  # 会话空闲超过该时间后被删除
+
+class SeriesSliceResult(SliceDetectResult):
+    index: int
+
+class SeriesDetectResponse(BaseModel):
+    series_id: str
+    slices: List[SeriesSliceResult]
+
+class PostprocessParams(BaseModel):
+    unet_threshold: float
+    min_distance: int
+    patch_size: int
+    min_contour_area: float
+    min_contour_points: int
+
+class SweepCombination(BaseModel):
+    params: PostprocessParams
+    nodules: List[Nodule]
+
+class SweepResponse(BaseModel):
+    combinations: List[SweepCombination]  # 按参数顺序展开的笛卡尔积
+
+class SeriesSweepCombination(BaseModel):
+    params: PostprocessParams
+    slices: List[SeriesSliceResult]
+
+class SeriesSweepResponse(BaseModel):
+    series_id: str
+    combinations: List[SeriesSweepCombination]
+
+class JobStatus(BaseModel):
+    job_id: str
+    status: str  # queued / running / completed / failed / cancelled / interrupted
+    priority: int
+    params: PostprocessParams
+    total: int      # 切片总数
+    completed: int  # 已完成的切片数 (含出错的切片)
+    errors: int     # 出错的切片数
+    error: Optional[str] = None  # 任务失败或中断的原因
+    created_at: float  # Unix 时间戳 (秒)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+class JobSliceResult(SliceDetectResult):
+    index: int  # 切片在任务中的序号 (按切片位置排序)
+
+class JobResultsResponse(BaseModel):
+    job_id: str
+    status: str
+    slices: List[JobSliceResult]  # 已完成的切片，按序号排列
 
 
 # --- API 端点 ---
@@ -75,27 +484,795 @@ def read_root():
     return {"status": "healthy", "message": "Lung Nodule Detection API is running."}
 
 
-@app.post("/api/predict", response_model=NoduleDetectResponse)
-async def predict_endpoint(file: UploadFile = File(...)):
+@app.get("/api/ready")
+def ready_endpoint():
+    """
+    就绪探针 (与只表示进程存活的 / 分开)：模型加载完成且推理工作池已启动时返回 200，否则返回 503。
+    响应中给出冷启动到就绪的总耗时与各阶段耗时 (秒)。
+    """
+    return JSONResponse(status_code=200 if readiness["ready"] else 503, content=readiness)
+
+
+@app.get("/api/status")
+def status_endpoint():
+    """
+    返回推理工作池的当前负载 (排队数、执行中任务数等)、结果缓存的命中情况、序列会话的内存占用、分析任务的排队情况
+    以及 patch 缓存按序列的命中率，用于容量规划。
+    """
+    return {"inference_pool": inference_pool.stats(), "result_cache": result_cache.stats(),
+            "series_store": series_store.stats(), "jobs": job_manager.stats(),
+            "patch_cache": {**patch_cache_stats(), "hits_by_series": patch_cache_hits.stats()}}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_endpoint():
+    """以 Prometheus 文本格式导出各阶段延迟直方图、候选数分布、请求大小、模型加载时间等指标。"""
+    return render_metrics()
+
+
+def _service_unavailable(e: PoolSaturatedError) -> HTTPException:
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+
+def _response_format(request: Request, response_format: Optional[str]) -> str:
+    """由 ``format`` 查询参数或 Accept 头确定轮廓的编码格式 (见 contour_format)。"""
+    try:
+        return negotiate_format(response_format, request.headers.get("accept"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _postprocess_query(unet_threshold: Optional[float] = Query(None, gt=0, lt=1),
+                       min_distance: Optional[int] = Query(None, ge=1),
+                       patch_size: Optional[int] = Query(None, ge=8, le=256),
+                       min_contour_area: Optional[float] = Query(None, ge=0),
+                       min_contour_points: Optional[int] = Query(None, ge=1)) -> dict:
+    """后处理参数的查询参数 (省略时使用 predict 中的默认值)，见 predict.postprocess_params。"""
+    return postprocess_params(unet_threshold=unet_threshold, min_distance=min_distance, patch_size=patch_size,
+                              min_contour_area=min_contour_area, min_contour_points=min_contour_points)
+
+
+# 阈值扫描中各参数取值的合法范围 (与 _postprocess_query 的约束一致)
+_SWEEP_VALUE_CHECKS = {
+    "unet_threshold": (lambda value: 0 < value < 1, "in (0, 1)"),
+    "min_distance": (lambda value: value >= 1, ">= 1"),
+    "patch_size": (lambda value: 8 <= value <= 256, "in [8, 256]"),
+    "min_contour_area": (lambda value: value >= 0, ">= 0"),
+    "min_contour_points": (lambda value: value >= 1, ">= 1"),
+}
+
+
+def _sweep_query(unet_threshold: List[float] = Query([]), min_distance: List[int] = Query([]),
+                 patch_size: List[int] = Query([]), min_contour_area: List[float] = Query([]),
+                 min_contour_points: List[int] = Query([])) -> list[dict]:
+    """
+    阈值扫描的参数网格：每个参数可重复给出多个取值 (如 ``?unet_threshold=0.3&unet_threshold=0.5``)，省略时使用默认值。
+    返回全部参数组合；取值非法或组合数超过 SWEEP_MAX_COMBINATIONS 时返回 400。
+    """
+    values = {"unet_threshold": unet_threshold, "min_distance": min_distance, "patch_size": patch_size,
+              "min_contour_area": min_contour_area, "min_contour_points": min_contour_points}
+    for name, (is_valid, expected) in _SWEEP_VALUE_CHECKS.items():
+        invalid = [value for value in values[name] if not is_valid(value)]
+        if invalid:
+            raise HTTPException(status_code=400, detail=f"Invalid {name} {invalid}: expected {expected}.")
+    values = {name: list(dict.fromkeys(grid)) for name, grid in values.items()}  # 去掉重复的取值
+    num_combinations = 1
+    for grid in values.values():
+        num_combinations *= max(1, len(grid))
+    if num_combinations > SWEEP_MAX_COMBINATIONS:
+        raise HTTPException(status_code=400, detail=f"Sweep has {num_combinations} combinations, "
+                                                    f"the limit is {SWEEP_MAX_COMBINATIONS}.")
+    return sweep_combinations(**values)
+
+
+def _contour_response(payload: dict, fmt: str, simplify: float) -> Response:
+    """
+    按协商的格式编码响应中的结节轮廓并直接返回 Response。
+    端点的 response_model 只用于生成文档，返回 Response 时 FastAPI 不再对数千个轮廓点逐一做 Pydantic 校验。
+    """
+    body, media_type = render(payload, fmt, simplify)
+    return Response(content=body, media_type=media_type, headers={"Vary": "Accept"})
+
+
+@app.post("/api/predict", response_model=NoduleDetectResponse, response_model_exclude_none=True)
+async def predict_endpoint(request: Request, file: UploadFile = File(...), debug: bool = False, frame: int = 0,
+                           params: dict = Depends(_postprocess_query),
+                           response_format: Optional[str] = Query(None, alias="format"),
+                           simplify: float = Query(0.0, ge=0)):
     """
     接收上传的单个CT图像文件，进行单阶段肺结节检测，并返回结节的轮廓点集。
+    多帧 DICOM 通过 ``frame`` 指定帧序号 (默认第 0 帧)，只解码该帧。
+    ``unet_threshold`` / ``min_distance`` / ``patch_size`` / ``min_contour_area`` / ``min_contour_points``
+    覆盖默认的后处理阈值。
+    ``debug=true`` 时在响应中附带各阶段耗时 (毫秒)。
+    ``format`` (或 Accept 头) 选择轮廓的编码格式，``simplify`` 为 Douglas-Peucker 简化容差 (原图像素)。
     """
-    logger.info(f"接收到文件进行预测: {file.filename}")
+    fmt = _response_format(request, response_format)
+    spooled = None
+    fields = {"filename": file.filename, "frame": frame}
     try:
-        # 1. 读取上传的文件内容
-        image_bytes = await file.read()
-        
-        # 2. 调用模型进行预测
-        results = run_prediction(image_bytes)
-        
-        logger.info(f"成功处理图像 {file.filename}，检测到 {len(results)} 个结节。")
-        # 3. 按照 Pydantic 模型结构返回结果
-        return {"nodules": results}
+        # 1. 将上传内容按块写入临时文件，同时计算缓存键
+        spooled = await spool_upload(file, result_cache.hasher(pipeline_signature()), UPLOAD_SPOOL_DIR)
+        request_start = time.perf_counter()
+        REQUEST_BYTES.observe(spooled.size, endpoint="predict")
+        if frame:
+            num_frames = await asyncio.to_thread(count_frames, spooled.path)
+            if not 0 <= frame < num_frames:
+                raise HTTPException(status_code=400, detail=f"Frame {frame} out of range ({num_frames} frames).")
+
+        # 2. 相同内容 (且模型与参数未变) 的文件直接返回缓存结果
+        cache_key = _params_cache_key(_frame_cache_key(spooled, frame), params)
+        cached = await result_cache.get(cache_key)
+        if cached is not None:
+            _log_slice(fields, cached, cached=True)
+            REQUESTS.inc(endpoint="predict", status="cached")
+            return _contour_response({"nodules": cached, **({"timings": {}} if debug else {})}, fmt, simplify)
+
+        # 3. 在推理工作池中调用模型进行预测
+        results, profile = await inference_pool.run(run_profiled, run_prediction, spooled.path, frame, params)
+        await result_cache.put(cache_key, results)
+        _record_profile(profile, fields)
+        request_seconds = time.perf_counter() - request_start
+        REQUEST_LATENCY.observe(request_seconds, endpoint="predict")
+        REQUESTS.inc(endpoint="predict", status="ok")
+        fields["total_ms"] = round(request_seconds * 1000, 2)
+        _log_slice(fields, results)
+        # 4. 按照 NoduleDetectResponse 的结构 (或协商的紧凑格式) 返回结果
+        response = {"nodules": results}
+        if debug:
+            response["timings"] = {stage: seconds * 1000 for stage, seconds in profile.get("stages", {}).items()}
+            response["timings"]["total"] = request_seconds * 1000
+        return _contour_response(response, fmt, simplify)
 
+    except HTTPException:
+        REQUESTS.inc(endpoint="predict", status="error")
+        raise
+    except PoolSaturatedError as e:
+        logger.warning("推理工作池已满，拒绝请求。", extra={"fields": {"filename": file.filename}})
+        REQUESTS.inc(endpoint="predict", status="rejected")
+        raise _service_unavailable(e)
     except Exception as e:
-        logger.error(f"处理文件 {file.filename} 时发生错误: {e}", exc_info=True)
+        logger.error("处理文件时发生错误。", exc_info=True, extra={"fields": {**fields, "error": str(e)}})
+        REQUESTS.inc(endpoint="predict", status="error")
         # 向客户端抛出 HTTP 500 错误
         raise HTTPException(status_code=500, detail=f"An error occurred during prediction: {str(e)}")
+    finally:
+        if spooled is not None:
+            spooled.close()
+
+
+@app.post("/api/predict/sweep", response_model=SweepResponse)
+async def predict_sweep_endpoint(request: Request, file: UploadFile = File(...), frame: int = 0,
+                                 combinations: list = Depends(_sweep_query),
+                                 response_format: Optional[str] = Query(None, alias="format"),
+                                 simplify: float = Query(0.0, ge=0)):
+    """
+    阈值扫描：对一张切片按参数网格的每个组合分别返回检测结果，用于调参与 ROC 分析。
+    每个后处理参数可重复给出多个取值 (如 ``?unet_threshold=0.3&unet_threshold=0.5&min_distance=5&min_distance=10``)，
+    组合为各取值的笛卡尔积 (省略的参数使用默认值)，每个组合的结果与以相同参数调用 /api/predict 相同。
+    U-Net 只执行一次；分水岭按 (阈值, 种子间距) 去重，各组合的候选 patch 去重后合并为一次 CNN 批量分类。
+    """
+    fmt = _response_format(request, response_format)
+    if inference_pool.is_saturated:
+        raise _service_unavailable(PoolSaturatedError(inference_pool.retry_after))
+    spooled = None
+    try:
+        spooled = await spool_upload(file, result_cache.hasher(pipeline_signature()), UPLOAD_SPOOL_DIR)
+        request_start = time.perf_counter()
+        REQUEST_BYTES.observe(spooled.size, endpoint="sweep")
+        num_frames = await asyncio.to_thread(count_frames, spooled.path)
+        if not 0 <= frame < num_frames:
+            raise HTTPException(status_code=400, detail=f"Frame {frame} out of range ({num_frames} frames).")
+        (input_tensor, resized_image_np, original_size, roi), profile = await inference_pool.run(
+            run_profiled, preprocess_slice, spooled.path, frame, wait=True)
+        _record_profile(profile)
+        series_uid = profile.get("series_uid")
+    finally:
+        if spooled is not None:
+            spooled.close()
+    if input_tensor is None:
+        REQUESTS.inc(endpoint="sweep", status="error")
+        raise HTTPException(status_code=400, detail="Image preprocessing failed.")
+
+    per_combination = [[] for _ in combinations]
+    if roi is not None:  # 肺野面积可忽略时所有组合均无结节
+        unet_pred_prob = await unet_batcher.submit((input_tensor, roi))
+        (per_combination, _), profile = await inference_pool.run(
+            run_profiled, sweep_postprocess, unet_pred_prob, resized_image_np, original_size, combinations, None,
+            series_uid, wait=True)
+        _record_profile(profile)
+    REQUEST_LATENCY.observe(time.perf_counter() - request_start, endpoint="sweep")
+    REQUESTS.inc(endpoint="sweep", status="ok")
+    logger.info("阈值扫描完成。", extra={"fields": {"filename": file.filename, "frame": frame,
+                                              "combinations": len(combinations)}})
+    response = {"combinations": [{"params": params, "nodules": nodules}
+                                 for params, nodules in zip(combinations, per_combination)]}
+    return _contour_response(response, fmt, simplify)
+
+
+def _frame_cache_key(spooled: SpooledUpload, frame: int) -> str:
+    """单帧文件 (及多帧文件的第 0 帧) 直接使用文件的缓存键，其余帧附加帧序号。"""
+    return spooled.key if frame == 0 else f"{spooled.key}-{frame}"
+
+
+def _params_cache_key(slice_key: str, params: dict) -> str:
+    """默认后处理参数直接使用切片的缓存键 (各端点共享)，否则由参数组合派生新键。"""
+    if params == postprocess_params():
+        return slice_key
+    return result_cache.make_key(slice_key.encode(), "params|" + json.dumps(params, sort_keys=True))
+
+
+async def _receive_series(files: List[UploadFile], uploads: list, slices: list, endpoint: str) -> float:
+    """
+    将上传的序列落盘并展开 zip，结果追加到 ``uploads`` 与 ``slices`` (由调用方负责删除临时文件)。
+    返回落盘完成的时刻，用于统计请求延迟。
+    """
+    signature = pipeline_signature()
+    for file in files:
+        uploads.append(await spool_upload(file, result_cache.hasher(signature), UPLOAD_SPOOL_DIR))
+    request_start = time.perf_counter()
+    for upload in uploads:
+        REQUEST_BYTES.observe(upload.size, endpoint=endpoint)
+    try:
+        slices.extend(await asyncio.to_thread(
+            expand_archives, uploads, lambda: result_cache.hasher(signature), UPLOAD_SPOOL_DIR))
+    except zipfile.BadZipFile as e:
+        raise HTTPException(status_code=400, detail=f"Invalid zip archive: {str(e)}")
+    return request_start
+
+
+async def _predict_slice_batched(spooled: SpooledUpload, frame: int, multi_frame: bool, gate_stats: dict,
+                                 params: dict, priority: int = PRIORITY_INTERACTIVE) -> dict:
+    """
+    对单张切片 (或多帧文件中的一帧) 进行预测，其中 U-Net 前向通过微批处理器与其他切片合并执行。
+    肺野门控的结果累加到 ``gate_stats``；``priority`` 为预处理、后处理在推理工作池中与 U-Net 在微批处理器中排队的优先级。
+    """
+    result = {"filename": spooled.filename, "frame": frame if multi_frame else None}
+    fields = {"filename": spooled.filename, "frame": frame}
+    try:
+        cache_key = _params_cache_key(_frame_cache_key(spooled, frame), params)
+        cached = await result_cache.get(cache_key)
+        if cached is not None:
+            _log_slice(fields, cached, cached=True)
+            return {**result, "nodules": cached, "error": None}
+
+        (input_tensor, resized_image_np, original_size, roi), profile = await inference_pool.run(
+            run_profiled, preprocess_slice, spooled.path, frame, wait=True, priority=priority)
+        _record_profile(profile, fields)
+        _accumulate_gate_stats(gate_stats, profile)
+        if input_tensor is None:
+            return {**result, "nodules": [], "error": "图像预处理失败"}
+        if roi is None:  # 肺野面积可忽略
+            await result_cache.put(cache_key, [])
+            _log_slice(fields, [])
+            return {**result, "nodules": [], "error": None}
+        unet_start = time.perf_counter()
+        unet_pred_prob = await unet_batcher.submit((input_tensor, roi), priority=priority)
+        # 含等待凑批的时间；批量前向本身的耗时见 unet_batch 阶段指标
+        fields["stages_ms"]["unet_batched"] = round((time.perf_counter() - unet_start) * 1000, 2)
+        nodules, profile = await inference_pool.run(
+            run_profiled, postprocess_prediction, unet_pred_prob, resized_image_np, original_size, params,
+            fields.get("series_uid"), wait=True, priority=priority)
+        _record_profile(profile, fields)
+        await result_cache.put(cache_key, nodules)
+        _log_slice(fields, nodules)
+        return {**result, "nodules": nodules, "error": None}
+    except Exception as e:
+        logger.error("处理切片时发生错误。", exc_info=True,
+                     extra={"fields": {"filename": spooled.filename, "frame": frame, "error": str(e)}})
+        return {**result, "nodules": [], "error": str(e)}
+
+
+@app.post("/api/predict/batch", response_model=BatchDetectResponse)
+async def predict_batch_endpoint(request: Request, files: List[UploadFile] = File(...),
+                                 params: dict = Depends(_postprocess_query),
+                                 response_format: Optional[str] = Query(None, alias="format"),
+                                 simplify: float = Query(0.0, ge=0)):
+    """
+    接收整个序列（多个文件，或一个包含所有切片的 zip），逐切片返回结节轮廓。
+    多帧 DICOM 按帧展开，每帧作为一张切片返回。
+    各切片的 U-Net 推理会与并发请求中的切片合并为批量前向计算。
+    后处理参数与 ``format`` / ``simplify`` 同 /api/predict。
+    """
+    fmt = _response_format(request, response_format)
+    if inference_pool.is_saturated:
+        raise _service_unavailable(PoolSaturatedError(inference_pool.retry_after))
+    uploads, slices = [], []
+    try:
+        request_start = await _receive_series(files, uploads, slices, endpoint="batch")
+        frame_counts = await asyncio.gather(*(asyncio.to_thread(count_frames, spooled.path) for spooled in slices))
+        logger.info("接收到序列进行批量预测。", extra={"fields": {"files": len(files), "slices": sum(frame_counts)}})
+
+        gate_stats = _new_gate_stats()
+        results = await asyncio.gather(*(
+            _predict_slice_batched(spooled, frame, num_frames > 1, gate_stats, params)
+            for spooled, num_frames in zip(slices, frame_counts) for frame in range(num_frames)
+        ))
+    finally:
+        for spooled in uploads + slices:
+            spooled.close()
+    REQUEST_LATENCY.observe(time.perf_counter() - request_start, endpoint="batch")
+    REQUESTS.inc(endpoint="batch", status="ok")
+    logger.info("批量预测完成。", extra={"fields": {
+        "slices": len(results), "nodules": sum(len(r["nodules"]) for r in results), "lung_gate": gate_stats,
+        "total_ms": round((time.perf_counter() - request_start) * 1000, 2)}})
+    return _contour_response({"slices": results, "lung_gate": gate_stats}, fmt, simplify)
+
+
+async def _sorted_frames(slices: list[SpooledUpload]) -> list[tuple[SpooledUpload, int, bool]]:
+    """将切片文件按帧展开并按切片位置排序 (见 volume.sort_order)，返回 (文件, 帧序号, 是否为多帧文件)。"""
+    positions = await asyncio.gather(*(asyncio.to_thread(slice_positions, spooled.path) for spooled in slices))
+    frames, frame_positions = [], []
+    for spooled, file_positions in zip(slices, positions):
+        for frame, position in enumerate(file_positions):
+            frames.append((spooled, frame, len(file_positions) > 1))
+            frame_positions.append(position)
+    return [frames[i] for i in sort_order(frame_positions)]
+
+
+async def _volume_slice_candidates(spooled: SpooledUpload, frame: int, gate_stats: dict, params: dict,
+                                   fields: dict) -> tuple[list[dict], tuple[int, int], tuple[int, int]]:
+    """
+    体积模式中单张切片的处理：预处理、肺野门控、(微批) U-Net 与分水岭分割，返回候选区域、模型输入尺寸与原始尺寸。
+    该切片的阶段耗时等日志字段合并到 ``fields``。
+    """
+    (input_tensor, resized_image_np, original_size, roi), profile = await inference_pool.run(
+        run_profiled, preprocess_slice, spooled.path, frame, wait=True)
+    _record_profile(profile, fields)
+    _accumulate_gate_stats(gate_stats, profile)
+    if input_tensor is None:
+        raise ValueError("图像预处理失败")
+    if roi is None:  # 肺野面积可忽略
+        return [], resized_image_np.shape[:2], original_size
+    unet_pred_prob = await unet_batcher.submit((input_tensor, roi))
+    candidates, profile = await inference_pool.run(
+        run_profiled, extract_candidates, unet_pred_prob, resized_image_np, params, wait=True)
+    _record_profile(profile, fields)
+    fields["candidates"] = len(candidates)
+    return candidates, resized_image_np.shape[:2], original_size
+
+
+@app.post("/api/predict/volume", response_model=VolumeDetectResponse)
+async def predict_volume_endpoint(request: Request, files: List[UploadFile] = File(...),
+                                  params: dict = Depends(_postprocess_query),
+                                  response_format: Optional[str] = Query(None, alias="format"),
+                                  simplify: float = Query(0.0, ge=0)):
+    """
+    体积模式：将整个序列按 ImagePositionPatient 排序后作为 3D 体积处理。
+    相邻切片上的候选区域被关联为 3D 结节，每个结节只做一次 CNN 分类，并在所有切片上使用同一个 id。
+    后处理参数与 ``format`` / ``simplify`` 同 /api/predict。
+    """
+    fmt = _response_format(request, response_format)
+    if inference_pool.is_saturated:
+        raise _service_unavailable(PoolSaturatedError(inference_pool.retry_after))
+    uploads, slices = [], []
+    try:
+        request_start = await _receive_series(files, uploads, slices, endpoint="volume")
+        frames = await _sorted_frames(slices)
+        logger.info("接收到序列进行体积预测。", extra={"fields": {"files": len(files), "slices": len(frames)}})
+
+        # 整个序列的结果以全部切片的缓存键 (按排序后的顺序) 与后处理参数为键缓存
+        cache_key = _params_cache_key(result_cache.make_key(
+            "|".join(_frame_cache_key(spooled, frame) for spooled, frame, _ in frames).encode(),
+            f"volume|{VOLUME_LINK_MIN_OVERLAP}"), params)
+        cached = await result_cache.get(cache_key)
+        if cached is not None:
+            REQUESTS.inc(endpoint="volume", status="cached")
+            return _contour_response(cached, fmt, simplify)
+
+        gate_stats = _new_gate_stats()
+        slice_fields = [{"filename": spooled.filename, "frame": frame} for spooled, frame, _ in frames]
+        outcomes = await asyncio.gather(
+            *(_volume_slice_candidates(spooled, frame, gate_stats, params, fields)
+              for (spooled, frame, _), fields in zip(frames, slice_fields)),
+            return_exceptions=True)
+    finally:
+        for spooled in uploads + slices:
+            spooled.close()
+
+    errors = [str(outcome) if isinstance(outcome, Exception) else None for outcome in outcomes]
+    volume_candidates = [[] if error else outcome[0] for outcome, error in zip(outcomes, errors)]
+    image_shapes = [(0, 0) if error else outcome[1] for outcome, error in zip(outcomes, errors)]
+    original_sizes = [(0, 0) if error else outcome[2] for outcome, error in zip(outcomes, errors)]
+    for (spooled, frame, _), error in zip(frames, errors):
+        if error:
+            logger.error("处理切片时发生错误。",
+                         extra={"fields": {"filename": spooled.filename, "frame": frame, "error": error}})
+
+    (slice_nodules, summaries), profile = await inference_pool.run(
+        run_profiled, assemble_volume, volume_candidates, image_shapes, original_sizes, params,
+        next((fields["series_uid"] for fields in slice_fields if "series_uid" in fields), None), wait=True)
+    _record_profile(profile)
+    for fields, nodules, error in zip(slice_fields, slice_nodules, errors):
+        if not error:
+            _log_slice(fields, nodules)
+    response = {
+        "nodules": summaries,
+        "slices": [
+            {"filename": spooled.filename, "frame": frame if multi_frame else None, "nodules": nodules, "error": error}
+            for (spooled, frame, multi_frame), nodules, error in zip(frames, slice_nodules, errors)
+        ],
+        "lung_gate": gate_stats,
+    }
+    if not any(errors):
+        await result_cache.put(cache_key, response)
+    REQUEST_LATENCY.observe(time.perf_counter() - request_start, endpoint="volume")
+    REQUESTS.inc(endpoint="volume", status="ok")
+    logger.info("体积预测完成。", extra={"fields": {
+        "slices": len(frames), "nodules_3d": len(summaries), "lung_gate": gate_stats,
+        "total_ms": round((time.perf_counter() - request_start) * 1000, 2)}})
+    return _contour_response(response, fmt, simplify)
+
+
+# --- 序列会话 ---
+async def _load_series_slice(series_id: str, index: int, spooled: SpooledUpload, frame: int, meta: dict):
+    """解码并预处理会话中的一张切片 (含肺野门控)：图像存入 series_store，尺寸、U-Net 区域或错误写入 ``meta``。"""
+    try:
+        (input_tensor, resized_image_np, original_size, roi), profile = await inference_pool.run(
+            run_profiled, preprocess_slice, spooled.path, frame, wait=True)
+        _record_profile(profile)
+        # 没有 SeriesInstanceUID 时 patch 缓存以会话为范围
+        meta["series_uid"] = profile.get("series_uid", f"session:{series_id}")
+        if input_tensor is None:
+            meta["error"] = "图像预处理失败"
+            return
+        meta.update(original_size=original_size, roi=roi)
+        series_store.put_array(series_id, index, "image", resized_image_np)
+    except Exception as e:
+        logger.error("加载切片时发生错误。", exc_info=True,
+                     extra={"fields": {"filename": spooled.filename, "frame": frame, "error": str(e)}})
+        meta["error"] = str(e)
+
+
+def _series_info(series_id: str, metadata: list[dict]) -> dict:
+    return {
+        "series_id": series_id,
+        "slices": [
+            {"index": index, "filename": meta["filename"], "frame": meta["frame"], "error": meta["error"]}
+            for index, meta in enumerate(metadata)
+        ],
+        "ttl_seconds": SERIES_TTL_SECONDS,
+    }
+
+
+@app.post("/api/series", response_model=SeriesInfo, status_code=201)
+async def create_series_endpoint(files: List[UploadFile] = File(...)):
+    """
+    序列会话：上传整个序列 (多个文件，或一个 zip；多帧 DICOM 按帧展开) 一次，返回 series_id。
+    各切片在上传时完成解码、窗宽窗位与肺野门控，按切片位置排序 (与体积模式相同)；
+    之后通过 /api/series/{series_id}/predict 按切片或切片范围请求预测，不再重复上传。
+    """
+    if inference_pool.is_saturated:
+        raise _service_unavailable(PoolSaturatedError(inference_pool.retry_after))
+    uploads, slices = [], []
+    series_id = None
+    try:
+        request_start = await _receive_series(files, uploads, slices, endpoint="series")
+        frames = await _sorted_frames(slices)
+        metadata = [
+            {"filename": spooled.filename, "frame": frame if multi_frame else None,
+             "key": _frame_cache_key(spooled, frame), "original_size": None, "roi": None, "error": None}
+            for spooled, frame, multi_frame in frames
+        ]
+        series_id = series_store.create(metadata)
+        await asyncio.gather(*(
+            _load_series_slice(series_id, index, spooled, frame, meta)
+            for index, ((spooled, frame, _), meta) in enumerate(zip(frames, metadata))
+        ))
+    except BaseException:
+        if series_id is not None:
+            series_store.delete(series_id)
+        raise
+    finally:
+        for spooled in uploads + slices:
+            spooled.close()
+    REQUEST_LATENCY.observe(time.perf_counter() - request_start, endpoint="series")
+    REQUESTS.inc(endpoint="series", status="ok")
+    logger.info("已创建序列会话。", extra={"fields": {"series_id": series_id, "files": len(files),
+                                               "slices": len(metadata)}})
+    return _series_info(series_id, metadata)
+
+
+def _get_series(series_id: str) -> list[dict]:
+    metadata = series_store.get(series_id)
+    if metadata is None:
+        raise HTTPException(status_code=404, detail=f"Series {series_id} not found or expired.")
+    return metadata
+
+
+@app.get("/api/series/{series_id}", response_model=SeriesInfo)
+def get_series_endpoint(series_id: str):
+    """返回会话中的切片列表 (同时刷新会话的空闲计时)。"""
+    return _series_info(series_id, _get_series(series_id))
+
+
+@app.delete("/api/series/{series_id}", status_code=204)
+def delete_series_endpoint(series_id: str):
+    """删除会话及其保存的图像与概率图。"""
+    if not series_store.delete(series_id):
+        raise HTTPException(status_code=404, detail=f"Series {series_id} not found or expired.")
+    return Response(status_code=204)
+
+
+def _series_range(metadata: list[dict], start: int, stop: Optional[int]) -> int:
+    """检查切片范围 [start, stop) (省略 ``stop`` 时只含第 ``start`` 张)，返回 stop。"""
+    stop = start + 1 if stop is None else stop
+    if not 0 <= start < stop <= len(metadata):
+        raise HTTPException(status_code=400,
+                            detail=f"Slice range [{start}, {stop}) out of range ({len(metadata)} slices).")
+    return stop
+
+
+async def _series_prob(series_id: str, index: int, meta: dict):
+    """返回会话中一张切片的 (图像, U-Net 概率图)：概率图已保存时直接复用，否则经微批处理器生成并保存。"""
+    image = series_store.get_array(series_id, index, "image")
+    if image is None:
+        raise RuntimeError("会话已被删除。")
+    unet_pred_prob = series_store.get_array(series_id, index, "prob")
+    if unet_pred_prob is None:
+        unet_pred_prob = await unet_batcher.submit((image_to_tensor(image), meta["roi"]))
+        series_store.put_array(series_id, index, "prob", unet_pred_prob)
+    return image, unet_pred_prob
+
+
+async def _predict_series_slice(series_id: str, index: int, meta: dict, params: dict) -> dict:
+    """
+    预测会话中的一张切片：U-Net 概率图已保存时直接复用，否则经微批处理器生成并保存；
+    之后以给定的后处理参数执行分水岭、CNN 与轮廓提取。
+    """
+    result = {"index": index, "filename": meta["filename"], "frame": meta["frame"]}
+    if meta["error"]:
+        return {**result, "nodules": [], "error": meta["error"]}
+    fields = {"series_id": series_id, "index": index, "filename": meta["filename"], "frame": meta["frame"]}
+    try:
+        cache_key = _params_cache_key(meta["key"], params)
+        cached = await result_cache.get(cache_key)
+        if cached is not None:
+            _log_slice(fields, cached, cached=True)
+            return {**result, "nodules": cached, "error": None}
+
+        nodules = []
+        if meta["roi"] is not None:  # 肺野面积可忽略的切片不做 U-Net
+            image, unet_pred_prob = await _series_prob(series_id, index, meta)
+            nodules, profile = await inference_pool.run(
+                run_profiled, postprocess_prediction, unet_pred_prob, image, meta["original_size"], params,
+                meta["series_uid"], wait=True)
+            _record_profile(profile, fields)
+        await result_cache.put(cache_key, nodules)
+        _log_slice(fields, nodules)
+        return {**result, "nodules": nodules, "error": None}
+    except Exception as e:
+        logger.error("预测会话切片时发生错误。", exc_info=True,
+                     extra={"fields": {"series_id": series_id, "index": index, "error": str(e)}})
+        return {**result, "nodules": [], "error": str(e)}
+
+
+@app.get("/api/series/{series_id}/predict", response_model=SeriesDetectResponse)
+async def predict_series_endpoint(request: Request, series_id: str, start: int = 0, stop: Optional[int] = None,
+                                  params: dict = Depends(_postprocess_query),
+                                  response_format: Optional[str] = Query(None, alias="format"),
+                                  simplify: float = Query(0.0, ge=0)):
+    """
+    预测会话中序号在 [start, stop) 范围内的切片，省略 ``stop`` 时只预测第 ``start`` 张。
+    后处理参数同 /api/predict；U-Net 概率图在首次预测时生成并保存在会话中，修改这些阈值只重新执行后续的廉价阶段。
+    ``format`` / ``simplify`` 与 /api/predict 相同。
+    """
+    fmt = _response_format(request, response_format)
+    metadata = _get_series(series_id)
+    stop = _series_range(metadata, start, stop)
+    if inference_pool.is_saturated:
+        raise _service_unavailable(PoolSaturatedError(inference_pool.retry_after))
+
+    request_start = time.perf_counter()
+    results = await asyncio.gather(*(
+        _predict_series_slice(series_id, index, metadata[index], params) for index in range(start, stop)
+    ))
+    REQUEST_LATENCY.observe(time.perf_counter() - request_start, endpoint="series_predict")
+    REQUESTS.inc(endpoint="series_predict", status="ok")
+    return _contour_response({"series_id": series_id, "slices": results}, fmt, simplify)
+
+
+async def _sweep_series_slice(series_id: str, index: int, meta: dict, combinations: list[dict]) -> list[dict]:
+    """以全部参数组合处理会话中的一张切片，返回每个组合的切片结果；CNN logits 保存在切片元数据中供后续扫描复用。"""
+    result = {"index": index, "filename": meta["filename"], "frame": meta["frame"], "nodules": [], "error": meta["error"]}
+    if meta["error"] or meta["roi"] is None:
+        return [result] * len(combinations)
+    try:
+        image, unet_pred_prob = await _series_prob(series_id, index, meta)
+        logit_cache = meta.setdefault("cnn_logits", {})
+        (per_combination, new_logits), profile = await inference_pool.run(
+            run_profiled, sweep_postprocess, unet_pred_prob, image, meta["original_size"], combinations,
+            dict(logit_cache), meta["series_uid"], wait=True)
+        _record_profile(profile)
+        logit_cache.update(new_logits)
+        return [{**result, "nodules": nodules} for nodules in per_combination]
+    except Exception as e:
+        logger.error("扫描会话切片时发生错误。", exc_info=True,
+                     extra={"fields": {"series_id": series_id, "index": index, "error": str(e)}})
+        return [{**result, "error": str(e)}] * len(combinations)
+
+
+@app.get("/api/series/{series_id}/sweep", response_model=SeriesSweepResponse)
+async def sweep_series_endpoint(request: Request, series_id: str, start: int = 0, stop: Optional[int] = None,
+                                combinations: list = Depends(_sweep_query),
+                                response_format: Optional[str] = Query(None, alias="format"),
+                                simplify: float = Query(0.0, ge=0)):
+    """
+    阈值扫描：对会话中 [start, stop) 范围内的切片，按参数网格 (见 /api/predict/sweep) 的每个组合分别返回结果。
+    复用会话中保存的 U-Net 概率图；每张切片上的候选 patch 只做一次 CNN 分类，其 logits 保存在会话中，
+    之后的扫描与预测不再对相同的 patch 执行 CNN。
+    """
+    fmt = _response_format(request, response_format)
+    metadata = _get_series(series_id)
+    stop = _series_range(metadata, start, stop)
+    if inference_pool.is_saturated:
+        raise _service_unavailable(PoolSaturatedError(inference_pool.retry_after))
+
+    request_start = time.perf_counter()
+    per_slice = await asyncio.gather(*(
+        _sweep_series_slice(series_id, index, metadata[index], combinations) for index in range(start, stop)
+    ))
+    REQUEST_LATENCY.observe(time.perf_counter() - request_start, endpoint="series_sweep")
+    REQUESTS.inc(endpoint="series_sweep", status="ok")
+    response = {
+        "series_id": series_id,
+        "combinations": [
+            {"params": params, "slices": [results[i] for results in per_slice]}
+            for i, params in enumerate(combinations)
+        ],
+    }
+    return _contour_response(response, fmt, simplify)
+
+
+# --- 后台分析任务 ---
+async def _predict_job_slice(item: tuple[SpooledUpload, int, bool], params: dict) -> dict:
+    """处理分析任务中的一张切片；预处理与后处理以 PRIORITY_BULK 排队，排在交互式请求之后。"""
+    spooled, frame, multi_frame = item
+    return await _predict_slice_batched(spooled, frame, multi_frame, _new_gate_stats(), params, priority=PRIORITY_BULK)
+
+
+# 任务状态与逐切片结果保存在 SQLite 中，服务重启后已完成的结果仍可查询
+job_store = JobStore(JOB_STORE_PATH, retention_seconds=JOB_RETENTION_HOURS * 3600)
+job_manager = JobManager(job_store, _predict_job_slice, max_running=JOB_MAX_RUNNING,
+                         slice_concurrency=JOB_SLICE_CONCURRENCY, max_queued=JOB_MAX_QUEUED)
+
+Gauge("lung_cad_jobs_queued", "Analysis jobs waiting to start.", callback=lambda: job_manager.queued)
+Gauge("lung_cad_jobs_running", "Analysis jobs currently running.", callback=lambda: job_manager.running)
+
+
+def _get_job(job_id: str) -> dict:
+    status = job_store.get(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return status
+
+
+@app.post("/api/jobs", response_model=JobStatus, status_code=202)
+async def create_job_endpoint(files: List[UploadFile] = File(...), params: dict = Depends(_postprocess_query),
+                              priority: int = Query(0, ge=-100, le=100)):
+    """
+    提交整个检查 (多个文件，或一个包含所有切片的 zip) 作为后台分析任务，立即返回任务状态与 job_id。
+    切片按位置排序后逐张预测，结果可通过 /api/jobs/{job_id}/results 查询，或通过 /api/jobs/{job_id}/events 订阅。
+    ``priority`` 较大的任务先于排队中的其他任务启动；所有任务的切片都排在交互式请求之后。
+    后处理参数同 /api/predict。
+    """
+    uploads, slices = [], []
+
+    def cleanup():
+        for spooled in uploads + slices:
+            spooled.close()
+
+    try:
+        request_start = await _receive_series(files, uploads, slices, endpoint="jobs")
+        frames = await _sorted_frames(slices)
+        await asyncio.to_thread(job_store.purge)
+        status = job_manager.submit(
+            [{"filename": spooled.filename, "frame": frame if multi_frame else None}
+             for spooled, frame, multi_frame in frames],
+            frames, params, priority, cleanup)
+    except JobQueueFullError as e:
+        cleanup()
+        REQUESTS.inc(endpoint="jobs", status="rejected")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+    except BaseException:
+        cleanup()
+        raise
+    REQUEST_LATENCY.observe(time.perf_counter() - request_start, endpoint="jobs")
+    REQUESTS.inc(endpoint="jobs", status="ok")
+    logger.info("已提交分析任务。", extra={"fields": {"job_id": status["job_id"], "files": len(files),
+                                               "slices": len(frames)}})
+    return status
+
+
+@app.get("/api/jobs/{job_id}", response_model=JobStatus)
+def get_job_endpoint(job_id: str):
+    """返回任务的状态与进度 (已完成的切片数)。"""
+    return _get_job(job_id)
+
+
+@app.get("/api/jobs/{job_id}/results", response_model=JobResultsResponse)
+def job_results_endpoint(request: Request, job_id: str, start: int = Query(0, ge=0),
+                         stop: Optional[int] = Query(None, ge=0),
+                         response_format: Optional[str] = Query(None, alias="format"),
+                         simplify: float = Query(0.0, ge=0)):
+    """
+    返回任务中序号在 [start, stop) 内的已完成切片 (运行中的任务返回目前已完成的部分)。
+    ``format`` / ``simplify`` 同 /api/predict。
+    """
+    fmt = _response_format(request, response_format)
+    status = _get_job(job_id)
+    slices = job_store.results(job_id, start, stop)
+    return _contour_response({"job_id": job_id, "status": status["status"], "slices": slices}, fmt, simplify)
+
+
+def _sse_event(event: str, data: dict, fmt: str, simplify: float) -> bytes:
+    """编码一条 Server-Sent Event；切片结果中的轮廓按协商的格式编码 (紧凑的 JSON 为单行)。"""
+    body, _ = render(data, fmt, simplify)
+    return b"event: " + event.encode() + b"\ndata: " + body + b"\n\n"
+
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events_endpoint(request: Request, job_id: str,
+                              response_format: Optional[str] = Query(None, alias="format"),
+                              simplify: float = Query(0.0, ge=0)):
+    """
+    以 Server-Sent Events (text/event-stream) 推送任务进度：先重放已完成的切片，之后每完成一张切片推送一个
+    ``slice`` 事件，状态变化时推送 ``status`` 事件；任务结束后推送最终状态并关闭连接。
+    重新连接时会再次重放全部已完成的切片，客户端可按 ``index`` 去重。``format`` 不支持 msgpack。
+    """
+    fmt = _response_format(request, response_format)
+    if fmt == "msgpack":
+        raise HTTPException(status_code=400, detail="The msgpack format is not supported for event streams.")
+    _get_job(job_id)
+    # 先订阅再读取已完成的结果，重放与实时事件之间不会遗漏切片 (重复的按 index 跳过)
+    queue = job_manager.subscribe(job_id)
+
+    async def stream():
+        try:
+            sent = set()
+            for result in await asyncio.to_thread(job_store.results, job_id):
+                sent.add(result["index"])
+                yield _sse_event("slice", result, fmt, simplify)
+            status = await asyncio.to_thread(job_store.get, job_id)
+            yield _sse_event("status", status, fmt, simplify)
+            if queue is None or status["status"] in TERMINAL_STATES:
+                return
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), JOB_EVENT_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                if event["event"] == "slice":
+                    if event["data"]["index"] in sent:
+                        continue
+                    sent.add(event["data"]["index"])
+                yield _sse_event(event["event"], event["data"], fmt, simplify)
+                if event["event"] == "status" and event["data"]["status"] in TERMINAL_STATES:
+                    return
+        finally:
+            if queue is not None:
+                job_manager.unsubscribe(job_id, queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post("/api/jobs/{job_id}/cancel", response_model=JobStatus)
+async def cancel_job_endpoint(job_id: str):
+    """取消排队或运行中的任务 (已完成的切片结果保留)；任务已结束时原样返回其状态。"""
+    _get_job(job_id)
+    await job_manager.cancel(job_id)
+    return _get_job(job_id)
+
+
+@app.delete("/api/jobs/{job_id}", status_code=204)
+async def delete_job_endpoint(job_id: str):
+    """删除任务及其保存的结果 (运行中的任务先被取消)。"""
+    await job_manager.cancel(job_id)
+    if not job_store.delete(job_id):
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return Response(status_code=204)
 
 
 # --- 直接运行时的启动配置 ---
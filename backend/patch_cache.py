@@ -0,0 +1,131 @@
+"""
+候选 patch 的 CNN logits 缓存
+
+相邻 CT 切片上的分水岭候选常出现在相同位置且内容几乎相同，同一序列被反复请求 (逐张浏览、调整阈值、
+体积模式与逐切片模式交替) 时同一个 patch 也会被反复分类。本模块以「patch 内容的量化哈希 + 裁剪位置」为键
+缓存 CNN 输出的 logits，近似重复的 patch 直接复用已有结果，不再送入分类器。
+
+- 键: patch 按块取均值缩小为 ``hash_size`` × ``hash_size``，量化到 ``levels`` 个灰度级后与裁剪尺寸、
+  按 ``position_step`` 量化的裁剪位置一起哈希。量化越粗命中越多，但内容差异较大的 patch 也越可能共用结果；
+- 复用条件: 与缓存条目的 CNN 输入逐字节相同时总是复用；只是近似相同时，仅当缓存的 logits 最大两类之差
+  不低于 ``min_margin`` (分类器足够确定) 才复用，否则重新分类，避免把接近决策边界的结果套用到略有不同的 patch 上；
+- 缓存按序列 (SeriesInstanceUID) 划分，不同序列的 patch 互不命中；每个序列一个 LRU，
+  序列数与每个序列的条目数均有上限；
+- 命中率按序列统计 (SeriesHitStats)。进程模式下每个工作进程各有一份缓存，命中数随 profile 返回主进程汇总。
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class PatchLogitCache:
+    """
+    按序列划分的 patch logits LRU 缓存 (线程安全)。
+
+    - ``max_entries``: 每个序列最多缓存的 patch 数 (每个 patch 占精确与近似两个键)，为 0 时禁用缓存。
+    - ``max_series``: 同时缓存的序列数，超出时删除最久未访问的序列。
+    - ``hash_size`` / ``levels`` / ``position_step``: 键的量化参数，``min_margin``: 近似命中的置信度要求，见模块说明。
+    """
+
+    def __init__(self, max_entries: int = 4096, max_series: int = 32, hash_size: int = 16, levels: int = 16,
+                 position_step: int = 4, min_margin: float = 0.0):
+        self.max_entries = max_entries
+        self.max_series = max_series
+        self.hash_size = hash_size
+        self.levels = levels
+        self.position_step = max(1, position_step)
+        self.min_margin = min_margin
+        self._series: OrderedDict[str, OrderedDict[bytes, np.ndarray]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def key(self, patch: np.ndarray, position: tuple[int, int, int]) -> tuple[bytes, bytes]:
+        """
+        由 patch 像素 (取值 0~1) 与位置 (裁剪尺寸, 行, 列) 计算 (缓存键, 内容摘要)；
+        内容摘要取自量化为 uint8 的 patch，即 CNN 实际看到的输入 (见 predict._patches_to_tensor)。
+        """
+        content = hashlib.blake2b((patch * 255).astype(np.uint8).tobytes(), digest_size=16).digest()
+        height, width = patch.shape
+        cells = min(self.hash_size, height, width)
+        # 裁掉不能整除的边缘像素后按块求均值
+        blocks = np.asarray(patch, dtype=np.float32)[:height - height % cells, :width - width % cells]
+        means = blocks.reshape(cells, blocks.shape[0] // cells, cells, blocks.shape[1] // cells).mean(axis=(1, 3))
+        quantized = np.clip(means * self.levels, 0, self.levels - 1).astype(np.uint8)
+        crop_size, row, col = position
+        digest = hashlib.blake2b(quantized.tobytes(), digest_size=16)
+        digest.update(np.array([crop_size, row // self.position_step, col // self.position_step], np.int64).tobytes())
+        return digest.digest(), content
+
+    def get_many(self, series_uid: str, keys: list[tuple[bytes, bytes]]) -> list[np.ndarray | None]:
+        """返回各键 (见 key) 缓存的 logits，未命中或不满足复用条件的位置为 None。"""
+        with self._lock:
+            entries = self._series.get(series_uid)
+            if entries is None:
+                return [None] * len(keys)
+            self._series.move_to_end(series_uid)
+            found = []
+            for key, content in keys:
+                logits = entries.get(content)
+                if logits is not None:
+                    entries.move_to_end(content)
+                elif key in entries:
+                    entries.move_to_end(key)
+                    cached_logits = entries[key]
+                    if np.ptp(np.sort(cached_logits)[-2:]) >= self.min_margin:
+                        logits = cached_logits
+                found.append(logits)
+            return found
+
+    def put_many(self, series_uid: str, keys: list[tuple[bytes, bytes]], logits: np.ndarray):
+        if not self.enabled:
+            return
+        with self._lock:
+            entries = self._series.get(series_uid)
+            if entries is None:
+                entries = self._series[series_uid] = OrderedDict()
+                while len(self._series) > self.max_series:
+                    self._series.popitem(last=False)
+            self._series.move_to_end(series_uid)
+            # 每个 patch 同时以内容摘要 (精确命中) 与近似键登记；近似键指向最近一次写入的结果
+            for (key, content), row in zip(keys, logits):
+                for entry_key in (content, key):
+                    entries[entry_key] = row
+                    entries.move_to_end(entry_key)
+            while len(entries) > 2 * self.max_entries:
+                entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"series": len(self._series), "keys": sum(map(len, self._series.values()))}
+
+
+class SeriesHitStats:
+    """按序列累计的 patch 缓存命中数与未命中数 (只保留最近 ``max_series`` 个序列)。"""
+
+    def __init__(self, max_series: int = 32):
+        self.max_series = max_series
+        self._series: OrderedDict[str, list[int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, series_uid: str, hits: int, misses: int):
+        with self._lock:
+            counts = self._series.setdefault(series_uid, [0, 0])
+            counts[0] += hits
+            counts[1] += misses
+            self._series.move_to_end(series_uid)
+            while len(self._series) > self.max_series:
+                self._series.popitem(last=False)
+
+    def stats(self) -> dict:
+        """{序列: {"hits", "misses", "hit_rate"}}，按最近访问顺序排列。"""
+        with self._lock:
+            return {
+                series_uid: {"hits": hits, "misses": misses,
+                             "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
+                for series_uid, (hits, misses) in self._series.items()
+            }
@@ -11,18 +11,34 @@ import numpy as np
 import cv2
 import pydicom
 from io import BytesIO
+import ctypes
+import ctypes.util
+import hashlib
+import itertools
+import logging
 import os
+import sys
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from scipy import ndimage
-from skimage import measure, transform
-from skimage.segmentation import watershed
-from skimage.feature import peak_local_max
-from torchvision import transforms
+
+try:
+    from pydicom.pixels import iter_pixels  # pydicom >= 3: 按帧解码，不需要读入全部像素数据
+except ImportError:
+    iter_pixels = None
 
 
 # 从项目中的 unet_model.py 导入 UNet 模型结构
 from unet_model import UNet
-# 从 cnn_classifier_model.py 导入 CNN 模型结构
-from cnn_classifier_model import get_classifier_model
+from metrics import stage_timer
+from structured_logging import configure_logging
+from patch_cache import PatchLogitCache
+from engine import load_exported_models, prepare_models
+logger = logging.getLogger(__name__)
+# skimage 与 torchvision (cnn_classifier_model) 导入较慢，在首次使用时才导入，缩短服务的冷启动时间
 
 
 # --- 配置 ---
@@ -33,216 +49,1095 @@ UNET_MODEL_PATH = os.path.join(BASE_DIR, "model-best.pth")
 CNN_MODEL_PATH = os.path.join(BASE_DIR, "cnn_classifier.pth")
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# 推理后端 (见 engine.py): eager / torchscript / onnx / onnx_int8 / int8_dynamic / int8_static
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "eager")
+CHANNELS_LAST = os.getenv("CHANNELS_LAST", "0") == "1"  # eager 后端是否使用 channels_last 内存格式
+EXPORT_DIR = os.getenv("MODEL_EXPORT_DIR", os.path.join(BASE_DIR, "exported"))  # 导出模型文件的目录
+
 # 模型和预处理所期望的参数
 TARGET_IMG_SIZE = (512, 512)
 WINDOW_LEVEL = -600  # 肺窗中心
 WINDOW_WIDTH = 1500  # 肺窗宽度
 CLASS_NAMES = ['fp', 'tp'] # CNN 分类器类别顺序 (与训练一致)
+CNN_NORM_MEAN = (0.485, 0.456, 0.406)  # CNN 输入归一化参数 (ImageNet，与训练一致)
+CNN_NORM_STD = (0.229, 0.224, 0.225)
+CNN_BATCH_SIZE = 64  # CNN 分类器单次前向的最大 patch 数量
+
+# 后处理阈值
+UNET_THRESHOLD = 0.5         # U-Net 概率图二值化阈值
+WATERSHED_MIN_DISTANCE = 10  # 分水岭种子点 (距离变换局部极大值) 的最小间距
+PATCH_SIZE = 64              # 送入 CNN 分类器的候选 patch 尺寸
+MIN_CONTOUR_AREA = 10        # 面积小于该值的轮廓被视为噪声
+MIN_CONTOUR_POINTS = 5       # 点数少于该值的轮廓被视为噪声
+
+# U-Net 推理模式: "resize" 将图像缩放到 TARGET_IMG_SIZE 后推理；
+# "tiled" 对大于 TARGET_IMG_SIZE 的图像在原始分辨率上以重叠的滑动窗口 (tile) 推理并融合概率图
+UNET_INFERENCE_MODE = os.getenv("UNET_INFERENCE_MODE", "resize")
+UNET_TILE_OVERLAP = int(os.getenv("UNET_TILE_OVERLAP", "64"))         # 相邻 tile 的重叠像素数
+UNET_TILE_BATCH_SIZE = int(os.getenv("UNET_TILE_BATCH_SIZE", "4"))    # 单次前向的最大 tile 数
+
+# 肺野门控 (见 lung.py): 肺野面积可忽略的切片跳过 U-Net，其余切片只对肺野外接矩形做推理
+LUNG_GATE_ENABLED = os.getenv("LUNG_GATE", "1") == "1"                            # 设为 0 关闭门控 (用于验证)
+LUNG_GATE_MIN_FRACTION = float(os.getenv("LUNG_GATE_MIN_FRACTION", "0.005"))     # 肺野面积占比低于该值时跳过
+LUNG_ROI_ALIGN = 32  # 裁剪区域边长对齐到该值 (U-Net 下采样倍数的整数倍)
+# 裁剪区域为正方形，边长取不小于肺野外接矩形的最小档位 (超过所有档位时使用整张图像)，
+# 形状种类少，不同切片能合并为同一个微批，预热也能覆盖全部形状
+LUNG_ROI_BUCKETS = tuple(sorted({-(-int(size) // LUNG_ROI_ALIGN) * LUNG_ROI_ALIGN
+                                 for size in os.getenv("LUNG_ROI_BUCKETS", "256,352,448").split(",") if size.strip()}))
+
+# 运行时设置 (见 configure_runtime)
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", "0"))          # intra-op 线程数，0 表示使用 torch 的默认值
+TORCH_INTEROP_THREADS = int(os.getenv("TORCH_INTEROP_THREADS", "1"))  # inter-op 线程数 (流程中没有 inter-op 并行)，0 表示不修改
+MALLOC_RETAIN = os.getenv("MALLOC_RETAIN", "0") == "1"                # glibc: 大块内存释放后保留在堆中复用 (增加常驻内存，需显式开启)
+MALLOC_TRIM_THRESHOLD_MB = int(os.getenv("MALLOC_TRIM_THRESHOLD_MB", "512"))  # MALLOC_RETAIN 时堆顶最多保留的空闲内存 (MB)
+WARMUP_ITERATIONS = int(os.getenv("WARMUP_ITERATIONS", "1"))          # 预热时每个批大小的前向次数
+
+# 预处理 (见 _fill_frame)
+LUT_CHUNK_SIZE = 1 << 16  # 查找表路径每次处理的像素数 (索引缓冲区大小)
+
+# 候选 patch 的 CNN logits 缓存 (见 patch_cache.py)，按序列 (SeriesInstanceUID) 共享
+PATCH_CACHE_MAX_ENTRIES = int(os.getenv("PATCH_CACHE_MAX_ENTRIES", "4096"))     # 每个序列缓存的 patch 数，0 表示禁用
+PATCH_CACHE_MAX_SERIES = int(os.getenv("PATCH_CACHE_MAX_SERIES", "32"))         # 同时缓存的序列数
+PATCH_CACHE_HASH_SIZE = int(os.getenv("PATCH_CACHE_HASH_SIZE", "16"))           # patch 哈希前缩小到的边长
+PATCH_CACHE_LEVELS = int(os.getenv("PATCH_CACHE_LEVELS", "16"))                 # patch 哈希的灰度量化级数
+PATCH_CACHE_POSITION_STEP = int(os.getenv("PATCH_CACHE_POSITION_STEP", "4"))    # 裁剪位置的量化步长 (像素)
+PATCH_CACHE_MIN_MARGIN = float(os.getenv("PATCH_CACHE_MIN_MARGIN", "1.0"))      # 近似命中时只复用最大两类 logits 之差不低于该值的结果
 
 # --- 模型加载 (单例模式) ---
+def _load_state_dict(path: str) -> dict:
+    """
+    加载模型权重。在 CPU 上以内存映射 (mmap) 方式读取，配合 ``load_state_dict(assign=True)``
+    让参数直接引用映射的文件页，多个进程加载同一权重文件时共享操作系统的页缓存而不是各自复制一份。
+    """
+    if DEVICE.type == "cpu":
+        try:
+            return torch.load(path, map_location=DEVICE, weights_only=True, mmap=True)
+        except RuntimeError as e:
+            # 旧的 (非 zip) 序列化格式不支持 mmap，退回到普通读取
+            if "mmap" not in str(e):
+                raise
+    return torch.load(path, map_location=DEVICE, weights_only=True)
+
+
+def _build_with_state_dict(build, state_dict: dict) -> torch.nn.Module:
+    """
+    在 meta 设备上构建模型结构 (不分配内存、不做随机初始化)，再以 ``assign=True`` 直接接管权重张量。
+    模型含有不在权重文件中的张量 (非持久 buffer) 时退回到普通构建方式。
+    """
+    with torch.device("meta"):
+        model = build()
+    model.load_state_dict(state_dict, assign=True)
+    if any(tensor.is_meta for tensor in (*model.parameters(), *model.buffers())):
+        model = build()
+        model.load_state_dict(state_dict, assign=True)
+    return model.to(DEVICE).eval()
+
+
+def _load_unet() -> torch.nn.Module:
+    unet_state_dict = _load_state_dict(UNET_MODEL_PATH)
+    is_bilinear = 'up1.up.weight' not in unet_state_dict
+    unet_model = _build_with_state_dict(lambda: UNet(n_channels=1, n_classes=1, bilinear=is_bilinear), unet_state_dict)
+    logger.info("U-Net 模型加载成功。")
+    return unet_model
+
+
+def _load_cnn() -> torch.nn.Module:
+    from cnn_classifier_model import get_classifier_model
+
+    # 权重随即被检查点覆盖，不下载 ImageNet 预训练权重
+    cnn_model = _build_with_state_dict(lambda: get_classifier_model(pretrained=False), _load_state_dict(CNN_MODEL_PATH))
+    logger.info("CNN 分类器加载成功。")
+    return cnn_model
+
+
+def load_fp32_models(profile: dict | None = None) -> tuple[torch.nn.Module, torch.nn.Module]:
+    """
+    从权重文件加载 fp32 的 U-Net 与 CNN 分类器 (eager 模式)。
+    两个模型在两个线程中并行加载 (CNN 的耗时主要在于导入 torchvision)，``profile`` 中记录各自的耗时。
+    """
+    def timed(stage, load):
+        with stage_timer(profile, stage):
+            return load()
+
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="model-load") as executor:
+        unet_future = executor.submit(timed, "unet_load", _load_unet)
+        cnn_future = executor.submit(timed, "cnn_load", _load_cnn)
+        return unet_future.result(), cnn_future.result()
+
+
 def _load_models_singleton():
     """使用单例模式加载U-Net和CNN模型，避免Web服务中每次请求都重新加载。"""
-    unet_model, cnn_model, cnn_transform = None, None, None
+    unet_model, cnn_model = None, None
+
+    def _install(shared_unet, shared_cnn):
+        """直接使用外部 (如主进程共享内存中) 已加载好的模型，跳过本进程的加载。"""
+        nonlocal unet_model, cnn_model
+        unet_model, cnn_model = shared_unet, shared_cnn
 
-    def _load():
-        nonlocal unet_model, cnn_model, cnn_transform
+    def _load(profile: dict | None = None):
+        nonlocal unet_model, cnn_model
         if unet_model is None or cnn_model is None:
-            print(f"--- 准备加载模型到设备: {DEVICE} ---")
+            logger.info(f"准备加载模型到设备: {DEVICE}")
             try:
-                # 1. 加载 U-Net 模型
-                unet_state_dict = torch.load(UNET_MODEL_PATH, map_location=DEVICE, weights_only=True)
-                is_bilinear = 'up1.up.weight' not in unet_state_dict
-                unet_model = UNet(n_channels=1, n_classes=1, bilinear=is_bilinear)
-                unet_model.load_state_dict(unet_state_dict)
-                unet_model.to(DEVICE)
-                unet_model.eval()
-                print("--- U-Net 模型加载成功 ---")
-
-                # 2. 加载 CNN 分类器
-                cnn_model = get_classifier_model()
-                cnn_model.load_state_dict(torch.load(CNN_MODEL_PATH, map_location=DEVICE, weights_only=True))
-                cnn_model.to(DEVICE)
-                cnn_model.eval()
-                print("--- CNN 分类器加载成功 ---")
-
-                # 3. 定义 CNN 输入预处理 (与训练阶段保持一致)
-                cnn_transform = transforms.Compose([
-                    transforms.ToPILImage(),
-                    transforms.Grayscale(num_output_channels=3),
-                    transforms.ToTensor(),
-                    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-                ])
+                # 已导出的后端文件与当前权重一致时直接加载，跳过 fp32 模型
+                with stage_timer(profile, "backend"):
+                    exported = load_exported_models(INFERENCE_BACKEND, EXPORT_DIR, DEVICE)
+                if exported is not None:
+                    unet_model, cnn_model = exported
+                    logger.info(f"已加载导出的 {INFERENCE_BACKEND} 模型。")
+                    return unet_model, cnn_model
+                unet_model, cnn_model = load_fp32_models(profile)
+                # 3. 转换为配置的推理后端
+                if INFERENCE_BACKEND != "eager" or CHANNELS_LAST:
+                    with stage_timer(profile, "backend"):
+                        unet_model, cnn_model = prepare_models(unet_model, cnn_model, INFERENCE_BACKEND, EXPORT_DIR,
+                                                               CHANNELS_LAST)
+                    logger.info(f"已切换到推理后端: {INFERENCE_BACKEND}")
 
             except Exception as e:
-                print(f"--- 模型加载失败: {e} ---")
+                logger.error(f"模型加载失败: {e}", exc_info=True)
                 unet_model, cnn_model = None, None
-        return unet_model, cnn_model, cnn_transform
-    return _load
+        return unet_model, cnn_model
+    return _load, _install
+
+get_models, _install_models = _load_models_singleton()
+
+
+def get_model_version() -> str:
+    """根据权重文件的大小与修改时间生成模型版本标识，权重文件更新后该标识随之改变。"""
+    parts = []
+    for path in (UNET_MODEL_PATH, CNN_MODEL_PATH):
+        try:
+            stat = os.stat(path)
+            parts.append(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}")
+        except OSError:
+            parts.append(f"{os.path.basename(path)}:missing")
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()[:12]
 
-get_models = _load_models_singleton()
+
+def pipeline_signature() -> str:
+    """模型版本与全部预处理/后处理参数的组合，用于结果缓存的键，参数变化时缓存自动失效。"""
+    return "|".join(str(part) for part in (
+        get_model_version(), INFERENCE_BACKEND, TARGET_IMG_SIZE, WINDOW_LEVEL, WINDOW_WIDTH,
+        UNET_THRESHOLD, WATERSHED_MIN_DISTANCE, PATCH_SIZE, MIN_CONTOUR_AREA, MIN_CONTOUR_POINTS,
+        UNET_INFERENCE_MODE, UNET_TILE_OVERLAP, LUNG_GATE_ENABLED, LUNG_GATE_MIN_FRACTION, LUNG_ROI_BUCKETS,
+        PATCH_CACHE_MAX_ENTRIES > 0 and (PATCH_CACHE_HASH_SIZE, PATCH_CACHE_LEVELS, PATCH_CACHE_POSITION_STEP,
+                                         PATCH_CACHE_MIN_MARGIN),
+    ))
+
+
+def share_models() -> tuple[torch.nn.Module | None, torch.nn.Module | None]:
+    """
+    加载模型并将其权重移入共享内存，返回可传给工作进程的模型。
+    通过 torch.multiprocessing 传递时，子进程只获得共享内存的句柄，不会复制权重。
+    非 eager 后端 (TorchScript / ONNX / 量化模型) 无法跨进程传递，返回 (None, None)，由各工作进程自行加载。
+    """
+    if INFERENCE_BACKEND != "eager":
+        return None, None
+    unet_model, cnn_model = get_models()
+    if unet_model is None or cnn_model is None:
+        raise RuntimeError("模型未加载，无法共享。")
+    if DEVICE.type == "cpu":
+        unet_model.share_memory()
+        cnn_model.share_memory()
+    return unet_model, cnn_model
+
+
+def init_worker_process(unet_model=None, cnn_model=None, num_threads: int | None = None,
+                        warmup_batch_sizes: tuple[list[int], list[int]] | None = None, report_queue=None,
+                        log_config: dict | None = None):
+    """
+    推理工作进程的初始化函数。
+    - 按 ``log_config`` (configure_logging 的参数) 配置日志，工作进程的日志与主进程格式相同；
+    - 限制每个进程的 torch 线程数，避免多个进程争抢 CPU 核心，并固定内存分配器设置 (见 configure_runtime)；
+    - 若传入了主进程共享的模型则直接使用，否则在本进程中自行加载；
+    - 传入 ``warmup_batch_sizes`` (U-Net 批大小, CNN 批大小) 时在接收任务之前预热；
+    - 运行时设置与预热耗时放入 ``report_queue`` (multiprocessing 队列)，主进程据此确认所有工作进程已就绪。
+    """
+    if log_config is not None:
+        configure_logging(**log_config)
+    runtime = configure_runtime(num_threads)
+    if unet_model is not None and cnn_model is not None:
+        _install_models(unet_model, cnn_model)
+    else:
+        get_models()
+    timings = warm_up(*warmup_batch_sizes) if warmup_batch_sizes is not None else None
+    if report_queue is not None:
+        report_queue.put({"pid": os.getpid(), "runtime": runtime, "timings": timings})
+
+
+# --- 运行时设置与预热 ---
+def _retain_malloc_memory() -> bool:
+    """
+    调整 glibc malloc：不使用 mmap 分配大块内存，将归还操作系统的阈值提高到 MALLOC_TRIM_THRESHOLD_MB，
+    并让所有线程共用一个 arena。
+    U-Net 的特征图 (512x512x64 的 float32 即 64 MB) 远大于 mmap 阈值 (glibc 最多只能调到 32 MB)，默认每次前向都重新 mmap、
+    首次写入时逐页缺页 (每张切片数十万次)，释放时又归还操作系统；保留在堆中后，预热分配的内存在稳态下被直接复用。
+    代价是常驻内存：堆顶不超过阈值的空闲内存不再归还，堆中间的空闲块 (碎片) 也一直保留，
+    因此默认关闭，开启前用 benchmark.py 对比 rss_mb。
+    默认每个线程使用各自的 arena，预热线程保留的内存无法被推理线程复用，因此只保留一个 arena
+    (大块分配的次数很少，锁竞争可以忽略)。非 glibc 平台返回 False。
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+        mallopt = libc.mallopt
+    except (OSError, AttributeError):
+        return False
+    m_trim_threshold, m_mmap_max, m_arena_max = -1, -4, -8
+    trim_threshold = min(MALLOC_TRIM_THRESHOLD_MB * 1024 * 1024, 2 ** 31 - 1)
+    return (bool(mallopt(m_mmap_max, 0)) and bool(mallopt(m_trim_threshold, trim_threshold))
+            and bool(mallopt(m_arena_max, 1)))
+
+
+def configure_runtime(num_threads: int | None = None) -> dict:
+    """
+    固定稳态下的 torch 线程池与内存分配器设置，返回实际生效的设置。应在执行推理之前调用。
+    ``num_threads`` (工作进程的线程数) 为空时使用 TORCH_NUM_THREADS。
+    """
+    num_threads = num_threads or TORCH_NUM_THREADS
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if TORCH_INTEROP_THREADS and torch.get_num_interop_threads() != TORCH_INTEROP_THREADS:
+        try:
+            torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
+        except RuntimeError:
+            pass  # inter-op 线程池已经启动，只能在进程启动时设置
+    return {
+        "num_threads": torch.get_num_threads(),
+        "interop_threads": torch.get_num_interop_threads(),
+        "malloc_retain": MALLOC_RETAIN and _retain_malloc_memory(),
+    }
+
+
+def warm_up(unet_batch_sizes: list[int], cnn_batch_sizes: list[int],
+            iterations: int = WARMUP_ITERATIONS) -> dict:
+    """
+    以合成输入在每个批大小上执行 U-Net 与 CNN 前向，完成算子实现的选择与内存的首次分配 (首次前向明显慢于稳态)。
+    U-Net 的每个批大小覆盖整张图像与肺野门控的各个裁剪尺寸 (见 lung_roi_sizes)。
+    批大小从大到小执行，最大批次分配的内存随后被较小的批次复用。
+    返回各次前向的耗时 (秒): {"unet": {批大小: [...]}, "cnn": {批大小: [...]}}。
+    """
+    unet, cnn_classifier = get_models()
+    if unet is None or cnn_classifier is None:
+        raise RuntimeError("模型未加载，无法预热。")
+    generator = torch.Generator().manual_seed(0)
+    timings = {"unet": {}, "cnn": {}}
+    for batch_size in sorted(set(unet_batch_sizes), reverse=True):
+        input_tensors = [torch.rand((1, 1, *TARGET_IMG_SIZE), generator=generator).to(DEVICE) for _ in range(batch_size)]
+        timings["unet"][batch_size] = []
+        for size in [None, *(lung_roi_sizes() if LUNG_GATE_ENABLED else [])]:
+            rois = None if size is None else [(0, size, 0, size)] * batch_size
+            for _ in range(iterations):
+                start = time.perf_counter()
+                _forward_unet(unet, input_tensors, rois)
+                timings["unet"][batch_size].append(time.perf_counter() - start)
+    patches = list(torch.rand((max(cnn_batch_sizes, default=0), PATCH_SIZE, PATCH_SIZE), generator=generator).numpy())
+    for batch_size in sorted(set(cnn_batch_sizes), reverse=True):
+        timings["cnn"][batch_size] = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            _patch_logits(cnn_classifier, patches[:batch_size], batch_size)
+            timings["cnn"][batch_size].append(time.perf_counter() - start)
+    return timings
 
 
 # --- 核心图像处理与预测 ---
 
-def _apply_windowing(image, window_center, window_width):
-    """对原始像素值应用窗宽窗位设置"""
-    min_value = window_center - window_width / 2
-    max_value = window_center + window_width / 2
-    image = np.clip(image, min_value, max_value)
+def _is_tiled(shape) -> bool:
+    """分块模式下，长或宽超过 TARGET_IMG_SIZE 的图像保持原始分辨率，以滑动窗口推理。"""
+    return UNET_INFERENCE_MODE == "tiled" and (shape[-2] > TARGET_IMG_SIZE[1] or shape[-1] > TARGET_IMG_SIZE[0])
+
+
+# 图像来源: 上传内容 (字节) 或已落盘的上传文件路径 (见 ingest.py)
+ImageSource = bytes | str | os.PathLike
+
+
+def _open_source(source: ImageSource):
+    return BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+
+
+def read_dicom_header(source: ImageSource) -> pydicom.Dataset | None:
+    """只解析 DICOM 头 (在像素数据之前停止读取)；不是带图像的 DICOM 时返回 None。"""
+    try:
+        header = pydicom.dcmread(_open_source(source), stop_before_pixels=True, force=True)
+    except Exception:
+        # force=True 时非 DICOM 内容可能引发各种解析错误，统一视为常规图像
+        return None
+    if "Rows" not in header or "Columns" not in header:
+        return None
+    return header
+
+
+def count_frames(source: ImageSource) -> int:
+    """返回文件中的帧数：多帧 DICOM 为 NumberOfFrames，其余为 1。"""
+    header = read_dicom_header(source)
+    if header is None:
+        return 1
+    return int(header.get("NumberOfFrames") or 1)
+
+
+def _rescale_params(header: pydicom.Dataset, frame: int) -> tuple[float, float]:
+    """返回 (RescaleSlope, RescaleIntercept)；Enhanced CT 的换算参数位于每帧或共享的功能组序列中。"""
+    if "RescaleSlope" in header or "RescaleIntercept" in header:
+        return float(header.get("RescaleSlope", 1)), float(header.get("RescaleIntercept", 0))
+    for sequence, index in (("PerFrameFunctionalGroupsSequence", frame), ("SharedFunctionalGroupsSequence", 0)):
+        groups = header.get(sequence)
+        if groups and index < len(groups) and "PixelValueTransformationSequence" in groups[index]:
+            transform = groups[index].PixelValueTransformationSequence[0]
+            return float(transform.get("RescaleSlope", 1)), float(transform.get("RescaleIntercept", 0))
+    return 1.0, 0.0
+
+
+def _decode_frame(source: ImageSource, frame: int, num_frames: int) -> np.ndarray:
+    """只解码指定的一帧；多帧文件的其余帧不会被读入内存。"""
+    if iter_pixels is not None:
+        return next(iter_pixels(_open_source(source), indices=[frame]))
+    # pydicom 2 没有按帧解码的接口，退回到完整解码
+    pixel_array = pydicom.dcmread(_open_source(source), force=True).pixel_array
+    return pixel_array[frame] if num_frames > 1 else pixel_array
+
+
+def _window_arithmetic(image: np.ndarray, slope: float, intercept: float) -> np.ndarray:
+    """在 float32 数组 ``image`` 上原地完成 HU 换算、肺窗截断与归一化。"""
+    min_val = WINDOW_LEVEL - WINDOW_WIDTH / 2
+    max_val = WINDOW_LEVEL + WINDOW_WIDTH / 2
+    if slope != 1:
+        image *= np.float32(slope)
+    if intercept != 0:
+        image += np.float32(intercept)
+    np.clip(image, min_val, max_val, out=image)
+    image -= np.float32(min_val)
+    image /= np.float32(max_val - min_val)
     return image
 
-def _preprocess_image(image_bytes: bytes) -> tuple[torch.Tensor | None, np.ndarray | None, tuple[int, int]]:
+
+def _has_lut(dtype: np.dtype) -> bool:
+    """8/16 位整数像素走查找表路径。"""
+    return dtype.kind in "ui" and dtype.itemsize <= 2
+
+
+@lru_cache(maxsize=32)
+def _window_lut(dtype: str, slope: float, intercept: float) -> np.ndarray:
+    """
+    8/16 位整数像素值到归一化肺窗值的查找表，按像素值的无符号解释排列 (有符号类型以 view 作索引)。
+    表中的值与逐像素计算 (_window_arithmetic) 逐位一致。
+    """
+    dtype = np.dtype(dtype)
+    values = np.arange(1 << (8 * dtype.itemsize), dtype=f"u{dtype.itemsize}").view(dtype)
+    return _window_arithmetic(values.astype(np.float32), slope, intercept)
+
+
+@lru_cache(maxsize=1)
+def _unit_lut() -> np.ndarray:
+    """8 位灰度到 [0, 1] 的查找表 (常规图像)。"""
+    return (np.arange(256) / 255.0).astype(np.float32)
+
+
+_scratch_buffers = threading.local()
+
+
+def _scratch(name: str, shape: tuple[int, ...], dtype) -> np.ndarray:
+    """返回当前线程可复用的缓冲区 (形状或类型变化时重新分配)；内容在下次调用前有效，不能被返回给调用方。"""
+    buffers = _scratch_buffers.__dict__
+    buffer = buffers.get(name)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = buffers[name] = np.empty(shape, dtype)
+    return buffer
+
+
+def _apply_lut(pixels: np.ndarray, lut: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """按 ``lut`` 映射整数像素并写入 ``out``。8 位用 cv2.LUT；16 位分块查表，索引缓冲区在线程内复用。"""
+    unsigned = pixels.view(f"u{pixels.dtype.itemsize}")
+    if pixels.dtype.itemsize == 1:
+        return cv2.LUT(unsigned, lut, dst=out)
+    flat_pixels, flat_out = unsigned.reshape(-1), out.reshape(-1)
+    index = _scratch("lut_index", (min(LUT_CHUNK_SIZE, flat_pixels.size),), np.intp)
+    for start in range(0, flat_pixels.size, LUT_CHUNK_SIZE):
+        chunk = index[:min(LUT_CHUNK_SIZE, flat_pixels.size - start)]
+        np.copyto(chunk, flat_pixels[start:start + chunk.size], casting="unsafe")
+        np.take(lut, chunk, out=flat_out[start:start + chunk.size], mode="clip")  # 索引总在表内，clip 模式不缓冲 out
+    return out
+
+
+def _rescale_and_window(pixels: np.ndarray, slope: float, intercept: float, out: np.ndarray | None = None) -> np.ndarray:
+    """
+    HU 换算、肺窗截断与归一化，结果写入 float32 数组 ``out`` (默认新分配)，不产生 HU、窗口化等中间副本。
+    8/16 位整数像素 (CT 的常见情况) 通过查找表一次完成；其余类型在 ``out`` 上原地逐步计算。两条路径结果逐位一致。
+    """
+    if out is None:
+        out = np.empty(pixels.shape, np.float32)
+    if _has_lut(pixels.dtype):
+        return _apply_lut(pixels, _window_lut(pixels.dtype.str, float(slope), float(intercept)), out)
+    np.copyto(out, pixels, casting="unsafe")
+    return _window_arithmetic(out, slope, intercept)
+
+
+def _input_buffer(shape: tuple[int, ...]) -> np.ndarray:
+    """
+    分配模型输入图像的 float32 缓冲区；使用 GPU 时为锁页内存，可异步拷贝到显存。
+    该缓冲区会被返回的 Tensor 与 numpy 图像共享 (在微批处理队列和序列会话中保存)，因此每张切片单独分配，不复用。
+    """
+    if DEVICE.type == "cuda":
+        return torch.empty(shape, dtype=torch.float32, pin_memory=True).numpy()
+    return np.empty(shape, np.float32)
+
+
+def _fill_frame(pixels: np.ndarray, fill) -> np.ndarray:
+    """
+    将解码后的像素经 ``fill(pixels, out)`` (窗宽窗位或灰度归一化) 写入模型输入缓冲区，并在需要时缩放。
+    无需缩放 (尺寸已是 TARGET_IMG_SIZE 或分块模式) 时直接写入输入缓冲区；
+    否则先写入线程内复用的原始分辨率缓冲区，再由 cv2.resize 直接缩放到输入缓冲区。每张切片只分配一个输入缓冲区。
+    """
+    target_shape = (TARGET_IMG_SIZE[1], TARGET_IMG_SIZE[0], *pixels.shape[2:])
+    if _is_tiled(pixels.shape[:2]) or pixels.shape == target_shape:
+        return fill(pixels, _input_buffer(pixels.shape))
+    frame = fill(pixels, _scratch("frame", pixels.shape, np.float32))
+    return cv2.resize(frame, TARGET_IMG_SIZE, dst=_input_buffer(target_shape), interpolation=cv2.INTER_LINEAR)
+
+
+def preprocess_image(source: ImageSource, frame: int = 0,
+                     profile: dict | None = None) -> tuple[torch.Tensor | None, np.ndarray | None, tuple[int, int]]:
     """
     预处理图像，优先处理DICOM，并应用肺窗；若失败则按常规图像处理。
-    返回处理后的Tensor、用于提取patch的numpy图像和原始图像尺寸。
+    ``source`` 可以是文件内容 (字节) 或文件路径；多帧 DICOM 只解码第 ``frame`` 帧。
+    返回处理后的Tensor、用于提取patch的numpy图像 (与Tensor共享同一 float32 缓冲区) 和原始图像尺寸。
+    传入 ``profile`` 时记录 decode (解码) 与 preprocess (窗宽窗位、缩放等) 两个阶段的耗时，
+    以及 DICOM 的 SOPInstanceUID 与 SeriesInstanceUID (选择 patch 缓存的序列)。
     """
-    original_size = (0, 0)
-    image_for_tensor = None
+    return _preprocess_image(source, frame, profile)[:3]
 
-    try:
+
+def _preprocess_image(source: ImageSource, frame: int = 0, profile: dict | None = None):
+    """与 preprocess_image 相同，另外返回输入是否为 DICOM (像素为 HU 值，可做肺野门控)。"""
+    with stage_timer(profile, "decode"):
+        header = read_dicom_header(source)
+
+    if header is not None:
         # --- 1. 专业DICOM处理流程 ---
-        dcm = pydicom.dcmread(BytesIO(image_bytes), force=True)
-        pixel_array = dcm.pixel_array
+        num_frames = int(header.get("NumberOfFrames") or 1)
+        if not 0 <= frame < num_frames:
+            raise ValueError(f"帧序号 {frame} 超出范围 (共 {num_frames} 帧)。")
+        if profile is not None and "SOPInstanceUID" in header:
+            profile["slice_uid"] = str(header.SOPInstanceUID)  # 用于日志关联 (多帧文件的各帧共用同一个 UID)
+        if profile is not None and "SeriesInstanceUID" in header:
+            profile["series_uid"] = str(header.SeriesInstanceUID)
+        with stage_timer(profile, "decode"):
+            pixel_array = _decode_frame(source, frame, num_frames)
         original_size = (pixel_array.shape[1], pixel_array.shape[0]) # (宽, 高)
 
-        slope = getattr(dcm, 'RescaleSlope', 1)
-        intercept = getattr(dcm, 'RescaleIntercept', 0)
-        image_hu = pixel_array.astype(np.float32) * slope + intercept
-        image_windowed = _apply_windowing(image_hu, WINDOW_LEVEL, WINDOW_WIDTH)
-
-        min_val = WINDOW_LEVEL - WINDOW_WIDTH / 2
-        max_val = WINDOW_LEVEL + WINDOW_WIDTH / 2
-        image_normalized = (image_windowed - min_val) / (max_val - min_val)
-        
-        image_for_tensor = image_normalized
+        with stage_timer(profile, "preprocess"):
+            slope, intercept = _rescale_params(header, frame)
+            resized_image = _fill_frame(
+                pixel_array, lambda pixels, out: _rescale_and_window(pixels, slope, intercept, out))
 
-    except pydicom.errors.InvalidDicomError:
+    else:
         # --- 2. 常规图像处理流程 ---
-        print("非DICOM格式，尝试作为常规图像文件处理。")
-        image_buffer = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(image_buffer, cv2.IMREAD_GRAYSCALE)
+        logger.debug("非DICOM格式，尝试作为常规图像文件处理。")
+        if frame != 0:
+            raise ValueError(f"帧序号 {frame} 超出范围 (共 1 帧)。")
+        with stage_timer(profile, "decode"):
+            if isinstance(source, (bytes, bytearray)):
+                image_buffer = np.frombuffer(source, np.uint8)
+            else:
+                image_buffer = np.fromfile(source, np.uint8)
+            img = cv2.imdecode(image_buffer, cv2.IMREAD_GRAYSCALE)
         if img is None:
-            print("无法解码常规图像。")
-            return None, None, (0, 0)
+            logger.warning("无法解码常规图像。")
+            return None, None, (0, 0), False
         original_size = (img.shape[1], img.shape[0])
-        image_for_tensor = img / 255.0
-    
-    if image_for_tensor is None:
-        return None, None, (0, 0)
-
-    # --- 3. 统一处理：调整大小并转换为Tensor ---
-    if image_for_tensor.shape[:2] != TARGET_IMG_SIZE:
-        resized_image = cv2.resize(image_for_tensor, TARGET_IMG_SIZE, interpolation=cv2.INTER_LINEAR)
-    else:
-        resized_image = image_for_tensor
-    
-    tensor = torch.from_numpy(resized_image).float().unsqueeze(0).unsqueeze(0).to(DEVICE)
-    
-    return tensor, resized_image, original_size
+        with stage_timer(profile, "preprocess"):
+            resized_image = _fill_frame(img, lambda pixels, out: _apply_lut(pixels, _unit_lut(), out))
+
+    # --- 3. 统一处理：转换为Tensor (与 numpy 图像共享缓冲区，不复制) ---
+    with stage_timer(profile, "preprocess"):
+        tensor = image_to_tensor(resized_image)
+
+    return tensor, resized_image, original_size, header is not None
+
 
+def image_to_tensor(image: np.ndarray) -> torch.Tensor:
+    """
+    将预处理后的 (模型输入尺寸) 图像转换为 U-Net 输入张量 (1, 1, H, W)；float32 图像不复制，只读数组 (如内存映射) 会被复制。
+    锁页内存中的图像异步拷贝到 GPU。
+    """
+    if not image.flags.writeable:
+        image = np.array(image)
+    return torch.from_numpy(image).float().unsqueeze(0).unsqueeze(0).to(DEVICE, non_blocking=True)
+
+
+def _centered_span(start: int, stop: int, size: int, length: int) -> tuple[int, int]:
+    """以 [start, stop) 为中心、长为 ``size`` (不超过 length) 的区间，并保持在图像内。"""
+    start = min(max(0, start - (size - (stop - start)) // 2), length - size)
+    return start, start + size
+
+
+def lung_roi_sizes(shape: tuple[int, int] = (TARGET_IMG_SIZE[1], TARGET_IMG_SIZE[0])) -> list[int]:
+    """``shape`` 的图像可能使用的正方形裁剪边长 (从大到小，不含整张图像)，用于预热。"""
+    return [size for size in reversed(LUNG_ROI_BUCKETS) if size < min(shape)]
+
+
+def lung_gate(image: np.ndarray, hounsfield: bool = True,
+              profile: dict | None = None) -> tuple[int, int, int, int] | None:
+    """
+    肺野门控：返回送入 U-Net 的区域 (y0, y1, x0, x1)；肺野面积可忽略时返回 None，整张切片跳过 U-Net。
+    区域为覆盖肺野掩码 (已含边缘余量) 外接矩形的正方形，边长取 LUNG_ROI_BUCKETS 中的档位，放不下时为整张图像；
+    分块模式下由 tile 自行跳过肺野外区域，不再裁剪。
+    关闭门控或 ``hounsfield`` 为 False (常规图像的灰度不是 HU，肺窗阈值没有意义) 时总是返回整张图像。
+    传入 ``profile`` 时记录耗时与跳过的切片/像素数。
+    """
+    height, width = image.shape[:2]
+    roi = (0, height, 0, width)
+    if not LUNG_GATE_ENABLED or not hounsfield:
+        return roi
+    from lung import lung_mask
+
+    with stage_timer(profile, "lung_gate"):
+        mask = lung_mask(image)
+        if mask.mean() < LUNG_GATE_MIN_FRACTION:
+            roi = None
+        elif not _is_tiled(image.shape):
+            rows = np.flatnonzero(mask.any(axis=1))
+            cols = np.flatnonzero(mask.any(axis=0))
+            extent = max(int(rows[-1]) + 1 - int(rows[0]), int(cols[-1]) + 1 - int(cols[0]))
+            size = next((size for size in reversed(lung_roi_sizes((height, width))) if size >= extent), None)
+            if size is not None:
+                roi = (*_centered_span(int(rows[0]), int(rows[-1]) + 1, size, height),
+                       *_centered_span(int(cols[0]), int(cols[-1]) + 1, size, width))
+    if profile is not None:
+        kept = 0 if roi is None else (roi[1] - roi[0]) * (roi[3] - roi[2])
+        profile["lung_gate"] = {"skipped": roi is None, "pixels": height * width, "pixels_skipped": height * width - kept}
+    return roi
+
+
+def preprocess_slice(source: ImageSource, frame: int = 0, profile: dict | None = None):
+    """
+    preprocess_image 加肺野门控 (只对 DICOM)，返回 (Tensor, numpy 图像, 原始尺寸, U-Net 区域)；
+    区域为 None 表示跳过 U-Net。
+    """
+    input_tensor, resized_image_np, original_size, is_dicom = _preprocess_image(source, frame, profile=profile)
+    if input_tensor is None:
+        return None, None, original_size, None
+    return input_tensor, resized_image_np, original_size, lung_gate(resized_image_np, is_dicom, profile=profile)
+
+
+# --- 后处理参数 ---
+def postprocess_params(**overrides) -> dict:
+    """
+    返回后处理参数：默认值取自上面的模块常量，``overrides`` 中不为 None 的项覆盖默认值。
+    这些参数只影响 U-Net 之后的阶段，修改它们不需要重新执行 U-Net。
+    """
+    params = {
+        "unet_threshold": UNET_THRESHOLD,
+        "min_distance": WATERSHED_MIN_DISTANCE,
+        "patch_size": PATCH_SIZE,
+        "min_contour_area": MIN_CONTOUR_AREA,
+        "min_contour_points": MIN_CONTOUR_POINTS,
+    }
+    for name, value in overrides.items():
+        if name not in params:
+            raise TypeError(f"未知的后处理参数: {name}")
+        if value is not None:
+            params[name] = value
+    return params
+
+
+def _watershed_labels(binary_mask: np.ndarray, min_distance: int) -> np.ndarray:
+    """
+    分水岭分割，结果与在整张图上依次执行 distance_transform_edt / peak_local_max / watershed 逐像素相同，
+    但只在前景所在的区域内计算:
+    - 连通域内像素的最近背景点一定落在外扩 1 像素的外接矩形内，因此距离变换逐连通域在外接矩形内计算；
+    - peak_local_max 的峰值间距约束会跨连通域生效，仍在拼好的整张距离图上执行一次；
+    - 分水岭的种子同时入队、相同高度时按堆中顺序出队，结果依赖所有种子的相对顺序，
+      因此在全部前景的外接矩形上执行一次 (保持种子的光栅顺序)，而不是逐连通域执行。
+    """
+    from skimage.feature import peak_local_max
+    from skimage.segmentation import watershed
+
+    components, _ = ndimage.label(binary_mask)
+    boxes = ndimage.find_objects(components)
+    distance = np.zeros(binary_mask.shape)
+    for index, (rows, cols) in enumerate(boxes, start=1):
+        box = (slice(max(rows.start - 1, 0), rows.stop + 1), slice(max(cols.start - 1, 0), cols.stop + 1))
+        inside = components[box] == index
+        distance[box][inside] = ndimage.distance_transform_edt(inside)[inside]
 
-def _extract_patches_with_watershed(original_image, prob_map, patch_size=64, min_distance=10):
-    """使用分水岭算法对 U-Net 概率图进行连通域分割，提取候选 patch"""
-    binary_mask = prob_map > 0.5
-    distance = ndimage.distance_transform_edt(binary_mask)
     coords = peak_local_max(distance, min_distance=min_distance, labels=binary_mask)
-    mask = np.zeros(distance.shape, dtype=bool)
+    peaks = np.zeros(binary_mask.shape, dtype=bool)
     if coords.size > 0:
-        mask[tuple(coords.T)] = True
-    markers, _ = ndimage.label(mask)
-    labels = watershed(-distance, markers, mask=binary_mask)
+        peaks[tuple(coords.T)] = True
+    markers, _ = ndimage.label(peaks)
+
+    labels = np.zeros(binary_mask.shape, dtype=markers.dtype)
+    if boxes:
+        box = (slice(min(rows.start for rows, _ in boxes), max(rows.stop for rows, _ in boxes)),
+               slice(min(cols.start for _, cols in boxes), max(cols.stop for _, cols in boxes)))
+        labels[box] = watershed(-distance[box], markers[box], mask=binary_mask[box])
+    return labels
+
+
+def _extract_patches_with_watershed(original_image, prob_map, patch_size=PATCH_SIZE, min_distance=WATERSHED_MIN_DISTANCE,
+                                    output_size=PATCH_SIZE, threshold=UNET_THRESHOLD):
+    """
+    使用分水岭算法对 U-Net 概率图进行连通域分割，提取候选 patch。
+    返回 (分水岭标签图, 候选列表)，候选见 _region_patches。
+    """
+    labels = _watershed_labels(prob_map > threshold, min_distance)
+    return labels, _region_patches(original_image, labels, patch_size, output_size)
+
+
+def _region_patches(original_image, labels, patch_size=PATCH_SIZE, output_size=PATCH_SIZE) -> list[dict]:
+    """
+    为标签图中的每个区域提取候选 patch，按标签值排序。候选包含 patch、标签值、bbox (min_r, min_c, max_r, max_c)、
+    面积以及裁剪位置 origin (左上角行、列)。
+    以区域质心为中心裁剪 ``patch_size`` 的 patch (靠近图像边缘时平移到图像内)，尺寸不等于 ``output_size`` 时缩放
+    (分块模式下高分辨率图像的 patch 按比例放大裁剪)。
+    """
+    boxes = ndimage.find_objects(labels)
+    if not boxes:
+        return []
+
+    # 面积与质心一次性统计 (整数坐标求和是精确的，与 regionprops 的结果逐位相同)
+    pixels = np.flatnonzero(labels)
+    ids = labels.ravel()[pixels]
+    rows, cols = np.divmod(pixels, labels.shape[1])
+    areas = np.bincount(ids, minlength=len(boxes) + 1)
+    present = np.flatnonzero(areas[1:]) + 1
+    center_y = np.bincount(ids, weights=rows, minlength=len(boxes) + 1)[present] / areas[present]
+    center_x = np.bincount(ids, weights=cols, minlength=len(boxes) + 1)[present] / areas[present]
+
+    half_size = patch_size // 2
+    start_y = np.clip(center_y.astype(int) - half_size, 0, original_image.shape[0] - patch_size)
+    start_x = np.clip(center_x.astype(int) - half_size, 0, original_image.shape[1] - patch_size)
+    windows = np.lib.stride_tricks.sliding_window_view(original_image, (patch_size, patch_size))
+    patch_imgs = windows[start_y, start_x]
+    if patch_size != output_size:
+        from skimage import transform
+
+        patch_imgs = [transform.resize(patch_img, (output_size, output_size), anti_aliasing=True, preserve_range=True)
+                      for patch_img in patch_imgs]
 
     patches = []
-    for region in measure.regionprops(labels):
-        center_y, center_x = region.centroid
-        half_size = patch_size // 2
-        start_x = max(0, int(center_x) - half_size)
-        end_x = start_x + patch_size
-        start_y = max(0, int(center_y) - half_size)
-        end_y = start_y + patch_size
-        if end_x > original_image.shape[1]:
-            end_x = original_image.shape[1]
-            start_x = end_x - patch_size
-        if end_y > original_image.shape[0]:
-            end_y = original_image.shape[0]
-            start_y = end_y - patch_size
-        
-        patch_img = original_image[start_y:end_y, start_x:end_x]
-        
-        if patch_img.shape != (patch_size, patch_size):
-            patch_img = transform.resize(patch_img, (patch_size, patch_size), anti_aliasing=True, preserve_range=True)
-            
-        patches.append({'patch': patch_img, 'region': region})
+    for label, patch_img, y, x in zip(present, patch_imgs, start_y, start_x):
+        rows_slice, cols_slice = boxes[label - 1]
+        patches.append({
+            'patch': patch_img,
+            'label': int(label),
+            'bbox': (rows_slice.start, cols_slice.start, rows_slice.stop, cols_slice.stop),
+            'area': int(areas[label]),
+            'origin': (int(y), int(x)),
+        })
     return patches
 
 
-def run_prediction(image_bytes: bytes) -> list[dict]:
+def _scaled_sizes(shape: tuple[int, ...], min_distance: int, patch_size: int) -> tuple[int, int]:
+    """按图像相对 TARGET_IMG_SIZE 的比例缩放分水岭种子间距与 patch 裁剪尺寸，保证 CNN 看到的尺度与训练时一致。"""
+    scale = max(shape[:2]) / max(TARGET_IMG_SIZE)
+    return max(1, round(min_distance * scale)), round(patch_size * scale)
+
+
+def _watershed_candidates(resized_image_np: np.ndarray, unet_pred_prob: np.ndarray, threshold: float = UNET_THRESHOLD,
+                          min_distance: int = WATERSHED_MIN_DISTANCE,
+                          patch_size: int = PATCH_SIZE) -> tuple[np.ndarray, list[dict]]:
+    """分水岭分割并提取候选 patch；裁剪 ``patch_size`` (按分辨率缩放) 的区域，再缩放到 CNN 的输入尺寸 PATCH_SIZE。"""
+    min_distance, crop_size = _scaled_sizes(resized_image_np.shape, min_distance, patch_size)
+    return _extract_patches_with_watershed(resized_image_np, unet_pred_prob, patch_size=crop_size,
+                                           min_distance=min_distance, threshold=threshold)
+
+
+def _patches_to_tensor(patches: list[np.ndarray]) -> torch.Tensor:
     """
-    运行完整的两阶段预测流程（U-Net -> Watershed -> CNN Filter -> Post-processing）。
+    将一组候选 patch 向量化地转换为 CNN 输入张量 (N, 3, H, W)。
+    数值上与训练时的 ToPILImage -> Grayscale(3) -> ToTensor -> Normalize 完全一致，但不经过 PIL。
     """
-    unet, cnn_classifier, cnn_transform = get_models()
-    if unet is None or cnn_classifier is None:
-        print("模型未加载，跳过预测。")
-        return []
+    # 逐个量化到 uint8，保持与单张处理相同的截断行为 (patch 的 dtype 可能不同)
+    patches_u8 = np.stack([(patch * 255).astype(np.uint8) for patch in patches])
+    batch = torch.from_numpy(patches_u8).float().div_(255)
+    batch = batch.unsqueeze(1).expand(-1, 3, -1, -1)
+    mean = torch.tensor(CNN_NORM_MEAN, dtype=batch.dtype).view(1, 3, 1, 1)
+    std = torch.tensor(CNN_NORM_STD, dtype=batch.dtype).view(1, 3, 1, 1)
+    return ((batch - mean) / std).to(DEVICE)
 
-    # 1. 预处理图像
-    input_tensor, resized_image_np, original_size = _preprocess_image(image_bytes)
-    if input_tensor is None:
-        print("图像预处理失败，无法进行预测。")
+
+def _patch_logits(cnn_classifier, patches: list[np.ndarray], batch_size: int = CNN_BATCH_SIZE) -> np.ndarray:
+    """按批次对候选 patch 进行分类，返回 CNN 输出的 logits (N, 类别数)。"""
+    logits = []
+    with torch.no_grad():
+        for start in range(0, len(patches), batch_size):
+            batch_tensor = _patches_to_tensor(patches[start:start + batch_size])
+            logits.append(cnn_classifier(batch_tensor).float().cpu())
+    return torch.cat(logits).numpy()
+
+
+def _classify_patches(cnn_classifier, patches: list[np.ndarray], batch_size: int = CNN_BATCH_SIZE) -> np.ndarray:
+    """按批次对候选 patch 进行分类，返回每个 patch 的预测类别索引。"""
+    return _patch_logits(cnn_classifier, patches, batch_size).argmax(axis=1)
+
+
+# 每个进程一份 (进程模式下各工作进程各自缓存)
+_patch_cache = PatchLogitCache(PATCH_CACHE_MAX_ENTRIES, PATCH_CACHE_MAX_SERIES, PATCH_CACHE_HASH_SIZE,
+                               PATCH_CACHE_LEVELS, PATCH_CACHE_POSITION_STEP, PATCH_CACHE_MIN_MARGIN)
+
+
+# 每个分类器实例一个编号，作为缓存命名空间的一部分：换用其他模型 (_install_models、一致性检查切换后端) 后不会命中旧模型的结果
+_model_tokens: "weakref.WeakKeyDictionary[torch.nn.Module, int]" = weakref.WeakKeyDictionary()
+_model_token_counter = itertools.count()
+_model_tokens_lock = threading.Lock()
+
+
+def _patch_cache_namespace(cnn_classifier, series_uid: str) -> str:
+    with _model_tokens_lock:
+        token = _model_tokens.get(cnn_classifier)
+        if token is None:
+            token = _model_tokens[cnn_classifier] = next(_model_token_counter)
+    return f"{token}:{series_uid}"
+
+
+def patch_cache_stats() -> dict:
+    """当前进程中 patch 缓存的序列数与键数。"""
+    return _patch_cache.stats()
+
+
+def _cached_patch_logits(cnn_classifier, patches: list[np.ndarray], positions: list[tuple[int, int, int]],
+                         series_uid: str | None, profile: dict | None = None) -> np.ndarray:
+    """
+    与 _patch_logits 相同，但先查询 ``series_uid`` 的 patch 缓存，只把未命中的 patch 送入 CNN。
+    ``positions`` 为各 patch 的 (裁剪尺寸, 行, 列)。``series_uid`` 为 None (非 DICOM 或缺少该标签) 时不使用缓存。
+    缓存按 (分类器实例, 序列) 划分，不同模型的结果互不命中。
+    传入 ``profile`` 时记录命中数 patch_cache_hits 与实际分类的 patch 数 patch_cache_misses。
+    """
+    if series_uid is None or not _patch_cache.enabled or not patches:
+        return _patch_logits(cnn_classifier, patches)
+    namespace = _patch_cache_namespace(cnn_classifier, series_uid)
+    keys = [_patch_cache.key(patch, position) for patch, position in zip(patches, positions)]
+    logits = _patch_cache.get_many(namespace, keys)
+    missing = [i for i, found in enumerate(logits) if found is None]
+    if missing:
+        computed = _patch_logits(cnn_classifier, [patches[i] for i in missing])
+        _patch_cache.put_many(namespace, [keys[i] for i in missing], computed)
+        for i, row in zip(missing, computed):
+            logits[i] = row
+    if profile is not None:
+        profile["series_uid"] = series_uid
+        profile["patch_cache_hits"] = profile.get("patch_cache_hits", 0) + len(patches) - len(missing)
+        profile["patch_cache_misses"] = profile.get("patch_cache_misses", 0) + len(missing)
+    return np.stack(logits)
+
+
+def extract_candidates(unet_pred_prob: np.ndarray, resized_image_np: np.ndarray, params: dict | None = None,
+                       profile: dict | None = None) -> list[dict]:
+    """
+    对单张切片的 U-Net 概率图执行分水岭分割，返回可跨进程传递的轻量候选结构
+    (patch、区域在模型尺寸图像中的 bbox、bbox 内的区域掩码与面积)，供体积模式 (volume.py) 跨切片关联。
+    """
+    params = params or postprocess_params()
+    if not (unet_pred_prob > params["unet_threshold"]).any():
         return []
-    
+    with stage_timer(profile, "watershed"):
+        labels, candidates = _watershed_candidates(resized_image_np, unet_pred_prob, params["unet_threshold"],
+                                                   params["min_distance"], params["patch_size"])
+    for cand in candidates:
+        min_r, min_c, max_r, max_c = cand["bbox"]
+        cand["mask"] = labels[min_r:max_r, min_c:max_c] == cand.pop("label")
+    return candidates
+
+
+def _original_contours(mask: np.ndarray, original_size: tuple[int, int]):
+    """将模型尺寸的二值掩码缩放回原图尺寸并提取外轮廓 (cv2 格式)。"""
     original_w, original_h = original_size
+    resized_mask = cv2.resize(mask.astype(np.uint8), (original_w, original_h), interpolation=cv2.INTER_NEAREST)
+    contours, _ = cv2.findContours(resized_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return contours
+
+
+def mask_to_contours(mask: np.ndarray, original_size: tuple[int, int], min_area: float = MIN_CONTOUR_AREA,
+                     min_points: int = MIN_CONTOUR_POINTS) -> list[tuple[int, np.ndarray]]:
+    """
+    将模型尺寸的二值掩码缩放回原图尺寸并提取外轮廓，过滤面积小于 ``min_area`` 或点数少于 ``min_points`` 的噪声轮廓。
+    返回 (轮廓序号, (N, 2) 的 int32 坐标数组)，序号为过滤前的顺序。
+    """
+    results = []
+    for i, cnt in enumerate(_original_contours(mask, original_size)):
+        if cv2.contourArea(cnt) < min_area or len(cnt) < min_points:
+            continue
+        results.append((i, cnt.reshape(-1, 2)))
+    return results
+
+
+def _tile_starts(length: int, tile: int, stride: int) -> list[int]:
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def _blend_window(tile_h: int, tile_w: int, overlap: int) -> np.ndarray:
+    """tile 融合权重：中心为 1，在重叠宽度内向边缘线性衰减，消除拼接处的接缝。"""
+    def ramp(n):
+        index = np.arange(n)
+        return np.minimum(1.0, np.minimum(index + 0.5, n - index - 0.5) / max(overlap, 1))
+    return np.outer(ramp(tile_h), ramp(tile_w)).astype(np.float32)
+
+
+def run_unet_tiled(unet, input_tensor: torch.Tensor, overlap: int = UNET_TILE_OVERLAP,
+                   batch_size: int = UNET_TILE_BATCH_SIZE, profile: dict | None = None) -> np.ndarray:
+    """
+    在原始分辨率上以重叠的 TARGET_IMG_SIZE 大小 tile 执行 U-Net，按融合权重加权平均得到完整的概率图。
+    完全位于肺野掩码 (lung.lung_mask) 之外的 tile 不做推理，概率记为 0。
+    内存占用为两张原始尺寸的累加图加上一个批次的 tile，与图像放大无关。
+    """
+    from lung import lung_mask
+
+    image = input_tensor[0, 0]
+    height, width = image.shape
+    tile_w, tile_h = TARGET_IMG_SIZE
+    pad_h, pad_w = max(0, tile_h - height), max(0, tile_w - width)
+    if pad_h or pad_w:  # 某一边小于 tile 时补零 (归一化后的 0 即窗下限，视为空气)
+        image = torch.nn.functional.pad(image, (0, pad_w, 0, pad_h))
+    padded_h, padded_w = image.shape
+
+    lung = lung_mask(image.cpu().numpy())
+    windows = [
+        (y, x)
+        for y in _tile_starts(padded_h, tile_h, tile_h - overlap)
+        for x in _tile_starts(padded_w, tile_w, tile_w - overlap)
+    ]
+    total_tiles = len(windows)
+    windows = [(y, x) for y, x in windows if lung[y:y + tile_h, x:x + tile_w].any()]
+    if profile is not None:
+        profile["tiles"] = total_tiles
+        profile["tiles_skipped"] = total_tiles - len(windows)
+
+    weight = torch.from_numpy(_blend_window(tile_h, tile_w, overlap)).to(image.device)
+    prob_sum = torch.zeros((padded_h, padded_w), dtype=torch.float32, device=image.device)
+    weight_sum = torch.zeros_like(prob_sum)
+    with torch.no_grad():
+        for start in range(0, len(windows), batch_size):
+            batch_windows = windows[start:start + batch_size]
+            tiles = torch.stack([image[y:y + tile_h, x:x + tile_w] for y, x in batch_windows]).unsqueeze(1)
+            tile_probs = unet(tiles)[:, 0]
+            for (y, x), tile_prob in zip(batch_windows, tile_probs):
+                prob_sum[y:y + tile_h, x:x + tile_w] += tile_prob * weight
+                weight_sum[y:y + tile_h, x:x + tile_w] += weight
+    prob = prob_sum.div_(weight_sum.clamp_min_(1e-6))
+    return prob[:height, :width].cpu().numpy()
+
+
+def _forward_unet(unet, input_tensors: list[torch.Tensor], rois: list | None = None,
+                  profile: dict | None = None) -> list[np.ndarray]:
+    """
+    对多张切片执行 U-Net，返回每张切片完整尺寸的概率图。
+    ``rois[i]`` 为第 i 张切片送入 U-Net 的区域 (见 lung_gate)，为 None 时使用整张图像；区域外的概率记为 0。
+    裁剪尺寸相同的切片拼接为一个批次；分块模式下的大图逐张以滑动窗口推理 (tile 在其内部成批)。
+    """
+    rois = list(rois) if rois else [None] * len(input_tensors)
+    probs: list[np.ndarray | None] = [None] * len(input_tensors)
+    groups: dict[tuple[int, int], list[int]] = {}
+    for i, (tensor, roi) in enumerate(zip(input_tensors, rois)):
+        if roi is None:
+            rois[i] = roi = (0, tensor.shape[-2], 0, tensor.shape[-1])
+        if not _is_tiled(tensor.shape):
+            groups.setdefault((roi[1] - roi[0], roi[3] - roi[2]), []).append(i)
 
-    # 2. Stage-1: U-Net 分割
     with torch.no_grad():
-        unet_output = unet(input_tensor)
-        unet_pred_prob = unet_output.squeeze().cpu().numpy()
-        unet_pred_mask = (unet_pred_prob > 0.5).astype(np.uint8)
+        for indices in groups.values():
+            crops = [input_tensors[i][:, :, rois[i][0]:rois[i][1], rois[i][2]:rois[i][3]] for i in indices]
+            unet_output = unet(torch.cat(crops, dim=0))
+            for i, crop_prob in zip(indices, unet_output[:, 0].cpu().numpy()):
+                y0, y1, x0, x1 = rois[i]
+                height, width = input_tensors[i].shape[-2:]
+                if (y1 - y0, x1 - x0) == (height, width):
+                    probs[i] = crop_prob
+                else:
+                    probs[i] = np.zeros((height, width), dtype=crop_prob.dtype)
+                    probs[i][y0:y1, x0:x1] = crop_prob
+    for i, tensor in enumerate(input_tensors):
+        if probs[i] is None:
+            probs[i] = run_unet_tiled(unet, tensor, profile=profile)
+    return probs
+
+
+def run_unet_batch(input_tensors: list[torch.Tensor], rois: list | None = None,
+                   profile: dict | None = None) -> list[np.ndarray]:
+    """
+    将多张切片的输入张量拼接为 (N, 1, H, W)，执行一次 U-Net 前向，返回每张切片的概率图。
+    供微批处理器 (batching.MicroBatcher) 合并多个请求的切片时使用；``rois`` 见 _forward_unet。
+    传入 ``profile`` 时记录 unet_batch 阶段耗时。
+    """
+    unet, _ = get_models()
+    if unet is None:
+        raise RuntimeError("U-Net 模型未加载。")
+    with stage_timer(profile, "unet_batch"):
+        return _forward_unet(unet, input_tensors, rois, profile=profile)
+
+
+def postprocess_prediction(unet_pred_prob: np.ndarray, resized_image_np: np.ndarray,
+                           original_size: tuple[int, int], params: dict | None = None, series_uid: str | None = None,
+                           profile: dict | None = None) -> list[dict]:
+    """
+    在 U-Net 概率图的基础上完成剩余流程（Watershed -> CNN Filter -> Post-processing），返回结节轮廓列表。
+    ``params`` 为后处理参数 (见 postprocess_params)，默认使用模块常量；``series_uid`` 选择 patch 缓存的序列。
+    传入 ``profile`` 时记录 watershed / cnn / contours 各阶段耗时以及候选区域数与真阳性数。
+    """
+    params = params or postprocess_params()
+    _, cnn_classifier = get_models()
+    if cnn_classifier is None:
+        logger.error("模型未加载，跳过预测。")
+        return []
+
+    unet_pred_mask = (unet_pred_prob > params["unet_threshold"]).astype(np.uint8)
 
     if np.sum(unet_pred_mask) == 0:
-        print("U-Net 未检测到候选区域。")
+        logger.debug("U-Net 未检测到候选区域。")
         return []
 
     # 3. Stage-2: CNN 分类过滤
-    candidate_patches = _extract_patches_with_watershed(resized_image_np, unet_pred_prob)
-    final_pred_mask = np.zeros_like(unet_pred_mask)
-
-    for cand in candidate_patches:
-        patch_for_cnn = (cand['patch'] * 255).astype(np.uint8)
-        patch_tensor = cnn_transform(patch_for_cnn).unsqueeze(0).to(DEVICE)
-        
-        with torch.no_grad():
-            cnn_output = cnn_classifier(patch_tensor)
-            _, cnn_pred_idx = torch.max(cnn_output, 1)
-        
-        predicted_class = CLASS_NAMES[cnn_pred_idx.item()]
-        if predicted_class == 'tp':
-            min_r, min_c, max_r, max_c = cand['region'].bbox
-            final_pred_mask[min_r:max_r, min_c:max_c] |= cand['region'].image
+    with stage_timer(profile, "watershed"):
+        labels, candidate_patches = _watershed_candidates(resized_image_np, unet_pred_prob, params["unet_threshold"],
+                                                          params["min_distance"], params["patch_size"])
+
+    # 被分类为 tp 的标签值在查找表中置 1，一次查表得到最终掩码
+    is_tp = np.zeros(labels.max() + 1, dtype=np.uint8)
+    num_tp = 0
+    if candidate_patches:
+        _, crop_size = _scaled_sizes(resized_image_np.shape, params["min_distance"], params["patch_size"])
+        with stage_timer(profile, "cnn"):
+            pred_indices = _cached_patch_logits(
+                cnn_classifier, [cand['patch'] for cand in candidate_patches],
+                [(crop_size, *cand['origin']) for cand in candidate_patches], series_uid, profile).argmax(axis=1)
+        for cand, pred_idx in zip(candidate_patches, pred_indices):
+            predicted_class = CLASS_NAMES[pred_idx]
+            if predicted_class == 'tp':
+                num_tp += 1
+                is_tp[cand['label']] = 1
+    final_pred_mask = is_tp[labels]
+    if profile is not None:
+        profile["candidates"] = len(candidate_patches)
+        profile["true_positives"] = num_tp
 
     if np.sum(final_pred_mask) == 0:
-        print("CNN 分类器过滤后未发现有效结节。")
+        logger.debug("CNN 分类器过滤后未发现有效结节。")
         return []
 
     # 4. 后处理 - 将最终掩码转换为轮廓
-    resized_mask = cv2.resize(final_pred_mask.astype(np.uint8), (original_w, original_h), interpolation=cv2.INTER_NEAREST)
-    contours, _ = cv2.findContours(resized_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    
-    results = []
-    for i, cnt in enumerate(contours):
-        if cv2.contourArea(cnt) < 10 or len(cnt) < 5:
-            continue
+    with stage_timer(profile, "contours"):
+        contours = mask_to_contours(final_pred_mask, original_size, params["min_contour_area"],
+                                    params["min_contour_points"])
+        results = [{"id": i + 1, "contour": points} for i, points in contours]
 
-        contour_points = [{"x": int(point[0]), "y": int(point[1])} for point in cnt.squeeze(axis=1)]
-        
-        results.append({
-            "id": i + 1,
-            "contour": contour_points
-        })
+    logger.debug("检测到 %d 个有效结节轮廓。", len(results))
+    return results
 
-    if results:
-        print(f"检测到 {len(results)} 个有效结节轮廓。")
-    else:
-        print("未检测到结节。")
-        
-    return results 
\ No newline at end of file
+
+def run_prediction(source: ImageSource, frame: int = 0, params: dict | None = None,
+                   profile: dict | None = None) -> list[dict]:
+    """
+    运行完整的两阶段预测流程（U-Net -> Watershed -> CNN Filter -> Post-processing）。
+    ``source`` 为文件内容或文件路径，多帧 DICOM 时对第 ``frame`` 帧进行预测；``params`` 见 postprocess_params。
+    传入 ``profile`` (dict) 时在其中记录各阶段耗时与候选区域统计，见 metrics.stage_timer。
+    """
+    unet, cnn_classifier = get_models()
+    if unet is None or cnn_classifier is None:
+        logger.error("模型未加载，跳过预测。")
+        return []
+    if profile is None:
+        profile = {}  # 需要其中的 series_uid 选择 patch 缓存
+
+    # 1. 预处理图像
+    input_tensor, resized_image_np, original_size, is_dicom = _preprocess_image(source, frame, profile=profile)
+    if input_tensor is None:
+        logger.warning("图像预处理失败，无法进行预测。")
+        return []
+
+    # 2. 肺野门控 (只对 DICOM) + Stage-1: U-Net 分割
+    roi = lung_gate(resized_image_np, is_dicom, profile=profile)
+    if roi is None:
+        logger.debug("肺野面积可忽略，跳过 U-Net。")
+        return []
+    with stage_timer(profile, "unet"):
+        unet_pred_prob = _forward_unet(unet, [input_tensor], [roi], profile=profile)[0]
+
+    # 3-4. Stage-2 及后处理
+    return postprocess_prediction(unet_pred_prob, resized_image_np, original_size, params, profile.get("series_uid"),
+                                  profile=profile)
+
+
+# --- 阈值扫描 ---
+def sweep_combinations(**values) -> list[dict]:
+    """
+    由各后处理参数的取值列表生成全部参数组合 (笛卡尔积，按参数顺序展开)，每个组合为完整的参数字典。
+    取值列表为 None 或空时使用默认值。
+    """
+    names = list(values)
+    grids = [values[name] or [None] for name in names]
+    return [postprocess_params(**dict(zip(names, combo))) for combo in itertools.product(*grids)]
+
+
+def sweep_postprocess(unet_pred_prob: np.ndarray, resized_image_np: np.ndarray, original_size: tuple[int, int],
+                      combinations: list[dict], logit_cache: dict | None = None, series_uid: str | None = None,
+                      profile: dict | None = None) -> tuple[list[list[dict]], dict]:
+    """
+    以多组后处理参数处理同一张切片的 U-Net 概率图，每组参数的结果与 postprocess_prediction 相同。
+    - 分水岭按 (阈值, 种子间距) 去重，只执行一次；
+    - 候选 patch 由 (裁剪尺寸, 裁剪位置) 唯一确定，所有组合的 patch 去重后合并为一次 CNN 批量分类；
+    - 每个 (阈值, 种子间距, patch 尺寸) 只提取一次轮廓，面积与点数过滤对所有组合一次向量化完成。
+    ``logit_cache`` 为此前扫描得到的 {(裁剪尺寸, 行, 列): logits}，命中的 patch 不再送入 CNN；
+    其余 patch 再查询 ``series_uid`` 的 patch 缓存 (见 _cached_patch_logits)。
+    返回 (每组参数的结节列表, 本次新计算的 logits)，由调用方合并到自己的缓存中 (工作进程中修改传入的字典对调用方不可见)。
+    """
+    _, cnn_classifier = get_models()
+    if cnn_classifier is None:
+        raise RuntimeError("CNN 分类器未加载。")
+    logit_cache = logit_cache or {}
+
+    # 各组合对应的 (阈值, 缩放后的种子间距, 缩放后的裁剪尺寸)
+    keys = []
+    for params in combinations:
+        min_distance, crop_size = _scaled_sizes(resized_image_np.shape, params["min_distance"], params["patch_size"])
+        keys.append((params["unet_threshold"], min_distance, crop_size))
+
+    labels_by_watershed, candidates_by_key = {}, {}
+    with stage_timer(profile, "watershed"):
+        for threshold, min_distance, crop_size in dict.fromkeys(keys):
+            if (threshold, min_distance) not in labels_by_watershed:
+                labels_by_watershed[threshold, min_distance] = _watershed_labels(unet_pred_prob > threshold, min_distance)
+            candidates_by_key[threshold, min_distance, crop_size] = _region_patches(
+                resized_image_np, labels_by_watershed[threshold, min_distance], crop_size, PATCH_SIZE)
+
+    pending = {}
+    for (_, _, crop_size), candidates in candidates_by_key.items():
+        for cand in candidates:
+            patch_key = (crop_size, *cand["origin"])
+            if patch_key not in logit_cache:
+                pending.setdefault(patch_key, cand["patch"])
+    new_logits = {}
+    if pending:
+        with stage_timer(profile, "cnn"):
+            new_logits = dict(zip(pending, _cached_patch_logits(cnn_classifier, list(pending.values()), list(pending),
+                                                                series_uid, profile)))
+    logits = {**logit_cache, **new_logits}
+    if profile is not None:
+        profile["sweep_patches"] = len(pending)
+
+    results: list[list[dict] | None] = [None] * len(combinations)
+    with stage_timer(profile, "contours"):
+        for key in dict.fromkeys(keys):
+            threshold, min_distance, crop_size = key
+            indices = [i for i, other in enumerate(keys) if other == key]
+            labels = labels_by_watershed[threshold, min_distance]
+            is_tp = np.zeros(labels.max() + 1, dtype=np.uint8)
+            for cand in candidates_by_key[key]:
+                if CLASS_NAMES[int(logits[(crop_size, *cand["origin"])].argmax())] == 'tp':
+                    is_tp[cand["label"]] = 1
+            contours = _original_contours(is_tp[labels], original_size) if is_tp.any() else ()
+            areas = np.array([cv2.contourArea(cnt) for cnt in contours])
+            num_points = np.array([len(cnt) for cnt in contours])
+            # 行为组合、列为轮廓的保留矩阵
+            keep = ((areas >= np.array([[combinations[i]["min_contour_area"]] for i in indices]))
+                    & (num_points >= np.array([[combinations[i]["min_contour_points"]] for i in indices])))
+            for i, row in zip(indices, keep.reshape(len(indices), len(contours))):
+                # 同一轮廓的坐标数组在各组合间共享
+                results[i] = [{"id": int(j) + 1, "contour": contours[j].reshape(-1, 2)} for j in np.flatnonzero(row)]
+    return results, new_logits
@@ -0,0 +1,198 @@
+"""
+基于内容寻址的预测结果缓存
+
+以「上传文件字节 + 模型版本 + 处理参数」的哈希作为键，缓存 /api/predict 的检测结果。
+同一份 DICOM 被再次提交 (重新打开检查、切换切片、同事复核) 时直接返回缓存结果，无需重新推理。
+
+- 内存层: LRU，同时受条目数与字节数限制；
+- 磁盘层 (可选): 每个结果一个 JSON 文件，服务重启后仍然有效，超出容量时按最近访问时间淘汰。
+  磁盘读写在线程中执行 (asyncio.to_thread)，不阻塞事件循环。
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from contour_format import json_default
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """
+    两级 (内存 + 可选磁盘) LRU 结果缓存。
+
+    - ``max_entries``: 内存层最多保存的结果数，为 0 时禁用整个缓存。
+    - ``max_bytes``: 内存层结果 (序列化后) 的总字节数上限。
+    - ``disk_dir``: 磁盘层目录，为空时不启用磁盘层。
+    - ``disk_max_bytes``: 磁盘层的总字节数上限。
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 256 * 1024 * 1024,
+                 disk_dir: str | None = None, disk_max_bytes: int = 2 * 1024 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir or None
+        self.disk_max_bytes = disk_max_bytes
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._bytes = 0
+        # 磁盘层索引: 路径 -> 大小，按最近访问时间排序；首次访问磁盘层时扫描一次目录建立，之后增量维护
+        self._disk_index: OrderedDict[str, int] | None = None
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @staticmethod
+    def hasher(namespace: str):
+        """返回已写入命名空间的 sha256 对象；逐块 ``update`` 文件内容后，``hexdigest()`` 与 make_key 的结果相同。"""
+        digest = hashlib.sha256(namespace.encode())
+        digest.update(b"\0")
+        return digest
+
+    @staticmethod
+    def make_key(data: bytes, namespace: str) -> str:
+        """由文件内容与命名空间 (模型版本 + 参数) 计算缓存键。"""
+        digest = ResultCache.hasher(namespace)
+        digest.update(data)
+        return digest.hexdigest()
+
+    async def get(self, key: str):
+        """返回缓存的结果；未命中时返回 None。"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(payload)
+
+        payload = await asyncio.to_thread(self._read_disk, key) if self.disk_dir else None
+        with self._lock:
+            if payload is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._put_memory(key, payload)
+        return json.loads(payload)
+
+    async def put(self, key: str, value) -> None:
+        if not self.enabled:
+            return
+        payload = json.dumps(value, separators=(",", ":"), default=json_default).encode()
+        with self._lock:
+            self._put_memory(key, payload)
+        if self.disk_dir:
+            await asyncio.to_thread(self._write_disk, key, payload)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "disk_bytes": self._disk_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    # --- 内存层 ---
+    def _put_memory(self, key: str, payload: bytes):
+        if len(payload) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._entries[key] = payload
+        self._bytes += len(payload)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    # --- 磁盘层 ---
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _scan_disk(self):
+        """返回磁盘层中所有缓存文件的 (路径, 大小, 最近访问时间)。"""
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _ensure_disk_index(self):
+        """首次访问磁盘层时扫描目录 (在线程中执行，且不持锁)，建立按访问时间排序的索引。"""
+        if self._disk_index is not None:
+            return
+        os.makedirs(self.disk_dir, exist_ok=True)
+        files = sorted(self._scan_disk(), key=lambda item: item[2])
+        with self._lock:
+            if self._disk_index is None:
+                self._disk_index = OrderedDict((path, size) for path, size, _ in files)
+                self._disk_bytes = sum(self._disk_index.values())
+
+    def _read_disk(self, key: str) -> bytes | None:
+        self._ensure_disk_index()
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                payload = f.read()
+            os.utime(path)  # 记录访问时间，服务重启后仍按 LRU 淘汰
+        except OSError:
+            return None
+        with self._lock:
+            if path in self._disk_index:
+                self._disk_index.move_to_end(path)
+        return payload
+
+    def _write_disk(self, key: str, payload: bytes):
+        self._ensure_disk_index()
+        path = self._disk_path(key)
+        try:
+            if os.path.exists(path):
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, path)  # 原子替换，避免读到写了一半的文件
+        except OSError as e:
+            logger.warning(f"写入磁盘结果缓存失败: {e}")
+            return
+        with self._lock:
+            self._disk_bytes += len(payload) - self._disk_index.pop(path, 0)
+            self._disk_index[path] = len(payload)
+            evicted = self._evict_disk() if self._disk_bytes > self.disk_max_bytes else []
+        for evicted_path in evicted:
+            try:
+                os.remove(evicted_path)
+            except OSError:
+                pass
+
+    def _evict_disk(self) -> list[str]:
+        """按索引从最久未访问的文件开始淘汰 (调用方持锁)，返回需删除的路径；文件在锁外删除。"""
+        # 淘汰到上限的 90%，避免每次写入都触发淘汰
+        target = self.disk_max_bytes * 0.9
+        evicted = []
+        while self._disk_index and self._disk_bytes > target:
+            path, size = self._disk_index.popitem(last=False)
+            self._disk_bytes -= size
+            evicted.append(path)
+        return evicted
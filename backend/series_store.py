@@ -0,0 +1,157 @@
+"""
+序列会话存储
+
+客户端上传一次序列后得到 series_id，之后按切片或切片范围请求预测，不再重复上传文件。
+每张切片保存解码并经窗宽窗位归一化的图像 (模型输入尺寸) 以及首次预测时生成的 U-Net 概率图；
+调整后处理阈值时只需重新执行分水岭、CNN 与轮廓提取。
+
+- 内存层: 数组按最近访问顺序组成 LRU，总字节数超过 ``max_bytes`` 时，最久未访问的数组被写入
+  ``spill_dir`` 下的 .npy 文件，之后以 ``np.load(mmap_mode="r")`` 只读映射访问 (由操作系统页缓存管理)；
+- 会话数超过 ``max_series`` 或空闲超过 ``ttl_seconds`` 时整个会话 (含磁盘文件) 被删除。
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class SeriesStore:
+    """
+    内存受限、可溢出到磁盘的序列会话存储。
+
+    - ``max_bytes``: 内存中数组的总字节数上限。
+    - ``max_series``: 同时保留的会话数上限，超出时删除最久未访问的会话。
+    - ``ttl_seconds``: 会话的最长空闲时间。
+    - ``spill_dir``: 溢出文件目录，为空时在首次溢出时创建临时目录。
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024, max_series: int = 32, ttl_seconds: float = 3600,
+                 spill_dir: str | None = None):
+        self.max_bytes = max_bytes
+        self.max_series = max_series
+        self.ttl_seconds = ttl_seconds
+        self._spill_root = spill_dir or None
+        self._spill_dir: str | None = None
+        self._series: OrderedDict[str, dict] = OrderedDict()
+        self._arrays: OrderedDict[tuple, np.ndarray] = OrderedDict()
+        self._spilled: dict[tuple, tuple[str, np.ndarray]] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.spills = 0
+
+    def create(self, slices: list[dict]) -> str:
+        """新建会话并返回其 id；``slices`` 为各切片的元数据 (由调用方填写，存储只负责保存)。"""
+        series_id = uuid.uuid4().hex
+        with self._lock:
+            self._purge_expired()
+            self._series[series_id] = {"slices": slices, "last_access": time.monotonic()}
+            while len(self._series) > self.max_series:
+                self._delete(next(iter(self._series)))
+        return series_id
+
+    def get(self, series_id: str) -> list[dict] | None:
+        """返回会话的切片元数据并刷新其访问时间；会话不存在或已过期时返回 None。"""
+        with self._lock:
+            self._purge_expired()
+            series = self._series.get(series_id)
+            if series is None:
+                return None
+            series["last_access"] = time.monotonic()
+            self._series.move_to_end(series_id)
+            return series["slices"]
+
+    def delete(self, series_id: str) -> bool:
+        with self._lock:
+            if series_id not in self._series:
+                return False
+            self._delete(series_id)
+            return True
+
+    def clear(self):
+        """删除所有会话与溢出目录 (服务关闭时调用)。"""
+        with self._lock:
+            for series_id in list(self._series):
+                self._delete(series_id)
+            if self._spill_dir is not None:
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+                self._spill_dir = None
+
+    def put_array(self, series_id: str, index: int, kind: str, array: np.ndarray):
+        """保存会话中第 ``index`` 张切片的数组 (``kind`` 如 "image" / "prob")；会话已被删除时忽略。"""
+        key = (series_id, index, kind)
+        with self._lock:
+            if series_id not in self._series:
+                return
+            self._discard(key)
+            self._arrays[key] = array
+            self._bytes += array.nbytes
+            while self._bytes > self.max_bytes and self._arrays:
+                self._spill(*self._arrays.popitem(last=False))
+
+    def get_array(self, series_id: str, index: int, kind: str) -> np.ndarray | None:
+        """返回保存的数组；已溢出到磁盘的数组以只读内存映射返回。不存在时返回 None。"""
+        key = (series_id, index, kind)
+        with self._lock:
+            array = self._arrays.get(key)
+            if array is not None:
+                self._arrays.move_to_end(key)
+                return array
+            spilled = self._spilled.get(key)
+            return spilled[1] if spilled is not None else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "series": len(self._series),
+                "arrays": len(self._arrays),
+                "bytes": self._bytes,
+                "spilled_arrays": len(self._spilled),
+                "spilled_bytes": sum(array.nbytes for _, array in self._spilled.values()),
+                "spills": self.spills,
+            }
+
+    # --- 内部方法 (调用方持有锁) ---
+    def _spill(self, key: tuple, array: np.ndarray):
+        self._bytes -= array.nbytes
+        if self._spill_dir is None:
+            if self._spill_root:
+                os.makedirs(self._spill_root, exist_ok=True)
+            self._spill_dir = tempfile.mkdtemp(prefix="series-store-", dir=self._spill_root)
+        series_id, index, kind = key
+        path = os.path.join(self._spill_dir, f"{series_id}-{index}-{kind}.npy")
+        try:
+            np.save(path, array)
+            self._spilled[key] = (path, np.load(path, mmap_mode="r"))
+            self.spills += 1
+        except OSError as e:
+            # 写入失败时丢弃该数组：图像丢失的切片会报错，概率图丢失时下次预测重新执行 U-Net
+            logger.warning(f"序列数组溢出到磁盘失败: {e}")
+
+    def _discard(self, key: tuple):
+        array = self._arrays.pop(key, None)
+        if array is not None:
+            self._bytes -= array.nbytes
+        spilled = self._spilled.pop(key, None)
+        if spilled is not None:
+            try:
+                os.remove(spilled[0])  # 已映射的数组在引用释放前仍然可读
+            except OSError:
+                pass
+
+    def _delete(self, series_id: str):
+        self._series.pop(series_id, None)
+        for key in [key for key in (*self._arrays, *self._spilled) if key[0] == series_id]:
+            self._discard(key)
+
+    def _purge_expired(self):
+        deadline = time.monotonic() - self.ttl_seconds
+        for series_id in [series_id for series_id, series in self._series.items() if series["last_access"] < deadline]:
+            self._delete(series_id)
@@ -0,0 +1,148 @@
+"""
+结构化、低开销的日志
+
+- 请求级上下文 (request_id、job_id) 保存在 contextvars 中，随 asyncio 任务自动传递；
+  线程模式的推理工作池在提交任务时复制调用方的上下文 (见 worker_pool.py)。
+- 调用线程只做采样判断、附加上下文并把记录放入有界队列 (队列满时丢弃并计数)；
+  格式化与写 stdout 由后台线程 (QueueListener) 完成，推理线程不再同步写终端。
+- 输出为 JSON lines (``LOG_FORMAT=json``) 或传统文本格式；``extra={"fields": {...}}`` 中的字段
+  (切片 UID、候选数、真阳性数、各阶段耗时等) 与上下文一起合并到同一行。
+- 按请求采样: 每个请求开始时以 ``sample_rate`` 的概率决定是否记录，同一请求的 INFO 及以下日志要么全部保留、
+  要么全部丢弃，请求量再大日志开销也保持平稳；WARNING 及以上总是记录。
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+_context: contextvars.ContextVar[dict] = contextvars.ContextVar("log_context", default={})
+_sample_rate = 1.0
+_queue_handler: "_DroppingQueueHandler | None" = None
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+# --- 上下文 ---
+def bind(**fields) -> contextvars.Token:
+    """在当前上下文中添加字段 (值为 None 时移除该字段)，返回用于 reset 的 token。"""
+    context = {**_context.get(), **fields}
+    return _context.set({key: value for key, value in context.items() if value is not None})
+
+
+def reset(token: contextvars.Token):
+    _context.reset(token)
+
+
+@contextmanager
+def bound(**fields):
+    """在 with 块内向上下文添加字段。"""
+    token = bind(**fields)
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def start_request(request_id: str) -> contextvars.Token:
+    """开始一个请求：绑定 request_id 并做出该请求的采样决定。"""
+    return bind(request_id=request_id, sampled=_sample_rate >= 1 or random.random() < _sample_rate)
+
+
+def dropped_records() -> int:
+    """因队列已满而丢弃的日志记录数。"""
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+
+# --- 过滤、入队与格式化 ---
+class _ContextFilter(logging.Filter):
+    """在调用线程中执行：丢弃未被采样的请求的低级别日志，并把当前上下文附加到记录上。"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = _context.get()
+        if record.levelno < logging.WARNING and not context.get("sampled", True):
+            return False
+        record.context = context
+        return True
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """有界队列的 QueueHandler：队列满时丢弃记录并计数，不阻塞调用线程。"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 只在调用线程中展开消息参数与异常文本 (参数对象不跨线程)，完整的格式化由后台线程完成
+        message = record.getMessage()
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = logging.Formatter().formatException(record.exc_info)
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg, record.args, record.exc_info, record.exc_text = message, None, None, exc_text
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录输出为一行 JSON：时间、级别、logger、消息、上下文字段与 ``fields`` 中的字段。"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in getattr(record, "context", {}).items() if key != "sampled")
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """传统的文本格式，上下文与 ``fields`` 中的字段以 key=value 附加在消息之后。"""
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        message = super().formatMessage(record)
+        extra = {key: value for key, value in getattr(record, "context", {}).items() if key != "sampled"}
+        extra.update(getattr(record, "fields", None) or {})
+        if not extra:
+            return message
+        return message + " " + " ".join(
+            f"{key}={json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=str)}"
+            for key, value in extra.items())
+
+
+def configure_logging(level: str = "INFO", fmt: str = "json", sample_rate: float = 1.0,
+                      queue_size: int = 10000) -> logging.handlers.QueueListener:
+    """
+    替换根 logger 的处理器：记录经采样与上下文过滤后放入有界队列，由后台线程格式化 (``fmt`` 为 json 或 text)
+    并写入 stdout。返回已启动的 QueueListener；进程退出时自动 stop()，写出队列中剩余的记录。
+    """
+    global _sample_rate, _queue_handler
+    if fmt not in {"json", "text"}:
+        raise ValueError(f"不支持的日志格式: {fmt}. 请选择 'json' 或 'text'.")
+    _sample_rate = sample_rate
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter(TEXT_FORMAT))
+    log_queue = queue.Queue(maxsize=queue_size)
+    _queue_handler = _DroppingQueueHandler(log_queue)
+    _queue_handler.addFilter(_ContextFilter())
+    logging.basicConfig(level=level.upper(), handlers=[_queue_handler], force=True)
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 后端模块按脚本方式组织 (from predict import ...)，测试时将 backend 目录加入导入路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
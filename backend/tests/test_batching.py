@@ -0,0 +1,134 @@
+"""
+batching.MicroBatcher: 批大小上限、按优先级组批，以及 stop 时正在执行与排队的任务以异常结束。
+"""
+import asyncio
+
+import pytest
+
+from batching import MicroBatcher
+
+
+class RecordingBatchFn:
+    """记录每次调用的批次与优先级；``gate`` 未放行时批处理一直阻塞，用于构造「批次正在执行」的状态。"""
+
+    def __init__(self, blocked: bool = False):
+        self.calls: list[tuple[list, int]] = []
+        self.gate = asyncio.Event()
+        if not blocked:
+            self.gate.set()
+
+    async def __call__(self, items: list, priority: int) -> list:
+        self.calls.append((list(items), priority))
+        await self.gate.wait()
+        return [item * 10 for item in items]
+
+
+def test_results_follow_submission():
+    async def scenario():
+        batch_fn = RecordingBatchFn()
+        batcher = MicroBatcher(batch_fn, max_batch_size=4, max_wait_ms=5)
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(10)))
+        await batcher.stop()
+        return results, batch_fn.calls
+
+    results, calls = asyncio.run(scenario())
+    assert results == [i * 10 for i in range(10)]
+    assert all(1 <= len(items) <= 4 for items, _ in calls)
+    assert sorted(item for items, _ in calls for item in items) == list(range(10))
+
+
+def test_partial_batch_flushes_after_max_wait():
+    async def scenario():
+        batch_fn = RecordingBatchFn()
+        batcher = MicroBatcher(batch_fn, max_batch_size=8, max_wait_ms=20)
+        result = await asyncio.wait_for(batcher.submit(1), 1)
+        await batcher.stop()
+        return result, batch_fn.calls
+
+    result, calls = asyncio.run(scenario())
+    assert result == 10
+    assert calls == [([1], 0)]
+
+
+def test_priority_order():
+    async def scenario():
+        batch_fn = RecordingBatchFn(blocked=True)
+        batcher = MicroBatcher(batch_fn, max_batch_size=2, max_wait_ms=1)
+        # 第一批阻塞在 batch_fn 中，其余任务在队列中按优先级排序
+        tasks = [asyncio.create_task(batcher.submit(0))]
+        await asyncio.sleep(0.05)
+        tasks += [asyncio.create_task(batcher.submit(i, priority=10)) for i in (1, 2, 3)]
+        tasks += [asyncio.create_task(batcher.submit(i, priority=0)) for i in (4, 5)]
+        await asyncio.sleep(0.01)
+        batch_fn.gate.set()
+        results = await asyncio.wait_for(asyncio.gather(*tasks), 1)
+        await batcher.stop()
+        return results, batch_fn.calls
+
+    results, calls = asyncio.run(scenario())
+    assert results == [0, 10, 20, 30, 40, 50]
+    # 交互式任务 (0) 先于后台任务 (10) 组批；同优先级先进先出；批次优先级取批内最小值
+    assert calls == [([0], 0), ([4, 5], 0), ([1, 2], 10), ([3], 10)]
+
+
+def test_batch_fn_error_fails_whole_batch():
+    async def failing(items, priority):
+        raise ValueError("boom")
+
+    async def scenario():
+        batcher = MicroBatcher(failing, max_batch_size=4, max_wait_ms=5)
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(3)), return_exceptions=True)
+        await batcher.stop()
+        return results
+
+    assert all(isinstance(result, ValueError) for result in asyncio.run(scenario()))
+
+
+def test_stop_fails_inflight_and_queued():
+    async def scenario():
+        batch_fn = RecordingBatchFn(blocked=True)
+        batcher = MicroBatcher(batch_fn, max_batch_size=2, max_wait_ms=1)
+        tasks = [asyncio.create_task(batcher.submit(i)) for i in range(5)]
+        await asyncio.sleep(0.05)
+        assert len(batch_fn.calls) == 1  # 第一批正在执行，其余在排队
+        await batcher.stop()
+        return await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), 1)
+
+    results = asyncio.run(scenario())
+    assert len(results) == 5
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_stop_fails_items_taken_while_collecting():
+    async def scenario():
+        batch_fn = RecordingBatchFn()
+        batcher = MicroBatcher(batch_fn, max_batch_size=4, max_wait_ms=10_000)
+        task = asyncio.create_task(batcher.submit(1))
+        await asyncio.sleep(0.05)  # 已取出，正在等待凑满一批
+        await batcher.stop()
+        return await asyncio.wait_for(asyncio.gather(task, return_exceptions=True), 1), batch_fn.calls
+
+    (result,), calls = asyncio.run(scenario())
+    assert isinstance(result, RuntimeError)
+    assert calls == []
+
+
+def test_no_item_lost_at_wait_deadline():
+    """大量任务恰好在凑批超时前后到达时，每个任务都得到结果。"""
+    async def scenario():
+        batcher = MicroBatcher(RecordingBatchFn(), max_batch_size=4, max_wait_ms=0.5)
+
+        async def client(i):
+            await asyncio.sleep((i % 7) * 0.0003)
+            return await asyncio.wait_for(batcher.submit(i), 2)
+
+        for _ in range(5):
+            assert await asyncio.gather(*(client(i) for i in range(100))) == [i * 10 for i in range(100)]
+        await batcher.stop()
+
+    asyncio.run(scenario())
+
+
+def test_invalid_batch_size():
+    with pytest.raises(ValueError):
+        MicroBatcher(RecordingBatchFn(), max_batch_size=0)
@@ -0,0 +1,107 @@
+"""
+contour_format: 各编码格式可还原出原轮廓，默认 json 格式的响应体与逐点 {"x", "y"} 对象的原格式逐字节相同。
+"""
+import base64
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+import contour_format
+from contour_format import json_default, negotiate_format, render
+
+
+def _contours(seed: int = 0) -> list[np.ndarray]:
+    """随机掩码的外轮廓，与 predict.mask_to_contours 一样为 (N, 2) 的 int32 数组。"""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((512, 512), np.uint8)
+    for _ in range(12):
+        center = (int(rng.integers(20, 490)), int(rng.integers(20, 490)))
+        axes = (int(rng.integers(3, 30)), int(rng.integers(3, 30)))
+        cv2.ellipse(mask, center, axes, float(rng.integers(0, 180)), 0, 360, 1, -1)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return [cnt.reshape(-1, 2) for cnt in contours]
+
+
+def _payload(contours: list[np.ndarray]) -> dict:
+    return {"slices": [{"filename": "a.dcm", "frame": None,
+                        "nodules": [{"id": i + 1, "contour": points} for i, points in enumerate(contours)]}]}
+
+
+def _decode(nodule: dict, fmt: str) -> np.ndarray:
+    if fmt == "json":
+        return np.array([(point["x"], point["y"]) for point in nodule["contour"]]).reshape(-1, 2)
+    if fmt == "flat":
+        return np.array(nodule["contour"]).reshape(-1, 2)
+    data = nodule["contour"] if fmt == "msgpack" else base64.b64decode(nodule["contour"])
+    return np.frombuffer(data, dtype="<i2" if nodule["dtype"] == "int16" else "<i4").reshape(-1, 2)
+
+
+def _load(body: bytes, fmt: str) -> dict:
+    if fmt == "msgpack":
+        return pytest.importorskip("msgpack").unpackb(body)
+    return json.loads(body)
+
+
+def test_json_default_is_byte_identical():
+    contours = _contours()
+    # 原实现: 结节中保存逐点的 {"x", "y"} 对象，直接序列化
+    legacy = {"slices": [{"filename": "a.dcm", "frame": None, "nodules": [
+        {"id": i + 1, "contour": [{"x": int(x), "y": int(y)} for x, y in points]}
+        for i, points in enumerate(contours)]}]}
+    expected = json.dumps(legacy, ensure_ascii=False, separators=(",", ":")).encode()
+
+    body, media_type = render(_payload(contours))
+    assert media_type == "application/json"
+    assert body == expected
+    # 结果缓存 (json_default 序列化) 与旧版本缓存中的点列表读回后输出相同
+    cached = json.loads(json.dumps(_payload(contours), default=json_default))
+    assert render(cached)[0] == expected
+    assert render(legacy)[0] == expected
+
+
+@pytest.mark.parametrize("fmt", ["json", "flat", "packed", "msgpack"])
+def test_point_formats_round_trip(fmt):
+    if fmt == "msgpack" and contour_format.msgpack is None:
+        pytest.skip("msgpack is not installed")
+    contours = _contours(1)
+    body, media_type = render(_payload(contours), fmt)
+    assert media_type == contour_format.MEDIA_TYPES[fmt]
+    nodules = _load(body, fmt)["slices"][0]["nodules"]
+    assert [nodule["id"] for nodule in nodules] == list(range(1, len(contours) + 1))
+    for nodule, points in zip(nodules, contours):
+        np.testing.assert_array_equal(_decode(nodule, fmt), points)
+
+
+def test_packed_widens_to_int32():
+    points = np.array([[0, 0], [40000, 5], [3, 40000]], np.int32)
+    nodule = json.loads(render(_payload([points]), "packed")[0])["slices"][0]["nodules"][0]
+    assert nodule["dtype"] == "int32"
+    np.testing.assert_array_equal(_decode(nodule, "packed"), points)
+
+
+def test_rle_round_trip():
+    for points in _contours(2):
+        nodule = json.loads(render(_payload([points]), "rle")[0])["slices"][0]["nodules"][0]
+        x, y, w, h = nodule["bbox"]
+        runs = np.repeat(np.arange(len(nodule["counts"])) % 2, nodule["counts"]).astype(np.uint8)
+        expected = np.zeros((h, w), np.uint8)
+        cv2.fillPoly(expected, [points - (x, y)], 1)
+        np.testing.assert_array_equal(runs.reshape(h, w), expected)
+
+
+def test_simplify_keeps_closed_polygon():
+    points = _contours(3)[0]
+    simplified = json.loads(render(_payload([points]), "flat", tolerance=2.0)[0])["slices"][0]["nodules"][0]
+    assert 3 <= len(simplified["contour"]) // 2 <= len(points)
+
+
+def test_negotiate_format():
+    assert negotiate_format(None, None) == "json"
+    assert negotiate_format("FLAT", "application/msgpack") == "flat"
+    assert negotiate_format(None, "text/html, application/vnd.lungcad.rle+json;q=0.5, "
+                                  "application/vnd.lungcad.packed+json;q=0.9") == "packed"
+    assert negotiate_format(None, "application/vnd.lungcad.flat+json;q=0") == "json"
+    with pytest.raises(ValueError):
+        negotiate_format("xml", None)
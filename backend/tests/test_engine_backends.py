@@ -0,0 +1,68 @@
+"""
+各推理后端对肺野门控裁剪后输入的回归测试。
+
+U-Net 的输入是 lung_gate 裁剪出的区域，尺寸随切片变化 (LUNG_ROI_BUCKETS 中的档位)；
+导出的模型必须接受与导出示例不同的 H/W (ONNX 曾只将批大小导出为动态轴)。使用随机初始化的模型，不需要权重文件。
+"""
+import importlib.util
+
+import pytest
+import torch
+
+import engine
+import predict
+from cnn_classifier_model import get_classifier_model
+from unet_model import UNet
+
+# 与导出示例 (TARGET_IMG_SIZE) 不同的裁剪区域 (y0, y1, x0, x1)
+CROP_ROIS = [(64, 448, 32, 480), (64, 448, 32, 480), (96, 416, 0, 512)]
+# fp32 后端与 eager 结果的最大允许误差；int8 后端只检查形状与数值有效
+FP32_ATOL = {"eager": 1e-5, "torchscript": 1e-4, "onnx": 1e-3, "int8_dynamic": 1e-5}
+
+
+@pytest.fixture(scope="module")
+def fp32_models():
+    torch.manual_seed(0)
+    unet = UNet(n_channels=1, n_classes=1, bilinear=False).eval()
+    cnn = get_classifier_model(pretrained=False).eval()
+    return unet, cnn
+
+
+@pytest.fixture(scope="module")
+def export_dir(tmp_path_factory):
+    return str(tmp_path_factory.mktemp("exports"))
+
+
+@pytest.fixture(scope="module")
+def slices():
+    generator = torch.Generator().manual_seed(1)
+    height, width = predict.TARGET_IMG_SIZE[1], predict.TARGET_IMG_SIZE[0]
+    return [torch.rand(1, 1, height, width, generator=generator) for _ in CROP_ROIS]
+
+
+@pytest.mark.parametrize("backend", engine.BACKENDS)
+def test_cropped_input(backend, fp32_models, export_dir, slices):
+    if backend.startswith("onnx") and importlib.util.find_spec("onnxruntime") is None:
+        pytest.skip("未安装 onnxruntime")
+    unet, cnn = fp32_models
+    backend_unet, _ = engine.prepare_models(unet, cnn, backend, export_dir)
+
+    expected = predict._forward_unet(unet, slices, CROP_ROIS)
+    actual = predict._forward_unet(backend_unet, slices, CROP_ROIS)
+    for prob, ref, (y0, y1, x0, x1) in zip(actual, expected, CROP_ROIS):
+        assert prob.shape == ref.shape
+        assert torch.isfinite(torch.from_numpy(prob)).all()
+        assert not prob[:y0].any() and not prob[y1:].any()
+        if backend in FP32_ATOL:
+            assert abs(prob - ref).max() <= FP32_ATOL[backend]
+
+
+def test_stale_export_format_is_ignored(fp32_models, export_dir):
+    unet, cnn = fp32_models
+    engine.export_models(unet, cnn, ["torchscript"], export_dir)
+    assert engine._exported_artifacts("torchscript", export_dir) is not None
+    manifest = engine._read_manifest(export_dir)
+    manifest["format"] = engine.EXPORT_FORMAT - 1
+    with open(f"{export_dir}/{engine.MANIFEST_NAME}", "w", encoding="utf-8") as f:
+        engine.json.dump(manifest, f)
+    assert engine._exported_artifacts("torchscript", export_dir) is None
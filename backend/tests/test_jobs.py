@@ -0,0 +1,157 @@
+"""
+jobs.JobManager: 按优先级启动排队的任务，取消与失败时停止切片处理、记录状态并清理临时文件。
+"""
+import asyncio
+
+import numpy as np
+import pytest
+
+from jobs import JobManager, JobQueueFullError, JobStore
+
+
+class SliceRecorder:
+    """记录处理过的切片；``gate`` 未放行时切片处理一直阻塞，``fail_on`` 中的切片抛出异常。"""
+
+    def __init__(self, blocked: bool = False, fail_on=()):
+        self.processed: list = []
+        self.fail_on = set(fail_on)
+        self.gate = asyncio.Event()
+        if not blocked:
+            self.gate.set()
+
+    async def __call__(self, item, params: dict) -> dict:
+        await self.gate.wait()
+        if item in self.fail_on:
+            raise RuntimeError(f"slice {item} failed")
+        self.processed.append(item)
+        return {"filename": str(item), "nodules": [{"id": 1, "contour": np.array([[item, 0], [0, item]], np.int32)}]}
+
+
+def _store() -> JobStore:
+    store = JobStore(":memory:")
+    store.open()
+    return store
+
+
+async def _wait_for_status(store: JobStore, job_id: str, status: str):
+    for _ in range(200):
+        if store.get(job_id)["status"] == status:
+            return
+        await asyncio.sleep(0.005)
+    raise AssertionError(f"job {job_id} is {store.get(job_id)['status']}, expected {status}")
+
+
+def test_completed_job_stores_results():
+    async def scenario():
+        store = _store()
+        manager = JobManager(store, SliceRecorder(), slice_concurrency=2)
+        manager.start()
+        cleaned = []
+        job_id = manager.submit([{"filename": str(i)} for i in range(5)], list(range(5)), {},
+                                cleanup=lambda: cleaned.append(True))["job_id"]
+        await _wait_for_status(store, job_id, "completed")
+        return store.get(job_id), store.results(job_id), cleaned
+
+    status, results, cleaned = asyncio.run(scenario())
+    assert status["completed"] == status["total"] == 5 and status["errors"] == 0
+    assert [result["index"] for result in results] == list(range(5))
+    # 轮廓数组以展平的整数数组保存
+    assert results[3]["nodules"][0]["contour"] == [3, 0, 0, 3]
+    assert cleaned == [True]
+
+
+def test_priority_order():
+    async def scenario():
+        recorder = SliceRecorder()
+        manager = JobManager(_store(), recorder, max_running=1, slice_concurrency=1)
+        # 模型就绪 (start) 之前提交的任务保持排队，之后按优先级 (大者优先，同优先级先到先得) 启动
+        for name, priority in (("low-1", 0), ("high", 10), ("low-2", 0), ("mid", 5)):
+            manager.submit([{"filename": name}], [name], {}, priority=priority)
+        assert manager.queued == 4 and manager.running == 0
+        manager.start()
+        while manager.queued or manager.running:
+            await asyncio.sleep(0.005)
+        return recorder.processed
+
+    assert asyncio.run(scenario()) == ["high", "mid", "low-1", "low-2"]
+
+
+def test_cancel_running_job_stops_slices_and_cleans_up():
+    async def scenario():
+        store = _store()
+        recorder = SliceRecorder(blocked=True)
+        manager = JobManager(store, recorder, slice_concurrency=2)
+        manager.start()
+        cleaned = []
+        job_id = manager.submit([{}] * 10, list(range(10)), {}, cleanup=lambda: cleaned.append(True))["job_id"]
+        await _wait_for_status(store, job_id, "running")
+        assert await manager.cancel(job_id)
+        recorder.gate.set()
+        await asyncio.sleep(0.05)
+        return store.get(job_id), recorder.processed, cleaned, await manager.cancel(job_id)
+
+    status, processed, cleaned, cancelled_again = asyncio.run(scenario())
+    assert status["status"] == "cancelled" and status["completed"] == 0
+    assert processed == []  # 被取消的 worker 不再处理切片
+    assert cleaned == [True]
+    assert cancelled_again is False
+
+
+def test_cancel_queued_job():
+    async def scenario():
+        store = _store()
+        recorder = SliceRecorder()
+        manager = JobManager(store, recorder)
+        cleaned = []
+        job_id = manager.submit([{}], ["queued"], {}, cleanup=lambda: cleaned.append(True))["job_id"]
+        assert await manager.cancel(job_id)
+        manager.start()
+        await asyncio.sleep(0.02)
+        return store.get(job_id)["status"], recorder.processed, cleaned, manager.queued
+
+    assert asyncio.run(scenario()) == ("cancelled", [], [True], 0)
+
+
+def test_failure_stops_other_workers_before_cleanup():
+    async def scenario():
+        store = _store()
+        recorder = SliceRecorder(fail_on={3})
+        cleanup_saw = []
+        manager = JobManager(store, recorder, slice_concurrency=4)
+        manager.start()
+        # 清理时所有 worker 都已退出，之后不再有切片被处理
+        job_id = manager.submit([{}] * 50, list(range(50)), {},
+                                cleanup=lambda: cleanup_saw.append(len(recorder.processed)))["job_id"]
+        await _wait_for_status(store, job_id, "failed")
+        await asyncio.sleep(0.02)
+        return store.get(job_id), recorder.processed, cleanup_saw
+
+    status, processed, cleanup_saw = asyncio.run(scenario())
+    assert status["error"] == "slice 3 failed"
+    assert 3 not in processed and len(processed) < 50
+    assert cleanup_saw == [len(processed)]
+
+
+def test_stop_marks_unfinished_jobs_interrupted():
+    async def scenario():
+        store = _store()
+        manager = JobManager(store, SliceRecorder(blocked=True), max_running=1)
+        manager.start()
+        running = manager.submit([{}], [0], {})["job_id"]
+        queued = manager.submit([{}], [1], {})["job_id"]
+        await _wait_for_status(store, running, "running")
+        await manager.stop()
+        return store.get(running)["status"], store.get(queued)["status"]
+
+    assert asyncio.run(scenario()) == ("interrupted", "interrupted")
+
+
+def test_queue_limit():
+    async def scenario():
+        manager = JobManager(_store(), SliceRecorder(), max_queued=2)
+        manager.submit([{}], [0], {})
+        manager.submit([{}], [1], {})
+        with pytest.raises(JobQueueFullError):
+            manager.submit([{}], [2], {})
+
+    asyncio.run(scenario())
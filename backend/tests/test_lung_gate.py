@@ -0,0 +1,79 @@
+"""
+肺野门控 (predict.lung_gate): 只对 DICOM 生效；裁剪区域为 LUNG_ROI_BUCKETS 档位的正方形 (或整张图像)，
+不同切片能合并为同一个 U-Net 微批，且预热覆盖全部裁剪尺寸。
+"""
+import numpy as np
+import pytest
+import torch
+
+import benchmark
+import lung
+import predict
+
+FULL = (0, predict.TARGET_IMG_SIZE[1], 0, predict.TARGET_IMG_SIZE[0])
+
+
+@pytest.fixture(autouse=True)
+def gate_enabled(monkeypatch):
+    monkeypatch.setattr(predict, "LUNG_GATE_ENABLED", True)
+
+
+def test_only_dicom_is_gated():
+    phantom = benchmark.make_phantom(512, n_nodules=5)
+    *_, dicom_roi = predict.preprocess_slice(benchmark.encode_dicom(phantom))
+    *_, png_roi = predict.preprocess_slice(benchmark.encode_png(phantom))
+    assert dicom_roi != FULL and dicom_roi[1] - dicom_roi[0] in predict.LUNG_ROI_BUCKETS
+    # 常规图像的灰度不是 HU：整张送入 U-Net，也不记录门控统计
+    assert png_roi == FULL
+    profile = {}
+    predict.preprocess_slice(benchmark.encode_png(np.full((512, 512), -1000, np.float32)), profile=profile)
+    assert "lung_gate" not in profile
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_roi_is_bucketed_and_covers_lung(monkeypatch, seed):
+    rng = np.random.default_rng(seed)
+    height, width = FULL[1], FULL[3]
+    image = np.zeros((height, width), np.float32)
+    shapes = set()
+    for _ in range(40):
+        y0, x0 = rng.integers(0, height - 64), rng.integers(0, width - 64)
+        y1, x1 = rng.integers(y0 + 64, height + 1), rng.integers(x0 + 64, width + 1)
+        mask = np.zeros((height, width), bool)
+        mask[y0:y1, x0:x1] = True
+        monkeypatch.setattr(lung, "lung_mask", lambda _, mask=mask: mask)
+        roi = predict.lung_gate(image)
+        shapes.add((roi[1] - roi[0], roi[3] - roi[2]))
+        assert roi[0] <= y0 and y1 <= roi[1] and roi[2] <= x0 and x1 <= roi[3]
+        assert 0 <= roi[0] and roi[1] <= height and 0 <= roi[2] and roi[3] <= width
+    allowed = {(size, size) for size in predict.lung_roi_sizes()} | {(height, width)}
+    assert shapes <= allowed
+
+
+def test_slices_share_unet_batch():
+    calls = []
+
+    def unet(batch):
+        calls.append(tuple(batch.shape))
+        return torch.zeros(batch.shape[0], 1, *batch.shape[2:])
+
+    size = predict.lung_roi_sizes()[0]
+    tensors = [torch.zeros(1, 1, FULL[1], FULL[3]) for _ in range(4)]
+    rois = [(y, y + size, x, x + size) for y, x in ((0, 0), (10, 30), (64, 0), (FULL[1] - size, 5))]
+    probs = predict._forward_unet(unet, tensors, rois)
+    assert calls == [(4, 1, size, size)]
+    assert all(prob.shape == (FULL[1], FULL[3]) for prob in probs)
+
+
+def test_warm_up_covers_roi_sizes(monkeypatch):
+    shapes = []
+
+    def unet(batch):
+        shapes.append(tuple(batch.shape))
+        return torch.zeros(batch.shape[0], 1, *batch.shape[2:])
+
+    monkeypatch.setattr(predict, "get_models", lambda: (unet, object()))
+    timings = predict.warm_up([1, 2], [], iterations=1)
+    sizes = [(FULL[1], FULL[3])] + [(size, size) for size in predict.lung_roi_sizes()]
+    assert sorted(shapes) == sorted((batch, 1, *size) for batch in (1, 2) for size in sizes)
+    assert all(len(timings["unet"][batch]) == len(sizes) for batch in (1, 2))
@@ -0,0 +1,129 @@
+"""
+patch_cache.PatchLogitCache: 精确命中与近似命中、近似命中的置信度 (logits 间隔) 门限、按序列划分与 LRU 上限，
+以及 predict._cached_patch_logits 按分类器实例划分缓存。
+"""
+import numpy as np
+import pytest
+
+import predict
+from patch_cache import PatchLogitCache, SeriesHitStats
+
+SIZE = 64
+CONFIDENT = np.array([0.0, 3.0], np.float32)   # 最大两类之差 3
+UNCERTAIN = np.array([1.0, 1.2], np.float32)   # 最大两类之差 0.2
+
+
+def _patch(seed: int) -> np.ndarray:
+    """块内取值位于量化区间中部的 patch，轻微扰动不会改变近似键。"""
+    rng = np.random.default_rng(seed)
+    levels = rng.integers(0, 16, (16, 16))
+    return np.kron((levels + 0.5) / 16, np.ones((SIZE // 16, SIZE // 16)))
+
+
+def _perturbed(patch: np.ndarray) -> np.ndarray:
+    """CNN 输入 (量化为 uint8) 不同，但块均值几乎不变的 patch。"""
+    noisy = patch.copy()
+    noisy[::7, ::5] += 0.01
+    return noisy
+
+
+def test_exact_hit_ignores_margin():
+    cache = PatchLogitCache(min_margin=10.0)
+    key = cache.key(_patch(0), (64, 100, 200))
+    cache.put_many("s", [key], UNCERTAIN[None])
+    (found,) = cache.get_many("s", [cache.key(_patch(0).copy(), (64, 100, 200))])
+    np.testing.assert_array_equal(found, UNCERTAIN)
+
+
+@pytest.mark.parametrize("logits,reused", [(CONFIDENT, True), (UNCERTAIN, False)])
+def test_approximate_hit_requires_margin(logits, reused):
+    cache = PatchLogitCache(min_margin=1.0)
+    patch = _patch(1)
+    near = _perturbed(patch)
+    key, near_key = cache.key(patch, (64, 100, 200)), cache.key(near, (64, 101, 202))
+    assert near_key[0] == key[0] and near_key[1] != key[1]  # 同一近似键、不同的内容摘要
+    cache.put_many("s", [key], logits[None])
+    (found,) = cache.get_many("s", [near_key])
+    assert (found is not None) == reused
+
+
+def test_different_content_or_position_misses():
+    cache = PatchLogitCache(min_margin=0.0)
+    patch = _patch(2)
+    cache.put_many("s", [cache.key(patch, (64, 100, 200))], CONFIDENT[None])
+    near = _perturbed(patch)
+    misses = [cache.key(_patch(3), (64, 100, 200)),     # 内容不同
+              cache.key(near, (64, 100, 240)),          # 近似相同，但位置超出量化步长
+              cache.key(near, (48, 100, 200))]          # 近似相同，但裁剪尺寸不同
+    assert cache.get_many("s", misses) == [None, None, None]
+    # CNN 输入逐字节相同时与位置无关
+    assert cache.get_many("s", [cache.key(patch, (48, 300, 0))])[0] is not None
+    assert cache.get_many("other-series", [cache.key(patch, (64, 100, 200))]) == [None]
+
+
+def test_lru_limits():
+    cache = PatchLogitCache(max_entries=2, max_series=2)
+    keys = [cache.key(_patch(i), (64, 0, 0)) for i in range(3)]
+    cache.put_many("a", keys, np.stack([CONFIDENT] * 3))
+    found = cache.get_many("a", keys)
+    assert found[0] is None and found[1] is not None and found[2] is not None
+
+    cache.put_many("b", keys[:1], CONFIDENT[None])
+    cache.get_many("a", keys[1:2])  # a 变为最近访问的序列
+    cache.put_many("c", keys[:1], CONFIDENT[None])
+    assert cache.get_many("b", keys[:1]) == [None]
+    assert cache.get_many("a", keys[1:2])[0] is not None
+    assert cache.stats()["series"] == 2
+
+
+def test_disabled_cache():
+    cache = PatchLogitCache(max_entries=0)
+    key = cache.key(_patch(0), (64, 0, 0))
+    cache.put_many("s", [key], CONFIDENT[None])
+    assert not cache.enabled and cache.get_many("s", [key]) == [None]
+
+
+def test_series_hit_stats():
+    stats = SeriesHitStats(max_series=2)
+    stats.record("a", 3, 1)
+    stats.record("b", 0, 2)
+    stats.record("a", 1, 0)
+    stats.record("c", 0, 0)
+    assert stats.stats() == {"a": {"hits": 4, "misses": 1, "hit_rate": 0.8},
+                             "c": {"hits": 0, "misses": 0, "hit_rate": 0.0}}
+
+
+class FakeClassifier:
+    def __init__(self, logits: np.ndarray):
+        self.logits = logits
+
+
+def test_cached_patch_logits_namespaced_per_classifier(monkeypatch):
+    monkeypatch.setattr(predict, "_patch_cache", PatchLogitCache(min_margin=0.0))
+    classified = []
+
+    def fake_patch_logits(cnn, patches, batch_size=64):
+        classified.append((cnn, len(patches)))
+        return np.stack([cnn.logits] * len(patches))
+
+    monkeypatch.setattr(predict, "_patch_logits", fake_patch_logits)
+    first, second = FakeClassifier(CONFIDENT), FakeClassifier(UNCERTAIN)
+    patches = [_patch(i) for i in range(4)]
+    positions = [(64, 10 * i, 0) for i in range(4)]
+
+    profile = {}
+    np.testing.assert_array_equal(predict._cached_patch_logits(first, patches, positions, "s", profile),
+                                  np.stack([CONFIDENT] * 4))
+    # 同一分类器: 两个 patch 精确命中，扰动后的 patch 近似命中，在别处的近似 patch 需重新分类
+    again = patches[:2] + [_perturbed(patches[2]), _perturbed(patches[3])]
+    again_positions = positions[:3] + [(64, 200, 200)]
+    predict._cached_patch_logits(first, again, again_positions, "s", profile)
+    assert profile["patch_cache_hits"] == 3 and profile["patch_cache_misses"] == 5
+    assert profile["series_uid"] == "s"
+
+    # 另一个分类器实例 (例如重新加载的权重) 不复用前一个实例的结果
+    np.testing.assert_array_equal(predict._cached_patch_logits(second, patches, positions, "s"),
+                                  np.stack([UNCERTAIN] * 4))
+    # 没有 series_uid 时不使用缓存
+    predict._cached_patch_logits(first, patches, positions, None)
+    assert [(cnn is first, count) for cnn, count in classified] == [(True, 4), (True, 1), (False, 4), (True, 4)]
@@ -0,0 +1,41 @@
+"""
+CNN 输入的向量化归一化 (predict._patches_to_tensor) 与训练时 torchvision 流程的逐位一致性。
+"""
+import numpy as np
+import pytest
+import torch
+from torchvision import transforms
+
+import predict
+
+# 训练与原逐个 patch 推理时使用的预处理
+REFERENCE_TRANSFORM = transforms.Compose([
+    transforms.ToPILImage(),
+    transforms.Grayscale(num_output_channels=3),
+    transforms.ToTensor(),
+    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+])
+
+
+def _reference(patches: list[np.ndarray]) -> torch.Tensor:
+    return torch.stack([REFERENCE_TRANSFORM((patch * 255).astype(np.uint8)) for patch in patches])
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_matches_torchvision_pipeline(dtype):
+    rng = np.random.default_rng(0)
+    patches = [rng.random((predict.PATCH_SIZE, predict.PATCH_SIZE)).astype(dtype) for _ in range(32)]
+    # 量化边界上的取值: 0、1 以及恰好落在 uint8 台阶两侧的值
+    patches.append(np.linspace(0, 1, predict.PATCH_SIZE ** 2, dtype=dtype).reshape(predict.PATCH_SIZE, -1))
+    patches.append((np.arange(predict.PATCH_SIZE ** 2) % 256 / 255).astype(dtype).reshape(predict.PATCH_SIZE, -1))
+
+    actual = predict._patches_to_tensor(patches).cpu()
+    expected = _reference(patches)
+    assert actual.shape == expected.shape == (len(patches), 3, predict.PATCH_SIZE, predict.PATCH_SIZE)
+    assert actual.dtype == expected.dtype
+    assert torch.equal(actual, expected)
+
+
+def test_single_patch():
+    patch = np.random.default_rng(1).random((predict.PATCH_SIZE, predict.PATCH_SIZE))
+    assert torch.equal(predict._patches_to_tensor([patch]).cpu(), _reference([patch]))
@@ -0,0 +1,110 @@
+"""
+result_cache.ResultCache: 内存层按条目数/字节数的 LRU 淘汰，磁盘层的读写往返与按访问时间淘汰。
+"""
+import asyncio
+import json
+import os
+
+from result_cache import ResultCache
+
+
+def _size(value) -> int:
+    return len(json.dumps(value, separators=(",", ":")).encode())
+
+
+def test_memory_lru_by_entries():
+    async def scenario():
+        cache = ResultCache(max_entries=2)
+        await cache.put("a", [1])
+        await cache.put("b", [2])
+        assert await cache.get("a") == [1]  # a 变为最近使用
+        await cache.put("c", [3])
+        return [await cache.get(key) for key in "abc"], cache.stats()
+
+    values, stats = asyncio.run(scenario())
+    assert values == [[1], None, [3]]
+    assert stats["entries"] == 2 and stats["hits"] == 3 and stats["misses"] == 1
+
+
+def test_memory_lru_by_bytes():
+    value = {"contour": list(range(20))}
+
+    async def scenario():
+        cache = ResultCache(max_entries=100, max_bytes=2 * _size(value))
+        for key in "abc":
+            await cache.put(key, value)
+        too_large = {"contour": list(range(1000))}
+        await cache.put("huge", too_large)  # 单条超过上限的结果不进入内存层
+        return [await cache.get(key) for key in ("a", "b", "c", "huge")], cache.stats()
+
+    values, stats = asyncio.run(scenario())
+    assert values == [None, value, value, None]
+    assert stats["bytes"] == 2 * _size(value)
+
+
+def test_disabled_cache():
+    async def scenario():
+        cache = ResultCache(max_entries=0)
+        await cache.put("a", [1])
+        return await cache.get("a"), cache.stats()
+
+    value, stats = asyncio.run(scenario())
+    assert value is None and stats["misses"] == 0
+
+
+def test_disk_round_trip_survives_restart(tmp_path):
+    result = [{"x": 1, "contour": [[1, 2], [3, 4]]}]
+    asyncio.run(ResultCache(disk_dir=str(tmp_path)).put("ab" + "0" * 62, result))
+
+    async def restarted():
+        cache = ResultCache(disk_dir=str(tmp_path))
+        first = await cache.get("ab" + "0" * 62)
+        second = await cache.get("ab" + "0" * 62)
+        return first, second, cache.stats()
+
+    first, second, stats = asyncio.run(restarted())
+    assert first == second == result
+    assert stats["disk_hits"] == 1 and stats["hits"] == 1
+    assert stats["disk_bytes"] == _size(result)
+
+
+def test_disk_eviction_drops_least_recently_used(tmp_path):
+    value = list(range(50))
+    size = _size(value)
+    keys = [f"{i:02x}" + "0" * 62 for i in range(4)]
+
+    async def scenario():
+        # 内存层只保留一条，迫使后续读取走磁盘层
+        cache = ResultCache(max_entries=1, disk_dir=str(tmp_path), disk_max_bytes=3 * size)
+        for key in keys[:3]:
+            await cache.put(key, value)
+        await cache.get(keys[0])  # keys[0] 成为磁盘层中最近访问的文件
+        await cache.put(keys[3], value)  # 超出上限，淘汰到 90%: 删除 keys[1] 与 keys[2]
+        return cache.stats()
+
+    stats = asyncio.run(scenario())
+    remaining = sorted(name for _, _, names in os.walk(tmp_path) for name in names)
+    assert remaining == sorted(f"{key}.json" for key in (keys[0], keys[3]))
+    assert stats["disk_bytes"] == 2 * size
+
+
+def test_disk_index_counts_existing_files(tmp_path):
+    value = list(range(50))
+    keys = [f"{i:02x}" + "0" * 62 for i in range(3)]
+
+    async def fill():
+        cache = ResultCache(disk_dir=str(tmp_path))
+        for key in keys:
+            await cache.put(key, value)
+
+    asyncio.run(fill())
+
+    async def restarted():
+        # 新实例在首次访问磁盘层时统计已有文件，随后的写入按增量累计并触发淘汰
+        cache = ResultCache(disk_dir=str(tmp_path), disk_max_bytes=3 * _size(value))
+        await cache.put("ff" + "0" * 62, value)
+        return cache.stats()
+
+    stats = asyncio.run(restarted())
+    assert stats["disk_bytes"] <= 0.9 * 3 * _size(value)
+    assert sum(len(names) for _, _, names in os.walk(tmp_path)) == stats["disk_bytes"] // _size(value)
@@ -0,0 +1,99 @@
+"""
+向量化的分水岭候选提取 (predict._watershed_labels / _region_patches 与查表生成的最终掩码)
+与原实现 (整图距离变换 + regionprops + 逐区域裁剪) 的逐位一致性。
+"""
+import cv2
+import numpy as np
+import pytest
+from scipy import ndimage
+from skimage import measure, transform
+from skimage.feature import peak_local_max
+from skimage.segmentation import watershed
+
+import predict
+
+
+def _busy_map(seed: int, count: int, size: int = 512) -> tuple[np.ndarray, np.ndarray]:
+    """随机图像与含 ``count`` 个相互重叠的模糊椭圆的概率图 (大量相邻、粘连的候选区域)。"""
+    rng = np.random.default_rng(seed)
+    image = rng.random((size, size)).astype(np.float32)
+    prob = np.zeros((size, size), np.float32)
+    for _ in range(count):
+        center = (int(rng.integers(0, size)), int(rng.integers(0, size)))
+        axes = (int(rng.integers(2, 25)), int(rng.integers(2, 25)))
+        cv2.ellipse(prob, center, axes, float(rng.integers(0, 180)), 0, 360, float(rng.uniform(0.3, 1)), -1)
+    return image, cv2.GaussianBlur(prob, (0, 0), 2)
+
+
+# --- 原实现 ---
+def _reference_labels(binary_mask: np.ndarray, min_distance: int) -> np.ndarray:
+    distance = ndimage.distance_transform_edt(binary_mask)
+    coords = peak_local_max(distance, min_distance=min_distance, labels=binary_mask)
+    peaks = np.zeros(distance.shape, dtype=bool)
+    if coords.size > 0:
+        peaks[tuple(coords.T)] = True
+    markers, _ = ndimage.label(peaks)
+    return watershed(-distance, markers, mask=binary_mask)
+
+
+def _reference_patches(image: np.ndarray, labels: np.ndarray, patch_size: int, output_size: int) -> list[dict]:
+    patches = []
+    for region in measure.regionprops(labels):
+        center_y, center_x = region.centroid
+        half_size = patch_size // 2
+        start_x = max(0, int(center_x) - half_size)
+        end_x = start_x + patch_size
+        start_y = max(0, int(center_y) - half_size)
+        end_y = start_y + patch_size
+        if end_x > image.shape[1]:
+            end_x = image.shape[1]
+            start_x = end_x - patch_size
+        if end_y > image.shape[0]:
+            end_y = image.shape[0]
+            start_y = end_y - patch_size
+        patch = image[start_y:end_y, start_x:end_x]
+        if patch.shape != (output_size, output_size):
+            patch = transform.resize(patch, (output_size, output_size), anti_aliasing=True, preserve_range=True)
+        patches.append({"patch": patch, "region": region, "origin": (start_y, start_x)})
+    return patches
+
+
+CASES = [(seed, count, 512) for seed in range(12) for count in (5, 40, 150)] + [(99, 200, 1024), (98, 120, 700)]
+
+
+@pytest.mark.parametrize("seed,count,size", CASES)
+def test_matches_regionprops_reference(seed, count, size):
+    image, prob = _busy_map(seed, count, size)
+    min_distance, crop_size = predict._scaled_sizes(image.shape, predict.WATERSHED_MIN_DISTANCE, predict.PATCH_SIZE)
+    binary_mask = prob > predict.UNET_THRESHOLD
+
+    labels = predict._watershed_labels(binary_mask, min_distance)
+    np.testing.assert_array_equal(labels, _reference_labels(binary_mask, min_distance))
+
+    candidates = predict._region_patches(image, labels, crop_size, predict.PATCH_SIZE)
+    reference = _reference_patches(image, labels, crop_size, predict.PATCH_SIZE)
+    assert len(candidates) == len(reference) > 0
+    for cand, ref in zip(candidates, reference):
+        assert cand["label"] == ref["region"].label
+        assert cand["bbox"] == ref["region"].bbox
+        assert cand["area"] == ref["region"].area
+        assert cand["origin"] == ref["origin"]
+        np.testing.assert_array_equal(np.asarray(cand["patch"]), ref["patch"])
+
+    # 最终掩码: 查表 (postprocess_prediction) 与逐区域按 bbox 合并 region.image 的结果相同
+    keep = np.random.default_rng(seed).random(len(candidates)) < 0.5
+    is_tp = np.zeros(labels.max() + 1, dtype=np.uint8)
+    expected = np.zeros(labels.shape, dtype=np.uint8)
+    for cand, ref, tp in zip(candidates, reference, keep):
+        if tp:
+            is_tp[cand["label"]] = 1
+            min_r, min_c, max_r, max_c = ref["region"].bbox
+            expected[min_r:max_r, min_c:max_c] |= ref["region"].image
+    np.testing.assert_array_equal(is_tp[labels], expected)
+
+
+def test_empty_mask():
+    binary_mask = np.zeros((64, 64), dtype=bool)
+    labels = predict._watershed_labels(binary_mask, predict.WATERSHED_MIN_DISTANCE)
+    assert not labels.any()
+    assert predict._region_patches(np.zeros((64, 64), np.float32), labels) == []
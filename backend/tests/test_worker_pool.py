@@ -0,0 +1,112 @@
+"""
+worker_pool.InferencePool: 池满时拒绝 (API 返回 503 与 Retry-After)，空闲名额按优先级交给等待中的任务。
+"""
+import asyncio
+import threading
+
+import pytest
+
+from worker_pool import PRIORITY_BULK, PRIORITY_INTERACTIVE, InferencePool, PoolSaturatedError
+
+
+async def _wait_until(predicate, timeout: float = 1.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.005)
+
+
+def test_rejects_when_workers_and_queue_are_full():
+    async def scenario():
+        pool = InferencePool(max_workers=1, max_queue=1, retry_after=7)
+        release = threading.Event()
+        running = asyncio.create_task(pool.run(release.wait))
+        await _wait_until(lambda: pool.in_flight == 1)
+        queued = asyncio.create_task(pool.run(lambda: "queued"))
+        await _wait_until(lambda: pool.queued == 1)
+        assert pool.is_saturated
+
+        with pytest.raises(PoolSaturatedError) as excinfo:
+            await pool.run(lambda: "rejected")
+        # wait=True 的任务 (后台任务的切片) 总是排队，不会被拒绝
+        waiting = asyncio.create_task(pool.run(lambda: "waited", wait=True))
+        await _wait_until(lambda: pool.queued == 2)
+
+        release.set()
+        results = await asyncio.gather(running, queued, waiting)
+        stats = pool.stats()
+        pool.shutdown()
+        return excinfo.value, results, stats
+
+    error, results, stats = asyncio.run(scenario())
+    assert error.retry_after == 7
+    assert results == [True, "queued", "waited"]
+    assert stats["rejected"] == 1 and stats["completed"] == 3 and stats["in_flight"] == 0
+
+
+def test_free_slot_goes_to_highest_priority_waiter():
+    async def scenario():
+        pool = InferencePool(max_workers=1, max_queue=8)
+        release = threading.Event()
+        order = []
+        blocker = asyncio.create_task(pool.run(release.wait))
+        await _wait_until(lambda: pool.in_flight == 1)
+        tasks = []
+        for name, priority in (("bulk-1", PRIORITY_BULK), ("bulk-2", PRIORITY_BULK),
+                               ("interactive-1", PRIORITY_INTERACTIVE), ("interactive-2", PRIORITY_INTERACTIVE)):
+            tasks.append(asyncio.create_task(pool.run(order.append, name, wait=True, priority=priority)))
+            await _wait_until(lambda: pool.queued == len(tasks))
+        release.set()
+        await asyncio.gather(blocker, *tasks)
+        pool.shutdown()
+        return order
+
+    assert asyncio.run(scenario()) == ["interactive-1", "interactive-2", "bulk-1", "bulk-2"]
+
+
+def test_bulk_waiters_do_not_saturate_interactive_requests():
+    async def scenario():
+        pool = InferencePool(max_workers=1, max_queue=1)
+        release = threading.Event()
+        blocker = asyncio.create_task(pool.run(release.wait))
+        await _wait_until(lambda: pool.in_flight == 1)
+        bulk = [asyncio.create_task(pool.run(lambda: None, wait=True, priority=PRIORITY_BULK)) for _ in range(3)]
+        await _wait_until(lambda: pool.queued == 3)
+        saturated = (pool.saturated_for(PRIORITY_INTERACTIVE), pool.saturated_for(PRIORITY_BULK))
+        release.set()
+        await asyncio.gather(blocker, *bulk)
+        pool.shutdown()
+        return saturated
+
+    assert asyncio.run(scenario()) == (False, True)
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    async def scenario():
+        pool = InferencePool(max_workers=1, max_queue=4)
+        release = threading.Event()
+        blocker = asyncio.create_task(pool.run(release.wait))
+        await _wait_until(lambda: pool.in_flight == 1)
+        cancelled = asyncio.create_task(pool.run(lambda: "never", wait=True))
+        await _wait_until(lambda: pool.queued == 1)
+        cancelled.cancel()
+        release.set()
+        await blocker
+        result = await asyncio.wait_for(pool.run(lambda: "next"), 1)
+        pool.shutdown()
+        return result, cancelled.cancelled()
+
+    assert asyncio.run(scenario()) == ("next", True)
+
+
+def test_api_returns_503_with_retry_after(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    import main
+
+    # 没有工作线程、也不允许排队的池总是处于饱和状态
+    monkeypatch.setattr(main, "inference_pool", InferencePool(max_workers=0, max_queue=0, retry_after=9))
+    monkeypatch.setitem(main.readiness, "ready", True)
+    response = TestClient(main.app).post("/api/predict/batch", files=[("files", ("a.dcm", b"\0"))])
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "9"
@@ -0,0 +1,188 @@
+"""
+整个序列的 3D 检测 (体积模式)
+
+逐切片流程中，一个跨越 10 张切片的结节会被报告为 10 组互不相关的轮廓 (每张切片的 id 都从 1 开始)，
+且每张切片上的每个候选区域都要经过一次 CNN 分类。体积模式下:
+    1. 按 ImagePositionPatient 在切片法向上的投影对序列排序；
+    2. U-Net 对各切片批量推理 (由 main 中的微批处理器完成)，每张切片各自做分水岭分割得到候选区域；
+    3. 相邻切片上相互重叠的候选区域被关联为同一个 3D 连通分量 (并查集)；
+    4. 每个 3D 分量只在其面积最大的截面上做一次 CNN 分类，结果作用于整个分量；
+    5. 被判定为结节的分量在所有切片上使用同一个 id。
+"""
+import logging
+
+import numpy as np
+import pydicom
+
+from metrics import stage_timer
+from predict import (
+    CLASS_NAMES, ImageSource, _cached_patch_logits, _scaled_sizes, get_models, mask_to_contours, postprocess_params,
+    read_dicom_header,
+)
+
+logger = logging.getLogger(__name__)
+
+# --- 配置 ---
+# 相邻切片上两个候选区域的重叠像素数 / 较小区域面积 不低于该值时视为同一结节
+VOLUME_LINK_MIN_OVERLAP = 0.2
+
+
+# --- 切片排序 ---
+def _position_along_normal(position, orientation) -> float | None:
+    if position is None or len(position) != 3:
+        return None
+    position = np.asarray(position, dtype=np.float64)
+    if orientation is None or len(orientation) != 6:
+        return float(position[2])
+    orientation = np.asarray(orientation, dtype=np.float64)
+    return float(np.dot(position, np.cross(orientation[:3], orientation[3:])))
+
+
+def _functional_group_value(header: pydicom.Dataset, frame: int, sequence: str, keyword: str):
+    """从 Enhanced 多帧对象的每帧 (或共享) 功能组中读取属性，例如 PlanePositionSequence.ImagePositionPatient。"""
+    for groups_keyword, index in (("PerFrameFunctionalGroupsSequence", frame), ("SharedFunctionalGroupsSequence", 0)):
+        groups = header.get(groups_keyword)
+        if groups and index < len(groups) and sequence in groups[index]:
+            return groups[index][sequence][0].get(keyword)
+    return None
+
+
+def slice_positions(source: ImageSource) -> list[float | None]:
+    """
+    返回文件中每一帧在切片法向上的位置 (毫米)，用于排序；无法确定位置 (非 DICOM、缺少定位信息) 时为 None。
+    单帧文件返回长度为 1 的列表，多帧文件每帧一个值。
+    """
+    header = read_dicom_header(source)
+    if header is None:
+        return [None]
+    num_frames = int(header.get("NumberOfFrames") or 1)
+    if "ImagePositionPatient" in header and num_frames == 1:
+        return [_position_along_normal(header.ImagePositionPatient, header.get("ImageOrientationPatient"))]
+    if "PerFrameFunctionalGroupsSequence" in header:
+        return [
+            _position_along_normal(
+                _functional_group_value(header, frame, "PlanePositionSequence", "ImagePositionPatient"),
+                _functional_group_value(header, frame, "PlaneOrientationSequence", "ImageOrientationPatient"),
+            )
+            for frame in range(num_frames)
+        ]
+    # 没有逐帧定位信息的多帧文件按帧顺序排列
+    if num_frames > 1:
+        return [float(frame) for frame in range(num_frames)]
+    instance_number = header.get("InstanceNumber")
+    return [float(instance_number) if instance_number is not None else None]
+
+
+def sort_order(positions: list[float | None]) -> list[int]:
+    """按位置升序返回切片的排列顺序；缺少位置的切片保持上传顺序并排在最后。"""
+    return sorted(range(len(positions)), key=lambda i: (positions[i] is None, positions[i] or 0.0, i))
+
+
+# --- 跨切片关联 ---
+def link_candidates(volume_candidates: list[list[dict]], image_shapes: list[tuple[int, int]],
+                    min_overlap: float = VOLUME_LINK_MIN_OVERLAP) -> list[list[tuple[int, int]]]:
+    """
+    将相邻切片上相互重叠的候选区域关联为 3D 连通分量。
+    ``volume_candidates[z]`` 为第 z 张 (已排序) 切片的候选列表 (见 predict.extract_candidates)，
+    ``image_shapes[z]`` 为其候选坐标所在的 (模型输入) 图像尺寸；尺寸不同的相邻切片不做关联。
+    返回分量列表，每个分量为 (切片序号, 候选序号) 的列表，按首次出现的位置排序。
+    """
+    parent: dict[tuple[int, int], tuple[int, int]] = {}
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    prev_labels = None
+    for z, candidates in enumerate(volume_candidates):
+        # 同一切片上的分水岭区域互不重叠，可以绘制到同一张标签图中 (0 为背景，j + 1 为第 j 个候选)
+        labels = np.zeros(image_shapes[z], dtype=np.int32) if candidates else None
+        if prev_labels is not None and prev_labels.shape != tuple(image_shapes[z]):
+            prev_labels = None
+        for j, cand in enumerate(candidates):
+            parent[(z, j)] = (z, j)
+            min_r, min_c, max_r, max_c = cand["bbox"]
+            labels[min_r:max_r, min_c:max_c][cand["mask"]] = j + 1
+            if prev_labels is None:
+                continue
+            under = prev_labels[min_r:max_r, min_c:max_c][cand["mask"]]
+            prev_ids, overlaps = np.unique(under[under > 0], return_counts=True)
+            for prev_id, overlap in zip(prev_ids, overlaps):
+                prev = volume_candidates[z - 1][prev_id - 1]
+                if overlap / min(cand["area"], prev["area"]) >= min_overlap:
+                    parent[find((z, j))] = find((z - 1, int(prev_id) - 1))
+        prev_labels = labels
+
+    components: dict[tuple[int, int], list[tuple[int, int]]] = {}
+    for node in parent:  # 字典按 (切片, 候选) 的插入顺序遍历
+        components.setdefault(find(node), []).append(node)
+    return list(components.values())
+
+
+def assemble_volume(volume_candidates: list[list[dict]], image_shapes: list[tuple[int, int]],
+                    original_sizes: list[tuple[int, int]], params: dict | None = None, series_uid: str | None = None,
+                    profile: dict | None = None) -> tuple[list[list[dict]], list[dict]]:
+    """
+    关联候选区域、对每个 3D 分量做一次 CNN 分类，并生成各切片上带统一 id 的结节轮廓。
+    ``params`` 中的轮廓过滤阈值见 predict.postprocess_params (分水岭相关的参数在 extract_candidates 中使用)；
+    ``series_uid`` 选择 patch 缓存的序列 (见 predict._cached_patch_logits)。
+    返回 (每张切片的结节列表, 3D 结节摘要列表)；摘要中的切片序号指排序后的序号。
+    """
+    params = params or postprocess_params()
+    _, cnn_classifier = get_models()
+    if cnn_classifier is None:
+        raise RuntimeError("CNN 分类器未加载。")
+
+    components = link_candidates(volume_candidates, image_shapes)
+    slice_nodules: list[list[dict]] = [[] for _ in volume_candidates]
+    if profile is not None:
+        profile["components"] = len(components)
+    if not components:
+        return slice_nodules, []
+
+    # 每个分量取面积最大的截面作为代表 patch，整个序列只需一次批量分类
+    representatives = [max(component, key=lambda node: volume_candidates[node[0]][node[1]]["area"])
+                       for component in components]
+    positions = [(_scaled_sizes(image_shapes[z], params["min_distance"], params["patch_size"])[1],
+                  *volume_candidates[z][j]["origin"]) for z, j in representatives]
+    with stage_timer(profile, "cnn"):
+        pred_indices = _cached_patch_logits(cnn_classifier, [volume_candidates[z][j]["patch"] for z, j in representatives],
+                                            positions, series_uid, profile).argmax(axis=1)
+
+    summaries = []
+    with stage_timer(profile, "contours"):
+        for component, pred_idx in zip(components, pred_indices):
+            if CLASS_NAMES[pred_idx] != 'tp':
+                continue
+            by_slice: dict[int, list[int]] = {}
+            for z, j in component:
+                by_slice.setdefault(z, []).append(j)
+            contours_by_slice = {}
+            for z, indices in by_slice.items():
+                mask = np.zeros(image_shapes[z], dtype=np.uint8)
+                for j in indices:
+                    cand = volume_candidates[z][j]
+                    min_r, min_c, max_r, max_c = cand["bbox"]
+                    mask[min_r:max_r, min_c:max_c] |= cand["mask"]
+                contours = mask_to_contours(mask, original_sizes[z], params["min_contour_area"],
+                                            params["min_contour_points"])
+                if contours:
+                    contours_by_slice[z] = contours
+            if not contours_by_slice:
+                continue  # 所有截面的轮廓都被当作噪声过滤
+            nodule_id = len(summaries) + 1
+            for z, contours in contours_by_slice.items():
+                slice_nodules[z].extend({"id": nodule_id, "contour": points} for _, points in contours)
+            summaries.append({
+                "id": nodule_id,
+                "slice_start": min(contours_by_slice),
+                "slice_end": max(contours_by_slice),
+                "num_slices": len(contours_by_slice),
+            })
+
+    if profile is not None:
+        profile["nodules"] = len(summaries)
+    logger.debug("体积模式: %d 个 3D 候选分量，检测到 %d 个结节。", len(components), len(summaries))
+    return slice_nodules, summaries
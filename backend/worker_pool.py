@@ -0,0 +1,163 @@
+"""
+有界推理工作池
+
+将 CPU 密集的推理任务从 asyncio 事件循环转移到固定大小的线程池或进程池中执行。
+超过工作线程数的请求进入等待队列；队列也满时直接拒绝，由 API 层返回 503 和 Retry-After。
+等待中的任务按优先级 (数值小者优先，同优先级先到先得) 获得空闲的工作线程，
+交互式的单切片请求因此排在后台任务 (见 jobs.py) 的切片之前执行。
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+
+PRIORITY_INTERACTIVE = 0  # 同步 API 请求
+PRIORITY_BULK = 10        # 后台任务的切片
+
+
+class PoolSaturatedError(RuntimeError):
+    """工作池及其等待队列均已满。"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("推理工作池已满，请稍后重试。")
+        self.retry_after = retry_after
+
+
+class InferencePool:
+    """
+    有界推理工作池。
+
+    - ``max_workers``: 同时执行推理的线程/进程数。
+    - ``max_queue``: 等待执行的最大任务数，超过后新任务被拒绝。
+    - ``mode``: ``"thread"`` 或 ``"process"``。
+    - ``retry_after``: 拒绝任务时建议客户端等待的秒数。
+    - ``initializer``: 每个工作线程/进程启动时调用，参数由 ``start(initargs)`` 提供。
+    - ``mp_context``: 进程模式下使用的 multiprocessing 上下文 (如 torch.multiprocessing 的 spawn 上下文)。
+    """
+
+    def __init__(self, max_workers: int = 2, max_queue: int = 16, mode: str = "thread",
+                 retry_after: int = 2, initializer: Callable[..., Any] | None = None, mp_context=None):
+        if mode not in {"thread", "process"}:
+            raise ValueError(f"不支持的工作池模式: {mode}. 请选择 'thread' 或 'process'.")
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.mode = mode
+        self.retry_after = retry_after
+        self._initializer = initializer
+        self._mp_context = mp_context
+        self._executor: Executor | None = None
+        self._free_slots = max_workers
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []  # (优先级, 序号, future) 组成的堆
+        self._sequence = itertools.count()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self.in_flight = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+
+    @property
+    def is_saturated(self) -> bool:
+        return self.saturated_for(PRIORITY_INTERACTIVE)
+
+    def saturated_for(self, priority: int) -> bool:
+        """优先级为 ``priority`` 的新任务是否会被拒绝；排在它之后的低优先级等待任务不计入队列长度。"""
+        waiting = sum(1 for waiter_priority, _, future in self._waiters
+                      if waiter_priority <= priority and not future.done())
+        return self.in_flight + waiting >= self.max_workers + self.max_queue
+
+    def start(self, initargs: tuple = ()):
+        """创建执行器；在事件循环中调用。``initargs`` 会传给每个工作线程/进程的 ``initializer``。"""
+        if self._executor is not None:
+            return
+        if self.mode == "process":
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self._mp_context,
+                                                 initializer=self._initializer, initargs=initargs)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inference",
+                                                initializer=self._initializer, initargs=initargs)
+        self._loop = asyncio.get_running_loop()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, fn: Callable[..., Any], *args: Any, wait: bool = False,
+                  priority: int = PRIORITY_INTERACTIVE) -> Any:
+        """
+        在工作池中执行 ``fn(*args)`` 并返回结果。
+        ``wait=False`` 时若池已满则抛出 PoolSaturatedError；``wait=True`` 时总是排队等待。
+        ``priority`` 决定排队时的先后 (数值小者优先)。
+        """
+        self.start()
+        if not wait and self.saturated_for(priority):
+            self.rejected += 1
+            raise PoolSaturatedError(self.retry_after)
+
+        self.queued += 1
+        try:
+            await self._acquire(priority)
+        finally:
+            self.queued -= 1
+
+        self.in_flight += 1
+        try:
+            if self.mode == "thread":
+                # 在调用方的 contextvars 上下文中执行，工作线程中的日志带有请求的 request_id (见 structured_logging)
+                future = self._executor.submit(contextvars.copy_context().run, fn, *args)
+            else:
+                future = self._executor.submit(fn, *args)
+        except Exception:
+            self._release()
+            raise
+        # 以执行器任务的实际结束为准释放名额，即使等待方 (如断开的客户端或被取消的后台任务) 已被取消
+        future.add_done_callback(self._release_threadsafe)
+        return await asyncio.wrap_future(future)
+
+    def _release_threadsafe(self, _):
+        try:
+            self._loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            pass  # 服务关闭后事件循环已关闭，名额不再需要释放
+
+    async def _acquire(self, priority: int):
+        if self._free_slots > 0:
+            # 有空闲名额时堆中只剩已取消的条目
+            self._waiters.clear()
+            self._free_slots -= 1
+            return
+        future = self._loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 已分配到名额后才被取消时把名额交给下一个任务；未分配时其条目在出堆时被跳过
+            if future.done() and not future.cancelled():
+                self._release_slot()
+            raise
+
+    def _release_slot(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._free_slots += 1
+
+    def _release(self):
+        self.in_flight -= 1
+        self.completed += 1
+        self._release_slot()
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }